@@ -5,32 +5,167 @@
 # =============================================================================
 
 import os
+import bisect
+import logging
+import uuid
+import socket
+import base64
+import hashlib
+import hmac
+import secrets
 import requests
 import json
 import re
 import time
 import random
+import queue
+import select
+import atexit
+import tempfile
+import shutil
+import subprocess
 import threading
-from flask import Flask, request, jsonify, render_template_string, Response
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from collections import deque
+from flask import Flask, request, jsonify, render_template_string, Response, stream_with_context, send_file, g
 from flask_cors import CORS
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import text, inspect
+from sqlalchemy import text, inspect, insert, update, bindparam, event, create_engine
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.pool import NullPool, QueuePool
+from extracao_nome import extrair_nome, extrair_nomes
+from telefones import normalizar_telefone
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow é opcional: sem ele, o painel mostra a imagem original.
+    Image = ImageOps = None
 
 # Carrega as variáveis de ambiente do arquivo .env para testes locais
 load_dotenv()
 
+# --- Logs ---
+# Tudo passa pelo logger "whatformula". LOG_LEVEL escolhe o nível e LOG_FORMATO=json
+# emite uma linha JSON por evento (com os campos de `extra={"campos": {...}}`).
+# Os caminhos quentes (cada lote salvo, cada envio) logam em DEBUG: desligados por padrão.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMATO = os.getenv("LOG_FORMATO", "texto")
+
+class FormatadorJson(logging.Formatter):
+    def format(self, registro):
+        dados = {"momento": self.formatTime(registro), "nivel": registro.levelname, "logger": registro.name,
+                 "thread": registro.threadName, "mensagem": registro.getMessage(), **getattr(registro, "campos", {})}
+        if registro.exc_info:
+            dados["excecao"] = self.formatException(registro.exc_info)
+        return json.dumps(dados, ensure_ascii=False, default=str)
+
+logger = logging.getLogger("whatformula")
+if not logger.handlers:
+    _saida_log = logging.StreamHandler()
+    _saida_log.setFormatter(FormatadorJson() if LOG_FORMATO == "json"
+                            else logging.Formatter("%(asctime)s %(levelname)s [%(threadName)s] %(message)s"))
+    logger.addHandler(_saida_log)
+    logger.propagate = False
+logger.setLevel(LOG_LEVEL)
+
 # --- Configuração do Banco de Dados ---
 app = Flask(__name__)
 CORS(app)
-db_url = os.getenv('DATABASE_URL')
-if db_url and db_url.startswith("postgres://"):
-    db_url = db_url.replace("postgres://", "postgresql://", 1)
+
+def normalizar_url_banco(url):
+    """
+    Fixa o driver psycopg2 (o do requirements.txt e o que o ouvinte de eventos usa):
+    o SQLAlchemy 2.1 passou a usar o psycopg 3 para URLs "postgresql://" sem driver.
+    """
+    if url and url.startswith("postgres://"):
+        url = url.replace("postgres://", "postgresql://", 1)
+    if url and url.startswith("postgresql://"):
+        url = url.replace("postgresql://", "postgresql+psycopg2://", 1)
+    return url
+
+db_url = normalizar_url_banco(os.getenv('DATABASE_URL'))
+
+# Pool de conexões. Cada worker do gunicorn tem o seu, então o Postgres recebe até
+# workers × (DB_POOL_SIZE + DB_MAX_OVERFLOW) conexões, mais as dedicadas (LISTEN,
+# travas de migração/retenção). DB_POOL_PRE_PING descarta conexões derrubadas
+# enquanto o app esteve ocioso e DB_POOL_RECYCLE_S as renova antes do timeout do
+# servidor/proxy.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "5"))
+DB_POOL_TIMEOUT_S = float(os.getenv("DB_POOL_TIMEOUT_S", "10"))
+DB_POOL_RECYCLE_S = int(os.getenv("DB_POOL_RECYCLE_S", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1") == "1"
+# Atrás do PgBouncer em modo transação o pool é dele: o app usa NullPool. Recursos
+# que dependem da sessão do servidor (LISTEN, advisory locks de sessão) não
+# atravessam esse modo; com DATABASE_URL_DIRETA (conexão direta ao Postgres) eles
+# passam por ela, e sem ela os eventos ficam restritos a cada processo.
+DB_PGBOUNCER = os.getenv("DB_PGBOUNCER", "0") == "1"
+DATABASE_URL_DIRETA = normalizar_url_banco(os.getenv("DATABASE_URL_DIRETA"))
+
+def opcoes_motor_banco(url):
+    """SQLALCHEMY_ENGINE_OPTIONS para a URL em uso; o SQLite fica com os padrões do Flask-SQLAlchemy."""
+    if not url or url.startswith("sqlite"):
+        return {}
+    if DB_PGBOUNCER:
+        opcoes = {"poolclass": NullPool}
+        if url.startswith("postgresql+psycopg:"):
+            # O psycopg 3 prepara comandos no servidor, e o PgBouncer troca a conexão entre transações.
+            opcoes["connect_args"] = {"prepare_threshold": None}
+        return opcoes
+    return {"pool_size": DB_POOL_SIZE, "max_overflow": DB_MAX_OVERFLOW, "pool_timeout": DB_POOL_TIMEOUT_S,
+            "pool_recycle": DB_POOL_RECYCLE_S, "pool_pre_ping": DB_POOL_PRE_PING}
+
 app.config['SQLALCHEMY_DATABASE_URI'] = db_url
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = opcoes_motor_banco(db_url)
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 db = SQLAlchemy(app)
 
+with app.app_context():
+    motor_banco = db.engine
+_motor_direto = None
+
+# Um pool herdado do processo pai (gunicorn --preload) compartilharia sockets com
+# ele: o filho começa com o pool vazio, sem fechar as conexões do pai.
+os.register_at_fork(after_in_child=lambda: motor_banco.dispose(close=False))
+
+def motor_sessao():
+    """Motor para o que precisa da mesma sessão no servidor do início ao fim (LISTEN, advisory locks)."""
+    global _motor_direto
+    if not (DB_PGBOUNCER and DATABASE_URL_DIRETA):
+        return motor_banco
+    if _motor_direto is None:
+        _motor_direto = create_engine(DATABASE_URL_DIRETA, poolclass=NullPool)
+    return _motor_direto
+
+def sessao_postgres_dedicada():
+    """True quando motor_sessao() mantém a mesma sessão do Postgres do início ao fim da conexão."""
+    return motor_banco.dialect.name == 'postgresql' and (not DB_PGBOUNCER or bool(DATABASE_URL_DIRETA))
+
+if DB_PGBOUNCER and not DATABASE_URL_DIRETA:
+    logger.warning("DB_PGBOUNCER sem DATABASE_URL_DIRETA: eventos ficam restritos a cada processo, a retenção "
+                   "roda sem advisory lock entre workers e os workers não aplicam migrações (use 'flask migrar').")
+
+@contextmanager
+def sessao_de_fundo():
+    """
+    App context para trabalho fora de requests (threads e agendadores). Na saída a
+    transação interrompida é desfeita e a sessão é removida, devolvendo a conexão ao
+    pool mesmo que a thread continue viva.
+    """
+    with app.app_context():
+        try:
+            yield db.session
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            db.session.remove()
+
 # --- Modelos das Tabelas do Banco de Dados ---
 class Cadastro(db.Model):
     __tablename__ = 'cadastros'
@@ -58,6 +193,247 @@ class Reclamacao(db.Model):
     media_id = db.Column(db.String(255), nullable=True)
     media_type = db.Column(db.String(50), nullable=True)
     timestamp = db.Column(db.DateTime, default=lambda: datetime.utcnow() - timedelta(hours=3))
+    atualizado_em = db.Column(db.DateTime, default=lambda: datetime.utcnow() - timedelta(hours=3),
+                              onupdate=lambda: datetime.utcnow() - timedelta(hours=3))
+
+class Participante(db.Model):
+    __tablename__ = 'participantes'
+    id = db.Column(db.Integer, primary_key=True)
+    telefone = db.Column(db.String(30), unique=True, nullable=False)
+    nome = db.Column(db.String(100), nullable=True)
+    boas_vindas_enviada = db.Column(db.Boolean, nullable=False, default=False)
+    data_criacao = db.Column(db.DateTime, default=lambda: datetime.utcnow() - timedelta(hours=3))
+
+class Sorteio(db.Model):
+    """Registro auditável de cada sorteio: semente, participantes considerados e vencedores."""
+    __tablename__ = 'sorteios'
+    id = db.Column(db.Integer, primary_key=True)
+    realizado_em = db.Column(db.DateTime, default=lambda: datetime.utcnow() - timedelta(hours=3))
+    algoritmo = db.Column(db.String(30), nullable=False)
+    semente = db.Column(db.String(64), nullable=False)
+    total_participantes = db.Column(db.Integer, nullable=False)
+    maior_participante_id = db.Column(db.Integer, nullable=False)
+    hash_participantes = db.Column(db.String(64), nullable=False)
+    quantidade = db.Column(db.Integer, nullable=False)
+    excluidos = db.Column(db.Text, nullable=False, default='[]')
+    vencedores = db.Column(db.Text, nullable=False)
+    versao_registro = db.Column(db.BigInteger, nullable=True)
+
+class Contato(db.Model):
+    """Resumo por telefone, mantido por upsert a cada lote do webhook."""
+    __tablename__ = 'contatos'
+    id = db.Column(db.Integer, primary_key=True)
+    telefone = db.Column(db.String(30), unique=True, nullable=False)
+    ultimo_nome = db.Column(db.String(100), nullable=True)
+    ultima_mensagem_em = db.Column(db.DateTime, nullable=False)
+    total_mensagens = db.Column(db.Integer, nullable=False, default=0)
+    janela_expira_em = db.Column(db.DateTime, nullable=False)
+    opt_in = db.Column(db.Boolean, nullable=False, default=True)
+
+class NotificacaoPendente(db.Model):
+    """Notificação aceita pelo webhook assíncrono e ainda não processada (spool durável)."""
+    __tablename__ = 'webhook_pendentes'
+    id = db.Column(db.Integer, primary_key=True)
+    payload = db.Column(db.Text, nullable=False)
+    recebida_em = db.Column(db.DateTime, default=lambda: datetime.utcnow() - timedelta(hours=3))
+    tentativas = db.Column(db.Integer, nullable=False, default=1)
+    lease_dono = db.Column(db.String(100), nullable=True)
+    lease_expira = db.Column(db.DateTime, nullable=True)
+
+class Campanha(db.Model):
+    __tablename__ = 'campanhas'
+    id = db.Column(db.Integer, primary_key=True)
+    perfil = db.Column(db.String(20), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='pendente')
+    mensagens = db.Column(db.Text, nullable=True)
+    preparada = db.Column(db.Boolean, nullable=False, default=False)
+    total = db.Column(db.Integer, nullable=False, default=0)
+    progresso = db.Column(db.Integer, nullable=False, default=0)
+    ignorados = db.Column(db.Integer, nullable=False, default=0)
+    lease_dono = db.Column(db.String(100), nullable=True)
+    lease_expira = db.Column(db.DateTime, nullable=True)
+    iniciada_em = db.Column(db.DateTime, default=lambda: datetime.utcnow() - timedelta(hours=3))
+    finalizada_em = db.Column(db.DateTime, nullable=True)
+
+class Contador(db.Model):
+    __tablename__ = 'contadores'
+    chave = db.Column(db.String(100), primary_key=True)
+    valor = db.Column(db.BigInteger, nullable=False, default=0)
+
+class CampanhaDestinatario(db.Model):
+    __tablename__ = 'campanha_destinatarios'
+    __table_args__ = (db.UniqueConstraint('campanha_id', 'telefone', name='uq_campanha_destinatarios_telefone'),)
+    id = db.Column(db.Integer, primary_key=True)
+    campanha_id = db.Column(db.Integer, db.ForeignKey('campanhas.id'), nullable=False)
+    telefone = db.Column(db.String(30), nullable=False)
+    ordem = db.Column(db.Integer, nullable=False)
+    estado = db.Column(db.String(10), nullable=False, default='pendente')
+
+class CampanhaLog(db.Model):
+    __tablename__ = 'campanha_logs'
+    __table_args__ = (db.UniqueConstraint('campanha_id', 'seq', name='uq_campanha_logs_seq'),)
+    id = db.Column(db.Integer, primary_key=True)
+    campanha_id = db.Column(db.Integer, db.ForeignKey('campanhas.id'), nullable=False)
+    seq = db.Column(db.Integer, nullable=False)
+    momento = db.Column(db.DateTime, nullable=False)
+    nivel = db.Column(db.String(10), nullable=False)
+    telefone = db.Column(db.String(30), nullable=True)
+    resultado = db.Column(db.String(20), nullable=True)
+    mensagem = db.Column(db.Text, nullable=False)
+
+class SchemaMigracao(db.Model):
+    __tablename__ = 'schema_migracoes'
+    versao = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    descricao = db.Column(db.String(255), nullable=False)
+    aplicada_em = db.Column(db.DateTime, default=lambda: datetime.utcnow() - timedelta(hours=3))
+
+# Índices das consultas mais frequentes (painel, disparo, sorteio e limpeza). Tabelas
+# que já existem em produção recebem estes mesmos índices pela migração 1.
+db.Index('ix_mensagens_telefone_data', Mensagem.telefone, Mensagem.data_recebimento.desc())
+db.Index('ix_mensagens_data_recebimento', Mensagem.data_recebimento, Mensagem.id)
+db.Index('ix_reclamacoes_timestamp', Reclamacao.timestamp, Reclamacao.id)
+db.Index('ix_reclamacoes_atualizado_em', Reclamacao.atualizado_em, Reclamacao.id)
+db.Index('ix_contatos_janela', Contato.janela_expira_em)
+db.Index('ix_contatos_ultima_mensagem', Contato.ultima_mensagem_em)
+db.Index('ix_participantes_data_criacao', Participante.data_criacao, Participante.id)
+db.Index('ix_campanha_destinatarios_fila', CampanhaDestinatario.campanha_id, CampanhaDestinatario.estado, CampanhaDestinatario.ordem)
+
+# --- Migrações de Esquema ---
+# Cada migração roda uma única vez, em ordem, e fica registrada em `schema_migracoes`.
+# Passos, nesta ordem: "colunas" (tabela, coluna, tipo), "sql" (comandos idempotentes),
+# "funcoes" (para o que depende do dialeto; cada uma recebe uma conexão numa transação
+# só dela, que confirma ao terminar) e "indices" (nome, "tabela (colunas)"). No
+# Postgres os índices são criados com CREATE INDEX CONCURRENTLY, sem bloquear as
+# escritas nas tabelas de produção.
+MIGRACOES = [
+    {"versao": 1, "descricao": "índices de mensagens e reclamações", "indices": [
+        ("ix_mensagens_telefone_data", "mensagens (telefone, data_recebimento DESC)"),
+        ("ix_mensagens_data_recebimento", "mensagens (data_recebimento, id)"),
+        ("ix_reclamacoes_timestamp", "reclamacoes (timestamp, id)"),
+    ]},
+    # Os cadastros existentes entram no registro com o nome mais recente e já marcados
+    # como recebidos: no modelo antigo eles eram carregados na memória ao iniciar e
+    # nunca recebiam as boas-vindas de novo.
+    {"versao": 2, "descricao": "registro de participantes no banco", "sql": [
+        """INSERT INTO participantes (telefone, nome, boas_vindas_enviada, data_criacao)
+           SELECT c.telefone,
+                  COALESCE(u.nome, 'Pessoa (' || SUBSTR(c.telefone, LENGTH(c.telefone) - 3) || ')'),
+                  TRUE, c.data_criacao
+           FROM cadastros c
+           LEFT JOIN (
+               SELECT telefone, nome,
+                      ROW_NUMBER() OVER (PARTITION BY telefone ORDER BY data_recebimento DESC, id DESC) AS ordem
+               FROM mensagens
+           ) u ON u.telefone = c.telefone AND u.ordem = 1
+           WHERE NOT EXISTS (SELECT 1 FROM participantes p WHERE p.telefone = c.telefone)
+           ORDER BY c.id""",
+    ]},
+    {"versao": 3, "descricao": "data de atualização das reclamações",
+     "colunas": [("reclamacoes", "atualizado_em", "TIMESTAMP")],
+     "sql": ["UPDATE reclamacoes SET atualizado_em = timestamp WHERE atualizado_em IS NULL"],
+     "indices": [("ix_reclamacoes_atualizado_em", "reclamacoes (atualizado_em, id)")]},
+    # Campanhas da versão em memória que ficaram "executando" não têm destinatários
+    # gravados; retomá-las reenviaria para todos, então são encerradas.
+    {"versao": 4, "descricao": "campanhas duráveis com lease",
+     "colunas": [("campanhas", "mensagens", "TEXT"),
+                 ("campanhas", "preparada", "BOOLEAN NOT NULL DEFAULT FALSE"),
+                 ("campanhas", "lease_dono", "VARCHAR(100)"),
+                 ("campanhas", "lease_expira", "TIMESTAMP")],
+     "sql": ["UPDATE campanhas SET status = 'interrompida' WHERE status = 'executando' AND mensagens IS NULL"]},
+    {"versao": 5, "descricao": "contadores incrementais das estatísticas",
+     "funcoes": [lambda conexao: recalcular_contadores(conexao)]},
+    {"versao": 6, "descricao": "resumo por contato",
+     "funcoes": [lambda conexao: preencher_contatos(conexao)]},
+    {"versao": 7, "descricao": "índice da janela de releitura dos participantes",
+     "indices": [("ix_participantes_data_criacao", "participantes (data_criacao, id)")]},
+    {"versao": 8, "descricao": "versão do registro de participantes em cada sorteio",
+     "colunas": [("sorteios", "versao_registro", "BIGINT")]},
+]
+MIGRACOES_TRAVA_PG = 7340032
+MIGRAR_AO_INICIAR = os.getenv("MIGRAR_AO_INICIAR", "1") == "1"
+trava_migracoes = threading.Lock()
+# Marcado quando a etapa de migrações do início termina (aplicadas, recusadas ou com erro).
+esquema_pronto = threading.Event()
+
+def criar_indice(conexao, nome, definicao):
+    if db.engine.dialect.name != 'postgresql':
+        conexao.execute(text(f"CREATE INDEX IF NOT EXISTS {nome} ON {definicao}"))
+        return
+    # Um CREATE INDEX CONCURRENTLY interrompido deixa o índice marcado como inválido;
+    # ele é removido antes de tentar de novo, senão o IF NOT EXISTS o manteria.
+    invalido = conexao.execute(text(
+        "SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = :nome AND NOT i.indisvalid"
+    ), {"nome": nome}).first()
+    if invalido:
+        conexao.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {nome}"))
+    conexao.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {nome} ON {definicao}"))
+
+def adicionar_coluna(conexao, tabela, coluna, tipo):
+    if coluna not in {c["name"] for c in inspect(conexao).get_columns(tabela)}:
+        conexao.execute(text(f"ALTER TABLE {tabela} ADD COLUMN {coluna} {tipo}"))
+
+def aplicar_migracoes(forcar=False):
+    """
+    Cria as tabelas que faltam e aplica as migrações pendentes. Os comandos rodam
+    em autocommit (exigência do CONCURRENTLY) e um advisory lock impede que dois
+    workers migrem ao mesmo tempo: quem não obtém a trava espera o outro terminar
+    e então encontra tudo aplicado. Retorna as versões aplicadas.
+
+    Atrás do PgBouncer sem DATABASE_URL_DIRETA não há como segurar essa trava, e
+    a migração só roda com `forcar` (execução única e explícita, como `flask migrar`).
+    """
+    if not forcar and motor_banco.dialect.name == 'postgresql' and not sessao_postgres_dedicada():
+        logger.error("Migrações não aplicadas: com DB_PGBOUNCER os workers não têm advisory lock entre si. "
+                     "Configure DATABASE_URL_DIRETA ou rode uma vez 'flask --app app_completo migrar'.")
+        return []
+    aplicadas = []
+    with trava_migracoes, sessao_de_fundo():
+        postgres = sessao_postgres_dedicada()
+        with motor_sessao().connect().execution_options(isolation_level="AUTOCOMMIT") as conexao:
+            # pg_advisory_lock bloqueante travaria com o CREATE INDEX CONCURRENTLY do
+            # outro worker, que espera as transações abertas; por isso a espera é por sondagem.
+            aguardando = False
+            while postgres and not conexao.execute(text("SELECT pg_try_advisory_lock(:k)"), {"k": MIGRACOES_TRAVA_PG}).scalar():
+                if not aguardando:
+                    logger.info("Migrações já estão sendo aplicadas por outro processo; aguardando.")
+                    aguardando = True
+                time.sleep(1)
+            try:
+                db.metadata.create_all(conexao)
+                feitas = set(conexao.execute(text("SELECT versao FROM schema_migracoes")).scalars())
+                for migracao in MIGRACOES:
+                    if migracao["versao"] in feitas: continue
+                    for tabela, coluna, tipo in migracao.get("colunas", []):
+                        adicionar_coluna(conexao, tabela, coluna, tipo)
+                    for sql in migracao.get("sql", []):
+                        conexao.execute(text(sql))
+                    for funcao in migracao.get("funcoes", []):
+                        with conexao.engine.begin() as transacao:
+                            funcao(transacao)
+                    for nome, definicao in migracao.get("indices", []):
+                        criar_indice(conexao, nome, definicao)
+                    conexao.execute(
+                        text("INSERT INTO schema_migracoes (versao, descricao, aplicada_em) VALUES (:versao, :descricao, :aplicada_em)"),
+                        {"versao": migracao["versao"], "descricao": migracao["descricao"], "aplicada_em": agora_local()}
+                    )
+                    aplicadas.append(migracao["versao"])
+                    logger.info("Migração %s aplicada: %s", migracao['versao'], migracao['descricao'])
+            finally:
+                if postgres:
+                    conexao.execute(text("SELECT pg_advisory_unlock(:k)"), {"k": MIGRACOES_TRAVA_PG})
+    return aplicadas
+
+def tarefa_migracoes():
+    try:
+        aplicar_migracoes()
+    except Exception as e:
+        logger.exception("Erro ao aplicar migrações: %s", e)
+
+@app.cli.command("migrar")
+def comando_migrar():
+    """Aplica as migrações pendentes uma vez, inclusive atrás do PgBouncer sem DATABASE_URL_DIRETA."""
+    aplicadas = aplicar_migracoes(forcar=True)
+    print(f"Migrações aplicadas: {', '.join(map(str, aplicadas))}." if aplicadas else "Nenhuma migração pendente.")
 
 # --- Credenciais e Variáveis Globais ---
 META_ACCESS_TOKEN = os.getenv("META_ACCESS_TOKEN")
@@ -65,194 +441,2366 @@ META_PHONE_NUMBER_ID = os.getenv("META_PHONE_NUMBER_ID")
 META_VERIFY_TOKEN = os.getenv("META_VERIFY_TOKEN")
 
 db_participantes_sorteio = {}
-disparo_status = {"ativo": False, "progresso": 0, "total": 0, "log": []}
+disparo_status = {"ativo": False, "progresso": 0, "total": 0, "elegiveis": 0, "ignorados": 0, "campanha_id": None, "ultimo_seq": 0}
+# Em disparo_status, "ativo" indica que ESTE processo está executando a campanha.
+trava_disparo = threading.Lock()
+
+# Log da campanha: um buffer circular com as últimas DISPARO_LOG_MAX entradas para o
+# painel (que pede só o que veio depois de `after`) e gravação em lotes na tabela
+# `campanha_logs`, que guarda o histórico completo para auditoria.
+DISPARO_LOG_MAX = int(os.getenv("DISPARO_LOG_MAX", "500"))
+DISPARO_LOG_LOTE = 50
+DISPARO_LOG_INTERVALO_S = 2.0
+disparo_log = deque(maxlen=DISPARO_LOG_MAX)
+disparo_log_pendentes = []
+disparo_log_gravado_em = 0.0
+trava_log = threading.Lock()
+
+# O registro de participantes fica na tabela `participantes`, compartilhada por todos
+# os workers. `db_participantes_sorteio` é só um cache de leitura deste processo: a
+# tabela só cresce, então a atualização busca os ids acima do último visto. Como os
+# ids são reservados antes do commit, uma transação lenta pode gravar um id menor
+# depois de um maior já lido; por isso cada leitura relê os ids chegados nos últimos
+# PARTICIPANTES_RELEITURA_S e, a cada PARTICIPANTES_RECONCILIAR_S (0 desativa), o
+# registro inteiro é relido. Jobs que reescrevem participantes existentes (mesclas,
+# backfill de nomes) incrementam o contador "participantes:versao"; cada worker o
+# confere a cada leitura e, se mudou, relê tudo. A carga inicial roda em segundo
+# plano, em paralelo com as migrações; até lá /health informa que não está pronto.
+# O webhook não espera por ela: quem recebe as boas-vindas é decidido pelo UPDATE
+# condicional do flag no banco, e o cache só poupa consultas.
+PARTICIPANTES_CARGA_ASSINCRONA = os.getenv("PARTICIPANTES_CARGA_ASSINCRONA", "1") == "1"
+PARTICIPANTES_BLOCO = int(os.getenv("PARTICIPANTES_BLOCO", "2000"))
+PARTICIPANTES_CACHE_TTL_S = float(os.getenv("PARTICIPANTES_CACHE_TTL_S", "5"))
+PARTICIPANTES_RELEITURA_S = float(os.getenv("PARTICIPANTES_RELEITURA_S", "60"))
+PARTICIPANTES_RECONCILIAR_S = float(os.getenv("PARTICIPANTES_RECONCILIAR_S", "900"))
+participantes_prontos = threading.Event()
+# `marcas` guarda (momento, ultimo_id) de cada leitura para achar o piso da releitura.
+cache_participantes = {"ultimo_id": 0, "atualizado_em": 0.0, "nomes_desde": None, "versao": 0,
+                       "marcas": deque(), "reconciliado_em": 0.0, "versao_registro": None}
+VERSAO_PARTICIPANTES_CHAVE = "participantes:versao"
+trava_cache_participantes = threading.Lock()
+
+# --- Motor de Disparo ---
+# "conservador" mantém o ritmo manual original (lotes de 5 com pausas longas);
+# "rapido" usa um pool de threads limitado por token bucket na vazão da Cloud API.
+PERFIS_DISPARO = ("conservador", "rapido")
+DISPARO_PERFIL_PADRAO = os.getenv("DISPARO_PERFIL", "conservador")
+DISPARO_MSGS_POR_SEGUNDO = float(os.getenv("DISPARO_MSGS_POR_SEGUNDO", "80"))
+DISPARO_WORKERS = int(os.getenv("DISPARO_WORKERS", "16"))
+
+# Campanhas são jobs no banco: qualquer worker cria, mas só quem detém o lease
+# executa. O lease é renovado enquanto a campanha roda; se o processo morrer, ele
+# expira e outro worker retoma a partir dos destinatários ainda pendentes.
+ESTADOS_CAMPANHA_ATIVA = ("pendente", "executando", "parando")
+# Uma campanha "parando" não é retomada: se o dono sumiu, o agendador a encerra.
+ESTADOS_CAMPANHA_ASSUMIVEL = ("pendente", "executando")
+CAMPANHA_LEASE_S = int(os.getenv("CAMPANHA_LEASE_S", "60"))
+CAMPANHA_POLL_S = int(os.getenv("CAMPANHA_POLL_S", "5"))
+CAMPANHA_TRAVA_PG = 7340033
+_SUFIXO_PROCESSO = uuid.uuid4().hex[:6]
+acordar_agendador_campanhas = threading.Event()
+
+# --- Fila de Ingestão do Webhook ---
+# Com WEBHOOK_ASYNC=1 o webhook grava o payload cru em `webhook_pendentes` e só então
+# responde 200 e enfileira a notificação; um pool de consumidores em segundo plano faz
+# a persistência, a extração do nome e as respostas, e apaga a linha do spool quando a
+# gravação dá certo. Cada linha tem um lease (dono + validade) como as campanhas: se o
+# processo cai ou a gravação falha, o lease vence e o agendador do spool devolve a
+# notificação à fila de algum worker, até WEBHOOK_MAX_TENTATIVAS vezes (depois ela fica
+# na tabela para inspeção). A entrega é "pelo menos uma vez": um processo que cai entre
+# gravar o lote e apagar a linha faz a notificação ser processada de novo.
+WEBHOOK_ASYNC = os.getenv("WEBHOOK_ASYNC", "0") == "1"
+WEBHOOK_FILA_MAX = int(os.getenv("WEBHOOK_FILA_MAX", "1000"))
+WEBHOOK_CONSUMIDORES = int(os.getenv("WEBHOOK_CONSUMIDORES", "4"))
+WEBHOOK_LEASE_S = int(os.getenv("WEBHOOK_LEASE_S", "120"))
+WEBHOOK_REPROCESSAR_S = int(os.getenv("WEBHOOK_REPROCESSAR_S", "30"))
+WEBHOOK_MAX_TENTATIVAS = int(os.getenv("WEBHOOK_MAX_TENTATIVAS", "5"))
+
+fila_webhook = queue.Queue(maxsize=WEBHOOK_FILA_MAX)
+fila_status = {"recebidas": 0, "processadas": 0, "erros": 0, "processadas_inline": 0, "ultimo_atraso_s": 0.0, "maior_atraso_s": 0.0}
+trava_fila_status = threading.Lock()
+
+_tarefas_iniciadas_pid = None
+_trava_tarefas = threading.Lock()
+
+# --- Métricas ---
+# Registro mínimo de métricas em memória, exposto em /metrics no formato texto do
+# Prometheus. Cada worker do gunicorn tem o seu: o Prometheus deve coletar cada
+# processo (ou somar por instância). Contadores e histogramas são atualizados nos
+# caminhos quentes; valores derivados de outras estruturas (filas, Graph API, pool)
+# vêm de coletores chamados só na hora da coleta.
+FAIXAS_HTTP_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 10000)
+FAIXAS_DB_MS = (1, 2, 5, 10, 25, 50, 100, 250, 1000, 5000)
+
+class Histograma:
+    """Histograma de latência com faixas fixas (ms), seguro entre threads."""
+    FAIXAS_MS = (25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+    def __init__(self, faixas_ms=None):
+        self.faixas_ms = tuple(faixas_ms or self.FAIXAS_MS)
+        self.contagens = [0] * (len(self.faixas_ms) + 1)
+        self.total = 0
+        self.soma_ms = 0.0
+        self.trava = threading.Lock()
+
+    def observar(self, ms):
+        i = bisect.bisect_left(self.faixas_ms, ms)
+        with self.trava:
+            self.contagens[i] += 1
+            self.total += 1
+            self.soma_ms += ms
+
+    def instantaneo(self):
+        with self.trava:
+            return list(self.contagens), self.total, self.soma_ms
+
+    def percentil(self, p, contagens, total):
+        """Estimativa pelo limite superior da faixa que contém o percentil."""
+        if not total: return None
+        alvo, acumulado = p * total, 0
+        for i, n in enumerate(contagens):
+            acumulado += n
+            if acumulado >= alvo:
+                return self.faixas_ms[i] if i < len(self.faixas_ms) else None
+        return None
+
+    def para_dict(self):
+        contagens, total, soma = self.instantaneo()
+        faixas = list(self.faixas_ms) + ["+Inf"]
+        return {
+            "total": total, "media_ms": round(soma / total, 1) if total else None,
+            "p50_ms": self.percentil(0.5, contagens, total), "p90_ms": self.percentil(0.9, contagens, total),
+            "p99_ms": self.percentil(0.99, contagens, total),
+            "faixas_ms": [[limite, n] for limite, n in zip(faixas, contagens)]
+        }
+
+def _rotulos_prometheus(rotulos):
+    if not rotulos: return ""
+    pares = ",".join('{}="{}"'.format(chave, str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                     for chave, valor in rotulos)
+    return "{" + pares + "}"
+
+class RegistroMetricas:
+    """Contadores, medidores e histogramas rotulados; `texto()` gera a exposição do Prometheus."""
+
+    def __init__(self):
+        self.familias = {}
+        self.series = {}
+        self.coletores = []
+        self.trava = threading.Lock()
+
+    def declarar(self, nome, tipo, ajuda, faixas_ms=None):
+        self.familias[nome] = (tipo, ajuda, faixas_ms)
+        self.series[nome] = {}
+
+    def contar(self, nome, valor=1, **rotulos):
+        chave = tuple(sorted(rotulos.items()))
+        with self.trava:
+            serie = self.series[nome]
+            serie[chave] = serie.get(chave, 0) + valor
+
+    def observar(self, nome, ms, **rotulos):
+        chave = tuple(sorted(rotulos.items()))
+        serie = self.series[nome]
+        histograma = serie.get(chave)
+        if histograma is None:
+            with self.trava:
+                histograma = serie.setdefault(chave, Histograma(self.familias[nome][2]))
+        histograma.observar(ms)
+
+    def coletor(self, funcao):
+        """Registra `funcao()`, que devolve [(nome, tipo, ajuda, {rótulos: valor ou Histograma})]."""
+        self.coletores.append(funcao)
+        return funcao
+
+    def texto(self):
+        with self.trava:
+            familias = [(nome, tipo, ajuda, dict(self.series[nome])) for nome, (tipo, ajuda, _) in self.familias.items()]
+        for coletor in self.coletores:
+            try:
+                familias.extend(coletor())
+            except Exception as e:
+                logger.error("Erro no coletor de métricas %s: %s", coletor.__name__, e)
+        linhas = []
+        for nome, tipo, ajuda, serie in familias:
+            linhas += [f"# HELP {nome} {ajuda}", f"# TYPE {nome} {tipo}"]
+            for rotulos, valor in serie.items():
+                if tipo == "histogram":
+                    linhas += self._linhas_histograma(nome, rotulos, valor)
+                else:
+                    linhas.append(f"{nome}{_rotulos_prometheus(rotulos)} {valor if isinstance(valor, int) else repr(float(valor))}")
+        return "\n".join(linhas) + "\n"
+
+    @staticmethod
+    def _linhas_histograma(nome, rotulos, histograma):
+        """Faixas cumulativas em segundos, como o Prometheus espera."""
+        contagens, total, soma_ms = histograma.instantaneo()
+        linhas, acumulado = [], 0
+        for limite, n in zip(list(histograma.faixas_ms) + [None], contagens):
+            acumulado += n
+            le = "+Inf" if limite is None else f"{limite / 1000:g}"
+            linhas.append(f"{nome}_bucket{_rotulos_prometheus(rotulos + (('le', le),))} {acumulado}")
+        linhas.append(f"{nome}_sum{_rotulos_prometheus(rotulos)} {soma_ms / 1000!r}")
+        linhas.append(f"{nome}_count{_rotulos_prometheus(rotulos)} {total}")
+        return linhas
+
+metricas = RegistroMetricas()
+metricas.declarar("whatformula_http_requisicoes_total", "counter", "Requisições HTTP por rota, método e status.")
+metricas.declarar("whatformula_http_requisicao_segundos", "histogram", "Latência das requisições HTTP por rota.", FAIXAS_HTTP_MS)
+metricas.declarar("whatformula_webhook_mensagens_total", "counter", "Mensagens recebidas pelo webhook, por tipo.")
+metricas.declarar("whatformula_webhook_processamento_segundos", "histogram", "Tempo para processar uma notificação do webhook.", FAIXAS_HTTP_MS)
+metricas.declarar("whatformula_webhook_atraso_fila_segundos", "histogram", "Tempo de uma notificação na fila de ingestão.", FAIXAS_HTTP_MS)
+metricas.declarar("whatformula_db_consultas_total", "counter", "Comandos SQL executados, por operação.")
+metricas.declarar("whatformula_db_consulta_segundos", "histogram", "Duração dos comandos SQL, por operação.", FAIXAS_DB_MS)
+metricas.declarar("whatformula_db_erros_total", "counter", "Comandos SQL que falharam, por operação.")
+metricas.declarar("whatformula_db_conexoes_abertas_total", "counter", "Conexões novas abertas com o banco.")
+metricas.declarar("whatformula_db_pool_retiradas_total", "counter", "Conexões retiradas do pool.")
+metricas.declarar("whatformula_envios_total", "counter", "Destinatários de campanha concluídos, por estado final.")
+
+@app.before_request
+def iniciar_medicao_requisicao():
+    g.inicio_requisicao = time.perf_counter()
+
+@app.after_request
+def medir_requisicao(resposta):
+    inicio = g.pop("inicio_requisicao", None)
+    if inicio is not None:
+        # A regra da rota ("/media/<media_id>"), não a URL, para não explodir a cardinalidade.
+        rota = request.url_rule.rule if request.url_rule else "sem_rota"
+        metricas.observar("whatformula_http_requisicao_segundos", (time.perf_counter() - inicio) * 1000,
+                          rota=rota, metodo=request.method)
+        metricas.contar("whatformula_http_requisicoes_total", rota=rota, metodo=request.method,
+                        status=resposta.status_code)
+    return resposta
+
+OPERACOES_SQL = {"SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "BEGIN", "COMMIT", "ROLLBACK", "CREATE", "ALTER"}
+
+def operacao_sql(comando):
+    palavra = (comando or "").lstrip().split(None, 1)[:1]
+    operacao = palavra[0].upper() if palavra else ""
+    return operacao if operacao in OPERACOES_SQL else "OUTRA"
+
+@event.listens_for(motor_banco, "before_cursor_execute")
+def _antes_do_comando_sql(conexao, cursor, comando, parametros, contexto, varios):
+    conexao.info.setdefault("inicio_comandos", []).append(time.perf_counter())
+
+@event.listens_for(motor_banco, "after_cursor_execute")
+def _depois_do_comando_sql(conexao, cursor, comando, parametros, contexto, varios):
+    inicio = conexao.info["inicio_comandos"].pop()
+    operacao = operacao_sql(comando)
+    metricas.contar("whatformula_db_consultas_total", operacao=operacao)
+    metricas.observar("whatformula_db_consulta_segundos", (time.perf_counter() - inicio) * 1000, operacao=operacao)
+
+@event.listens_for(motor_banco, "handle_error")
+def _erro_no_comando_sql(contexto):
+    conexao = contexto.connection
+    if conexao is not None and conexao.info.get("inicio_comandos"):
+        conexao.info["inicio_comandos"].pop()
+    metricas.contar("whatformula_db_erros_total", operacao=operacao_sql(contexto.statement))
+
+@event.listens_for(motor_banco, "connect")
+def _conexao_aberta(conexao_dbapi, registro):
+    metricas.contar("whatformula_db_conexoes_abertas_total")
+
+@event.listens_for(motor_banco, "checkout")
+def _conexao_retirada(conexao_dbapi, registro, proxy):
+    metricas.contar("whatformula_db_pool_retiradas_total")
+
+@metricas.coletor
+def coletar_metricas_pool():
+    """Ocupação do pool deste processo (com NullPool, no modo PgBouncer, só os contadores acima)."""
+    pool = motor_banco.pool
+    if not isinstance(pool, QueuePool): return []
+    return [
+        ("whatformula_db_pool_conexoes", "gauge", "Conexões do pool por estado (em_uso inclui o overflow).",
+         {(("estado", "em_uso"),): pool.checkedout(), (("estado", "livres"),): pool.checkedin()}),
+        ("whatformula_db_pool_tamanho", "gauge", "Tamanho configurado do pool (DB_POOL_SIZE).", {(): pool.size()}),
+        ("whatformula_db_pool_overflow", "gauge", "Conexões acima do tamanho do pool (negativo enquanto há vagas).",
+         {(): pool.overflow()}),
+    ]
+
+# --- Cliente da Graph API ---
+# Todas as chamadas à Graph API passam por um cliente único: sessão HTTP com pool
+# keep-alive, novas tentativas com backoff exponencial + jitter (respeitando o
+# Retry-After) e um disjuntor que pausa as campanhas quando a taxa de erro dispara.
+GRAPH_API_URL = os.getenv("GRAPH_API_URL", "https://graph.facebook.com/v19.0").rstrip("/")
+GRAPH_TIMEOUT_S = float(os.getenv("GRAPH_TIMEOUT_S", "15"))
+GRAPH_TENTATIVAS = int(os.getenv("GRAPH_TENTATIVAS", "4"))
+GRAPH_BACKOFF_BASE_S = float(os.getenv("GRAPH_BACKOFF_BASE_S", "0.5"))
+GRAPH_BACKOFF_MAX_S = float(os.getenv("GRAPH_BACKOFF_MAX_S", "30"))
+GRAPH_DISJUNTOR_JANELA_S = float(os.getenv("GRAPH_DISJUNTOR_JANELA_S", "60"))
+GRAPH_DISJUNTOR_MIN_CHAMADAS = int(os.getenv("GRAPH_DISJUNTOR_MIN_CHAMADAS", "20"))
+GRAPH_DISJUNTOR_TAXA_ERRO = float(os.getenv("GRAPH_DISJUNTOR_TAXA_ERRO", "0.5"))
+GRAPH_DISJUNTOR_PAUSA_S = float(os.getenv("GRAPH_DISJUNTOR_PAUSA_S", "60"))
+# Códigos de erro da Meta que indicam limite de taxa: vale esperar e tentar de novo.
+CODIGOS_LIMITE_META = {4, 613, 80007, 130429, 131048, 131056}
+STATUS_REPETIVEIS = {429, 500, 502, 503, 504}
+
+class ErroGraph(Exception):
+    """Falha definitiva numa chamada à Graph API. `tipo`: timeout, conexao, limite, api ou disjuntor."""
+
+    def __init__(self, mensagem, tipo="api", status=None, codigo=None, detalhe=None):
+        super().__init__(mensagem)
+        self.tipo = tipo
+        self.status = status
+        self.codigo = codigo
+        self.detalhe = detalhe
+
+def conexao_nao_aberta(erro):
+    """
+    True quando a requisição com certeza não chegou ao servidor: timeout ao conectar
+    ou falha do urllib3 ao abrir a conexão (NewConnectionError: recusada, sem rota,
+    ou o NameResolutionError do DNS). Conexões derrubadas depois de abertas
+    (RemoteDisconnected, ProtocolError) podem ter entregue o envio e não entram.
+    """
+    if isinstance(erro, requests.exceptions.ConnectTimeout): return True
+    vistos = set()
+    while erro is not None and id(erro) not in vistos:
+        vistos.add(id(erro))
+        if isinstance(erro, NewConnectionError): return True
+        causa = getattr(erro, "reason", None)
+        if causa is None and erro.args and isinstance(erro.args[0], BaseException):
+            causa = erro.args[0]
+        erro = causa if isinstance(causa, BaseException) else (erro.__cause__ or erro.__context__)
+    return False
+
+class DisjuntorGraph:
+    """
+    Circuit breaker por taxa de erro numa janela deslizante. Aberto, as chamadas
+    avulsas falham na hora e os envios de campanha aguardam a reabertura.
+    """
+
+    def __init__(self, janela_s, min_chamadas, taxa_erro, pausa_s):
+        self.janela_s = janela_s
+        self.min_chamadas = min_chamadas
+        self.taxa_erro = taxa_erro
+        self.pausa_s = pausa_s
+        self.resultados = deque()
+        self.aberto_ate = 0.0
+        self.aberturas = 0
+        self.trava = threading.Lock()
+
+    def _descartar_antigos(self, agora):
+        while self.resultados and self.resultados[0][0] < agora - self.janela_s:
+            self.resultados.popleft()
+
+    def registrar(self, sucesso):
+        agora = time.monotonic()
+        with self.trava:
+            self.resultados.append((agora, sucesso))
+            self._descartar_antigos(agora)
+            if sucesso or agora < self.aberto_ate: return
+            total = len(self.resultados)
+            erros = sum(1 for _, ok in self.resultados if not ok)
+            if total < self.min_chamadas or erros / total < self.taxa_erro: return
+            self.aberto_ate = agora + self.pausa_s
+            self.aberturas += 1
+            # Recomeça a contagem: após a pausa, a janela volta a ser avaliada do zero.
+            self.resultados.clear()
+        logger.warning("Graph API instável (%d/%d erros): disjuntor aberto por %gs.", erros, total, self.pausa_s)
+        if disparo_status["ativo"]:
+            registrar_log_disparo(f"Graph API instável: envios pausados por {self.pausa_s:g}s.", "aviso")
+
+    def aberto(self):
+        return time.monotonic() < self.aberto_ate
+
+    def aguardar(self, continuar=lambda: True):
+        """Bloqueia enquanto o disjuntor estiver aberto. Retorna False se `continuar()` ficar falso."""
+        while self.aberto():
+            if not continuar(): return False
+            time.sleep(min(1.0, max(0.0, self.aberto_ate - time.monotonic())))
+        return continuar()
+
+    def para_dict(self):
+        with self.trava:
+            self._descartar_antigos(time.monotonic())
+            total = len(self.resultados)
+            erros = sum(1 for _, ok in self.resultados if not ok)
+        restante = max(0.0, self.aberto_ate - time.monotonic())
+        return {"aberto": restante > 0, "reabre_em_s": round(restante, 1), "aberturas": self.aberturas,
+                "chamadas_na_janela": total, "erros_na_janela": erros}
+
+class ClienteGraph:
+    def __init__(self, url_base, pool_maxsize):
+        self.url_base = url_base
+        self.sessao = requests.Session()
+        adaptador = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize)
+        self.sessao.mount("https://", adaptador)
+        self.sessao.mount("http://", adaptador)
+        self.disjuntor = DisjuntorGraph(GRAPH_DISJUNTOR_JANELA_S, GRAPH_DISJUNTOR_MIN_CHAMADAS,
+                                        GRAPH_DISJUNTOR_TAXA_ERRO, GRAPH_DISJUNTOR_PAUSA_S)
+        self.latencias = {}
+        self.erros = {}
+        self.novas_tentativas = 0
+        self.trava = threading.Lock()
+
+    def _contar_erro(self, tipo):
+        with self.trava:
+            self.erros[tipo] = self.erros.get(tipo, 0) + 1
+
+    def _observar(self, operacao, ms):
+        with self.trava:
+            histograma = self.latencias.get(operacao) or self.latencias.setdefault(operacao, Histograma())
+        histograma.observar(ms)
+
+    def _espera(self, tentativa, retry_after=None):
+        """Backoff exponencial com jitter total; o Retry-After do servidor é o piso."""
+        espera = random.uniform(0, min(GRAPH_BACKOFF_MAX_S, GRAPH_BACKOFF_BASE_S * 2 ** tentativa))
+        if retry_after:
+            try:
+                espera = max(espera, min(GRAPH_BACKOFF_MAX_S, float(retry_after)))
+            except ValueError:
+                pass
+        return espera
+
+    @staticmethod
+    def _erro_meta(resposta):
+        try:
+            erro = resposta.json().get("error") or {}
+            return erro.get("code"), erro.get("message")
+        except ValueError:
+            return None, None
+
+    def requisitar(self, metodo, caminho, operacao, idempotente=True, **kwargs):
+        """
+        Executa a chamada com novas tentativas. Envios (POST) só são repetidos quando
+        a API recusou explicitamente (limite de taxa) ou a conexão nem chegou a abrir
+        (veja conexao_nao_aberta), para não duplicar mensagens; falhas 5xx, timeouts de
+        leitura e conexões derrubadas no meio só repetem em GET.
+        """
+        url = caminho if caminho.startswith("http") else f"{self.url_base}/{caminho.lstrip('/')}"
+        headers = {"Authorization": f"Bearer {META_ACCESS_TOKEN}", **kwargs.pop("headers", {})}
+        kwargs.setdefault("timeout", GRAPH_TIMEOUT_S)
+        for tentativa in range(GRAPH_TENTATIVAS):
+            if self.disjuntor.aberto():
+                self._contar_erro("disjuntor")
+                raise ErroGraph("Disjuntor aberto: Graph API instável", "disjuntor")
+            ultima = tentativa == GRAPH_TENTATIVAS - 1
+            inicio = time.perf_counter()
+            try:
+                resposta = self.sessao.request(metodo, url, headers=headers, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                self._observar(operacao, (time.perf_counter() - inicio) * 1000)
+                self.disjuntor.registrar(False)
+                tipo = "timeout" if isinstance(e, requests.exceptions.Timeout) else "conexao"
+                self._contar_erro(tipo)
+                repetivel = idempotente or conexao_nao_aberta(e)
+                if ultima or not repetivel:
+                    raise ErroGraph(f"{tipo} em {operacao}: {e}", tipo) from e
+                self._repetir(tentativa)
+                continue
+            except requests.exceptions.RequestException as e:
+                self._contar_erro("requisicao")
+                raise ErroGraph(f"Requisição inválida em {operacao}: {e}", "api") from e
+
+            self._observar(operacao, (time.perf_counter() - inicio) * 1000)
+            if resposta.ok:
+                self.disjuntor.registrar(True)
+                return resposta
+
+            codigo, mensagem = self._erro_meta(resposta)
+            limite = resposta.status_code == 429 or codigo in CODIGOS_LIMITE_META
+            instavel = limite or resposta.status_code >= 500
+            # Erros do destinatário (número inválido, fora da janela...) não contam para o disjuntor.
+            self.disjuntor.registrar(not instavel)
+            tipo = "limite" if limite else "api"
+            self._contar_erro(f"{tipo}_{resposta.status_code}")
+            repetivel = limite or (idempotente and resposta.status_code in STATUS_REPETIVEIS)
+            if ultima or not repetivel:
+                raise ErroGraph(f"HTTP {resposta.status_code} em {operacao}: {mensagem or resposta.reason}",
+                                tipo, resposta.status_code, codigo, resposta.text[:500])
+            # Devolve a conexão ao pool antes de esperar (respostas em stream não são lidas).
+            resposta.close()
+            self._repetir(tentativa, resposta.headers.get("Retry-After"))
+
+    def _repetir(self, tentativa, retry_after=None):
+        with self.trava:
+            self.novas_tentativas += 1
+        time.sleep(self._espera(tentativa, retry_after))
+
+    def enviar_mensagem(self, destinatario, corpo):
+        data = {"messaging_product": "whatsapp", "to": destinatario, "type": "text", "text": {"body": corpo}}
+        return self.requisitar("POST", f"{META_PHONE_NUMBER_ID}/messages", "enviar_mensagem", idempotente=False,
+                               data=json.dumps(data), headers={"Content-Type": "application/json"})
+
+    def info_midia(self, media_id):
+        return self.requisitar("GET", f"{media_id}/", "info_midia").json()
+
+    def baixar_midia(self, url, **kwargs):
+        return self.requisitar("GET", url, "baixar_midia", **kwargs)
+
+    def para_dict(self):
+        with self.trava:
+            latencias, erros, repetidas = dict(self.latencias), dict(self.erros), self.novas_tentativas
+        return {
+            "url_base": self.url_base, "disjuntor": self.disjuntor.para_dict(),
+            "novas_tentativas": repetidas, "erros": erros,
+            "latencia": {operacao: h.para_dict() for operacao, h in latencias.items()}
+        }
+
+cliente_graph = ClienteGraph(GRAPH_API_URL, max(DISPARO_WORKERS, 10))
+
+@metricas.coletor
+def coletar_metricas_graph():
+    with cliente_graph.trava:
+        latencias, erros, repetidas = dict(cliente_graph.latencias), dict(cliente_graph.erros), cliente_graph.novas_tentativas
+    return [
+        ("whatformula_graph_requisicao_segundos", "histogram", "Latência das chamadas à Graph API, por operação.",
+         {(("operacao", operacao),): h for operacao, h in latencias.items()}),
+        ("whatformula_graph_erros_total", "counter", "Falhas nas chamadas à Graph API, por tipo (e status HTTP).",
+         {(("tipo", tipo),): n for tipo, n in erros.items()}),
+        ("whatformula_graph_novas_tentativas_total", "counter", "Novas tentativas feitas pelo cliente da Graph API.",
+         {(): repetidas}),
+        ("whatformula_graph_disjuntor_aberto", "gauge", "1 enquanto o disjuntor da Graph API estiver aberto.",
+         {(): int(cliente_graph.disjuntor.aberto())}),
+    ]
 
 # --- Lógica Principal ---
 
+def agora_local():
+    """Horário de Brasília (UTC-3), o mesmo usado nas colunas de data dos modelos."""
+    return datetime.utcnow() - timedelta(hours=3)
+
+def consulta_participantes():
+    """Participantes com o nome mais recente do contato (cai para o nome do registro)."""
+    return (db.session.query(Participante.id, Participante.telefone,
+                             db.func.coalesce(Contato.ultimo_nome, Participante.nome))
+            .outerjoin(Contato, Contato.telefone == Participante.telefone))
+
+def reconciliar_cache_participantes():
+    """Relê o registro inteiro e acerta o cache no lugar. Chamada com a trava do cache."""
+    novo = {}
+    for id_participante, telefone, nome in consulta_participantes().order_by(Participante.id).yield_per(PARTICIPANTES_BLOCO):
+        novo[telefone] = {"id": id_participante, "nome": nome or f"Pessoa ({telefone[-4:]})", "telefone": telefone}
+    mudou = novo != db_participantes_sorteio
+    if mudou:
+        for telefone in db_participantes_sorteio.keys() - novo.keys():
+            db_participantes_sorteio.pop(telefone, None)
+        db_participantes_sorteio.update(novo)
+    cache_participantes["ultimo_id"] = max((p["id"] for p in novo.values()), default=0)
+    cache_participantes["marcas"].clear()
+    cache_participantes["reconciliado_em"] = time.time()
+    return mudou
+
+def atualizar_cache_participantes(forcar=False):
+    """
+    Traz para o cache os participantes registrados (por qualquer worker) desde a
+    última leitura e os nomes dos contatos que escreveram desde então.
+    """
+    if not forcar and time.time() - cache_participantes["atualizado_em"] < PARTICIPANTES_CACHE_TTL_S: return
+    with trava_cache_participantes:
+        if not forcar and time.time() - cache_participantes["atualizado_em"] < PARTICIPANTES_CACHE_TTL_S: return
+        with sessao_de_fundo():
+            # Sobreposição de alguns segundos para não perder upserts de relógios/transações vizinhos.
+            desde = cache_participantes.get("nomes_desde")
+            cache_participantes["nomes_desde"] = agora_local() - timedelta(seconds=5)
+            agora = time.time()
+            marcas = cache_participantes["marcas"]
+            versao_registro = versao_registro_participantes()
+            if not cache_participantes["reconciliado_em"] or versao_registro != cache_participantes["versao_registro"] or (
+                    PARTICIPANTES_RECONCILIAR_S and agora - cache_participantes["reconciliado_em"] >= PARTICIPANTES_RECONCILIAR_S):
+                mudou = reconciliar_cache_participantes()
+                cache_participantes["versao_registro"] = versao_registro
+            else:
+                # Piso = último id visto há PARTICIPANTES_RELEITURA_S; o que está acima é relido.
+                while len(marcas) > 1 and marcas[1][0] <= agora - PARTICIPANTES_RELEITURA_S:
+                    marcas.popleft()
+                piso = marcas[0][1] if marcas else cache_participantes["ultimo_id"]
+                consulta = (consulta_participantes()
+                            .filter(Participante.id > piso)
+                            .order_by(Participante.id)
+                            .yield_per(PARTICIPANTES_BLOCO))
+                mudou = False
+                for id_participante, telefone, nome in consulta:
+                    item = {"id": id_participante, "nome": nome or f"Pessoa ({telefone[-4:]})", "telefone": telefone}
+                    if db_participantes_sorteio.get(telefone) != item:
+                        db_participantes_sorteio[telefone] = item
+                        mudou = True
+                    cache_participantes["ultimo_id"] = max(cache_participantes["ultimo_id"], id_participante)
+            marcas.append((agora, cache_participantes["ultimo_id"]))
+            if desde is not None:
+                for telefone, nome in (db.session.query(Contato.telefone, Contato.ultimo_nome)
+                                       .filter(Contato.ultima_mensagem_em >= desde).yield_per(PARTICIPANTES_BLOCO)):
+                    if telefone in db_participantes_sorteio and nome and db_participantes_sorteio[telefone]["nome"] != nome:
+                        db_participantes_sorteio[telefone]["nome"] = nome
+                        mudou = True
+            if mudou:
+                cache_participantes["versao"] += 1
+        cache_participantes["atualizado_em"] = time.time()
+
+def versao_registro_participantes():
+    """Versão do registro compartilhada entre os workers (contador "participantes:versao")."""
+    return db.session.query(Contador.valor).filter(Contador.chave == VERSAO_PARTICIPANTES_CHAVE).scalar() or 0
+
+def sinalizar_mudanca_participantes():
+    """
+    Avisa todos os workers de que participantes existentes mudaram (não só entraram
+    novos): cada um relê o registro inteiro na próxima leitura do cache.
+    """
+    with sessao_de_fundo():
+        incrementar_contadores({VERSAO_PARTICIPANTES_CHAVE: 1})
+        db.session.commit()
+    invalidar_cache_participantes()
+
+def invalidar_cache_participantes():
+    """Faz a próxima leitura deste processo reler o registro inteiro (o cache atual segue servindo até lá)."""
+    with trava_cache_participantes:
+        cache_participantes.update({"atualizado_em": 0.0, "reconciliado_em": 0.0})
+
 def carregar_participantes_iniciais():
     """
-    CORREÇÃO DE PERSISTÊNCIA: Carrega todos os cadastros do DB para a lista de 
-    sorteio em memória ao iniciar, garantindo que a lista não se perca.
+    CORREÇÃO DE PERSISTÊNCIA: Carrega o registro de participantes do DB para a
+    lista de sorteio em memória ao iniciar, garantindo que a lista não se perca.
     """
-    with app.app_context():
-        print("Carregando participantes iniciais do banco de dados...")
-        cadastros = Cadastro.query.all()
-        for cadastro in cadastros:
-            if cadastro.telefone not in db_participantes_sorteio:
-                # Tenta encontrar o nome mais recente para este telefone
-                ultima_mensagem = Mensagem.query.filter_by(telefone=cadastro.telefone).order_by(Mensagem.data_recebimento.desc()).first()
-                nome = ultima_mensagem.nome if ultima_mensagem and ultima_mensagem.nome else f"Pessoa ({cadastro.telefone[-4:]})"
-                db_participantes_sorteio[cadastro.telefone] = {
-                    "nome": nome,
-                    "telefone": cadastro.telefone
-                }
-        print(f"✅ {len(db_participantes_sorteio)} participantes carregados.")
+    if participantes_prontos.is_set(): return
+    inicio = time.time()
+    logger.info("Carregando participantes iniciais do banco de dados...")
+    atualizar_cache_participantes(forcar=True)
+    participantes_prontos.set()
+    logger.info("%d participantes carregados em %.1fs.", len(db_participantes_sorteio), time.time() - inicio)
 
-def salvar_no_banco(telefone, nome, texto_mensagem, media_id, media_type):
-    with app.app_context():
+def tarefa_migracoes_iniciais():
+    """Aplica as migrações pendentes (se configurado) e marca `esquema_pronto` ao terminar."""
+    try:
+        if MIGRAR_AO_INICIAR:
+            tarefa_migracoes()
+    finally:
+        esquema_pronto.set()
+
+def tarefa_carga_participantes():
+    """
+    Carrega os participantes sem esperar as migrações, que podem levar minutos
+    (índices, backfills). Num banco novo, em que as tabelas ainda não existem, a
+    primeira tentativa falha; a carga então espera as migrações e tenta de novo.
+    """
+    try:
+        carregar_participantes_iniciais()
+        return
+    except Exception as e:
+        if esquema_pronto.is_set():
+            logger.exception("Erro ao carregar participantes: %s", e)
+            return
+        logger.info("Participantes ainda não carregados (%s); tentando de novo após as migrações.", getattr(e, "orig", e))
+    esquema_pronto.wait()
+    try:
+        carregar_participantes_iniciais()
+    except Exception as e:
+        logger.exception("Erro ao carregar participantes: %s", e)
+
+def insert_ignorando_conflitos(modelo, linhas, coluna):
+    """INSERT ... ON CONFLICT (coluna) DO NOTHING no dialeto do banco em uso."""
+    dialeto = postgresql if db.engine.dialect.name == 'postgresql' else sqlite
+    return dialeto.insert(modelo).values(linhas).on_conflict_do_nothing(index_elements=[coluna])
+
+def nomes_por_remetente(itens):
+    """Um nome por remetente do lote, preferindo um nome extraído ao nome genérico."""
+    remetentes = {}
+    for item in itens:
+        if item["telefone"] not in remetentes or not item["nome"].startswith("Pessoa ("):
+            remetentes[item["telefone"]] = item["nome"]
+    return remetentes
+
+JANELA_CONVERSA = timedelta(hours=24)
+
+def registrar_contatos(remetentes, quantidades, momento):
+    """
+    Upsert em `contatos` na transação corrente. Um nome genérico ("Pessoa (1234)")
+    não sobrescreve um nome já extraído de uma mensagem anterior.
+    """
+    dialeto = postgresql if db.engine.dialect.name == 'postgresql' else sqlite
+    stmt = dialeto.insert(Contato).values([{
+        "telefone": telefone, "ultimo_nome": remetentes[telefone], "ultima_mensagem_em": momento,
+        "total_mensagens": quantidades[telefone], "janela_expira_em": momento + JANELA_CONVERSA, "opt_in": True
+    } for telefone in sorted(remetentes)])
+    db.session.execute(stmt.on_conflict_do_update(index_elements=['telefone'], set_={
+        "ultimo_nome": db.case((stmt.excluded.ultimo_nome.like("Pessoa (%"), Contato.ultimo_nome), else_=stmt.excluded.ultimo_nome),
+        "ultima_mensagem_em": stmt.excluded.ultima_mensagem_em,
+        "total_mensagens": Contato.total_mensagens + stmt.excluded.total_mensagens,
+        "janela_expira_em": stmt.excluded.janela_expira_em,
+    }))
+
+def registrar_participantes(remetentes):
+    """
+    Registra os remetentes em `participantes` dentro da transação corrente e devolve
+    os telefones que devem receber as boas-vindas. O INSERT ignora quem já existe e o
+    UPDATE condicional do flag só vira cada linha uma vez, então, mesmo com vários
+    workers, apenas um deles envia a mensagem. O cache só poupa as consultas de quem
+    já está registrado; enquanto a carga inicial não termina, todos passam pelo banco.
+    """
+    novos = {telefone: nome for telefone, nome in remetentes.items() if telefone not in db_participantes_sorteio}
+    if not novos: return []
+    db.session.execute(insert_ignorando_conflitos(Participante, [{"telefone": t, "nome": n} for t, n in novos.items()], 'telefone'))
+    return db.session.execute(
+        update(Participante)
+        .where(Participante.telefone.in_(novos), Participante.boas_vindas_enviada.is_(False))
+        .values(boas_vindas_enviada=True)
+        .returning(Participante.telefone)
+    ).scalars().all()
+
+def salvar_lote_no_banco(itens):
+    """
+    Grava todas as mensagens de uma notificação em uma única transação: um
+    INSERT em massa para `mensagens`, um upsert (ON CONFLICT DO NOTHING) para
+    os telefones novos em `cadastros` e o registro dos remetentes no sorteio.
+    Devolve os telefones que devem receber boas-vindas, ou None se falhar.
+    """
+    if not itens: return []
+    remetentes = nomes_por_remetente(itens)
+    with sessao_de_fundo():
         try:
-            if not Cadastro.query.filter_by(telefone=telefone).first():
-                db.session.add(Cadastro(telefone=telefone))
-            
-            nova_mensagem_db = Mensagem(
-                telefone=telefone, nome=nome, texto=texto_mensagem,
-                media_id=media_id, media_type=media_type
+            telefones = sorted(remetentes)
+            novos_cadastros = db.session.execute(
+                insert_ignorando_conflitos(Cadastro, [{"telefone": t} for t in telefones], 'telefone').returning(Cadastro.id)
+            ).scalars().all()
+            db.session.execute(insert(Mensagem), [{
+                "telefone": item["telefone"], "nome": item["nome"], "texto": item["texto"],
+                "media_id": item["media_id"], "media_type": item["media_type"]
+            } for item in itens])
+            boas_vindas = registrar_participantes(remetentes)
+            quantidades = {}
+            for item in itens:
+                quantidades[item["telefone"]] = quantidades.get(item["telefone"], 0) + 1
+            registrar_contatos(remetentes, quantidades, agora_local())
+            incrementar_contadores({
+                "cadastros": len(novos_cadastros), "mensagens": len(itens),
+                **chaves_periodo("mensagens", agora_local(), len(itens))
+            })
+            db.session.commit()
+            logger.debug("%d mensagem(ns) de %d contato(s) salvas no banco de dados.", len(itens), len(telefones),
+                         extra={"campos": {"mensagens": len(itens), "contatos": len(telefones)}})
+        except Exception as e:
+            logger.exception("Erro ao salvar no banco de dados: %s", e)
+            db.session.rollback()
+            return None
+    for telefone in boas_vindas:
+        db_participantes_sorteio.setdefault(telefone, {"nome": remetentes[telefone], "telefone": telefone})
+    publicar_evento("mensagem_nova", {"quantidade": len(itens)})
+    if boas_vindas:
+        publicar_evento("participante_novo", {"quantidade": len(boas_vindas)})
+    return boas_vindas
+
+def formatar_numero_br(numero):
+    """
+    Forma canônica do telefone (veja telefones.py). Corrige, por exemplo, celulares
+    do Brasil que vêm da API sem o nono dígito: 554498369564 -> 5544998369564.
+    """
+    if not isinstance(numero, str): return numero
+    return normalizar_telefone(numero)
+
+def enviar_resposta_whatsapp(destinatario, mensagem, log_campanha=False):
+    """
+    CORREÇÃO DE ENVIO: Atualizada a versão da API para v19.0, adicionado "type": "text" 
+    explícito e melhorado o log de erros para diagnóstico. Só os envios da campanha
+    (log_campanha=True) entram no log de auditoria dela.
+    """
+    registrar = registrar_log_disparo if log_campanha else (lambda *args: None)
+    if not all([META_ACCESS_TOKEN, META_PHONE_NUMBER_ID]):
+        logger.debug("Credenciais não configuradas. Simulando envio para %s.", mascarar_telefone(destinatario))
+        registrar("Credenciais não configuradas. Simulando envio.", "aviso", destinatario, "simulado")
+        return False
+    
+    try:
+        response = cliente_graph.enviar_mensagem(destinatario, mensagem)
+        logger.debug("Mensagem enviada para %s. Status: %s", destinatario, response.status_code,
+                     extra={"campos": {"destinatario": destinatario, "status": response.status_code}})
+        return True
+    except ErroGraph as e:
+        if e.tipo == "timeout":
+            logger.warning("Timeout ao enviar mensagem para %s", destinatario)
+            registrar(f"Timeout ({GRAPH_TIMEOUT_S:g}s) no envio.", "erro", destinatario, "timeout")
+        else:
+            logger.error("Erro ao enviar para %s: %s. Resposta da API: %s", destinatario, e, e.detalhe or "(sem resposta)",
+                         extra={"campos": {"destinatario": destinatario, "tipo": e.tipo, "status": e.status, "codigo": e.codigo}})
+            registrar(f"Erro da API ao enviar ({e.tipo}): checar os logs para detalhes.", "erro", destinatario, "erro_api")
+        return False
+
+def mascarar_telefone(telefone):
+    return f"...{telefone[-4:]}" if telefone else None
+
+def registrar_log_disparo(mensagem, nivel="info", telefone=None, resultado=None):
+    """Acrescenta uma entrada estruturada ao log da campanha (telefone sempre mascarado)."""
+    with trava_log:
+        disparo_status["ultimo_seq"] += 1
+        entrada = {
+            "seq": disparo_status["ultimo_seq"], "momento": agora_local().isoformat(timespec='seconds'),
+            "nivel": nivel, "telefone": mascarar_telefone(telefone), "resultado": resultado, "mensagem": mensagem
+        }
+        disparo_log.append(entrada)
+        if disparo_status["campanha_id"] is None: return
+        disparo_log_pendentes.append(entrada)
+        gravar = (len(disparo_log_pendentes) >= DISPARO_LOG_LOTE
+                  or time.time() - disparo_log_gravado_em >= DISPARO_LOG_INTERVALO_S)
+    if gravar:
+        gravar_log_campanha()
+
+def gravar_log_campanha():
+    """Grava em lote as entradas pendentes do log na tabela `campanha_logs`."""
+    global disparo_log_pendentes, disparo_log_gravado_em
+    with trava_log:
+        pendentes, disparo_log_pendentes = disparo_log_pendentes, []
+        disparo_log_gravado_em = time.time()
+        campanha_id = disparo_status["campanha_id"]
+    if not pendentes or campanha_id is None: return
+    with sessao_de_fundo():
+        try:
+            db.session.execute(insert(CampanhaLog), [{
+                "campanha_id": campanha_id, "seq": e["seq"], "momento": datetime.fromisoformat(e["momento"]),
+                "nivel": e["nivel"], "telefone": e["telefone"], "resultado": e["resultado"], "mensagem": e["mensagem"]
+            } for e in pendentes])
+            db.session.commit()
+        except Exception as e:
+            logger.exception("Erro ao gravar o log da campanha: %s", e)
+            db.session.rollback()
+
+def id_processo():
+    return f"{socket.gethostname()}:{os.getpid()}:{_SUFIXO_PROCESSO}"
+
+def criar_campanha(mensagens, perfil):
+    """Grava a campanha como pendente; um dos workers a assume pelo agendador."""
+    campanha = Campanha(perfil=perfil, status="pendente", mensagens=json.dumps(mensagens))
+    db.session.add(campanha)
+    db.session.commit()
+    acordar_agendador_campanhas.set()
+    return campanha.id
+
+def assumir_campanha(campanha_id=None):
+    """
+    Tenta pegar o lease de uma campanha pendente ou em execução cujo lease esteja
+    livre ou vencido. O UPDATE condicional garante que, entre vários workers, só um consiga.
+    """
+    agora = agora_local()
+    livre = db.or_(Campanha.lease_expira.is_(None), Campanha.lease_expira < agora)
+    if campanha_id is None:
+        campanha_id = (db.session.query(Campanha.id)
+                       .filter(Campanha.status.in_(ESTADOS_CAMPANHA_ASSUMIVEL), livre)
+                       .order_by(Campanha.id).limit(1).scalar())
+        if campanha_id is None:
+            db.session.rollback()
+            return None
+    assumida = db.session.execute(
+        update(Campanha)
+        .where(Campanha.id == campanha_id, Campanha.status.in_(ESTADOS_CAMPANHA_ASSUMIVEL), livre)
+        .values(lease_dono=id_processo(), lease_expira=agora + timedelta(seconds=CAMPANHA_LEASE_S))
+        .returning(Campanha.id)
+        .execution_options(synchronize_session=False)
+    ).scalar()
+    db.session.commit()
+    return assumida
+
+def encerrar_campanhas_paradas():
+    """Fecha as campanhas "parando" sem dono vivo (paradas antes de começar ou cujo worker caiu)."""
+    agora = agora_local()
+    fechadas = db.session.execute(
+        update(Campanha)
+        .where(Campanha.status == "parando", db.or_(Campanha.lease_expira.is_(None), Campanha.lease_expira < agora))
+        .values(status="interrompida", finalizada_em=agora, lease_dono=None, lease_expira=None)
+        .returning(Campanha.id)
+        .execution_options(synchronize_session=False)
+    ).scalars().all()
+    db.session.commit()
+    for campanha_id in fechadas:
+        logger.info("Campanha %s parada sem dono ativo foi encerrada.", campanha_id)
+    return fechadas
+
+def renovar_lease(campanha_id):
+    """Renova o lease e devolve o status da campanha, ou None se ela mudou de dono."""
+    status = db.session.execute(
+        update(Campanha)
+        .where(Campanha.id == campanha_id, Campanha.lease_dono == id_processo())
+        .values(lease_expira=agora_local() + timedelta(seconds=CAMPANHA_LEASE_S))
+        .returning(Campanha.status)
+        .execution_options(synchronize_session=False)
+    ).scalar()
+    db.session.commit()
+    return status
+
+def manter_lease(campanha_id, encerrar, lease_perdido):
+    """Renova o lease a cada terço do prazo e traduz um pedido de parada no flag local."""
+    while not encerrar.wait(CAMPANHA_LEASE_S / 3):
+        try:
+            with sessao_de_fundo():
+                status = renovar_lease(campanha_id)
+        except Exception as e:
+            logger.exception("Erro ao renovar o lease da campanha %s: %s", campanha_id, e)
+            continue
+        if status is None:
+            lease_perdido.set()
+        if status != "executando":
+            disparo_status["ativo"] = False
+
+def preparar_destinatarios(campanha):
+    """Grava a lista embaralhada de destinatários elegíveis; roda uma vez por campanha."""
+    total_cadastros = db.session.query(db.func.count(Cadastro.id)).scalar() or 0
+    numeros = list(carregar_elegiveis_24h(agora_local() - timedelta(hours=24)))
+    random.shuffle(numeros)
+    for i in range(0, len(numeros), 5000):
+        db.session.execute(insert(CampanhaDestinatario), [
+            {"campanha_id": campanha.id, "telefone": numero, "ordem": i + j}
+            for j, numero in enumerate(numeros[i:i + 5000])
+        ])
+    campanha.total = len(numeros)
+    campanha.ignorados = total_cadastros - len(numeros)
+    campanha.preparada = True
+    return total_cadastros
+
+def reservar_bloco(campanha_id, tamanho):
+    """
+    Marca os próximos destinatários pendentes como "enviando" antes do envio. Se o
+    processo morrer no meio do bloco, eles não são reenviados na retomada. O status
+    da campanha é conferido a cada bloco: um /parar_disparo atendido por outro
+    worker interrompe o envio aqui, sem esperar a renovação do lease.
+    """
+    with sessao_de_fundo():
+        status = db.session.query(Campanha.status).filter(Campanha.id == campanha_id).scalar()
+        if status != "executando":
+            db.session.rollback()
+            disparo_status["ativo"] = False
+            return []
+        bloco = (db.session.query(CampanhaDestinatario.id, CampanhaDestinatario.telefone)
+                 .filter(CampanhaDestinatario.campanha_id == campanha_id, CampanhaDestinatario.estado == "pendente")
+                 .order_by(CampanhaDestinatario.ordem).limit(tamanho).all())
+        if bloco:
+            db.session.execute(
+                update(CampanhaDestinatario)
+                .where(CampanhaDestinatario.id.in_([d.id for d in bloco]))
+                .values(estado="enviando")
+                .execution_options(synchronize_session=False)
             )
-            db.session.add(nova_mensagem_db)
             db.session.commit()
-            print(f"✅ Dados de '{telefone}' salvos no banco de dados.")
+        return [(d.id, d.telefone) for d in bloco]
+
+def registrar_resultados(campanha_id, resultados):
+    """Grava o estado final de cada destinatário do bloco e o progresso da campanha."""
+    por_estado = {}
+    for destinatario_id, estado in resultados:
+        por_estado.setdefault(estado, []).append(destinatario_id)
+    concluidos = sum(len(ids) for estado, ids in por_estado.items() if estado != "pendente")
+    enviados = len(por_estado.get("enviado", []))
+    for estado, ids in por_estado.items():
+        if estado != "pendente":
+            metricas.contar("whatformula_envios_total", len(ids), estado=estado)
+    with sessao_de_fundo():
+        for estado, ids in por_estado.items():
+            db.session.execute(
+                update(CampanhaDestinatario).where(CampanhaDestinatario.id.in_(ids)).values(estado=estado)
+                .execution_options(synchronize_session=False)
+            )
+        db.session.execute(
+            update(Campanha).where(Campanha.id == campanha_id).values(
+                progresso=Campanha.progresso + concluidos,
+                ignorados=Campanha.ignorados + len(por_estado.get("ignorado", []))
+            ).execution_options(synchronize_session=False)
+        )
+        incrementar_contadores({"envios": enviados, **chaves_periodo("envios", agora_local(), enviados, dia=False)})
+        db.session.commit()
+
+def assumir_log_campanha(campanha_id, ultimo_seq):
+    """Aponta o log em memória para a campanha assumida, continuando a numeração gravada."""
+    with trava_log:
+        disparo_log.clear()
+        disparo_log_pendentes.clear()
+        disparo_status["ultimo_seq"] = ultimo_seq
+        disparo_status["campanha_id"] = campanha_id
+
+def fechar_campanha(campanha_id, status):
+    gravar_log_campanha()
+    with sessao_de_fundo():
+        db.session.execute(
+            update(Campanha).where(Campanha.id == campanha_id, Campanha.lease_dono == id_processo()).values(
+                status=status, finalizada_em=agora_local(), lease_dono=None, lease_expira=None
+            ).execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+
+class LimitadorTaxa:
+    """Token bucket thread-safe: até `taxa` envios por segundo, com rajadas de até `capacidade`."""
+
+    def __init__(self, taxa, capacidade=None):
+        self.taxa = float(taxa)
+        self.capacidade = float(capacidade or max(1.0, self.taxa))
+        self.tokens = self.capacidade
+        self.ultimo = time.monotonic()
+        self.trava = threading.Lock()
+
+    def aguardar(self, continuar=lambda: True):
+        """Bloqueia até haver um token. Retorna False se `continuar()` ficar falso antes disso."""
+        while continuar():
+            with self.trava:
+                agora = time.monotonic()
+                self.tokens = min(self.capacidade, self.tokens + (agora - self.ultimo) * self.taxa)
+                self.ultimo = agora
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                espera = (1 - self.tokens) / self.taxa
+            time.sleep(min(espera, 0.5))
+        return False
+
+def _avancar_progresso():
+    with trava_disparo:
+        disparo_status["progresso"] += 1
+    publicar_progresso_campanha()
+
+def carregar_elegiveis_24h(limite_24h):
+    """
+    Calcula de uma vez o público elegível da campanha: telefone -> última interação,
+    para os contatos com opt-in que escreveram depois de `limite_24h`. Lê uma linha
+    por contato de `contatos` (índice na expiração da janela), em blocos por cursor.
+    """
+    consulta = (db.session.query(Contato.telefone, Contato.ultima_mensagem_em)
+                .filter(Contato.janela_expira_em > limite_24h + JANELA_CONVERSA, Contato.opt_in.is_(True))
+                .yield_per(1000))
+    return {telefone: ultima_interacao for telefone, ultima_interacao in consulta}
+
+def contar_elegiveis_24h(limite_24h):
+    """Mesmo filtro de `carregar_elegiveis_24h`, só a contagem (prévia antes de iniciar)."""
+    return (db.session.query(db.func.count(Contato.telefone))
+            .filter(Contato.janela_expira_em > limite_24h + JANELA_CONVERSA, Contato.opt_in.is_(True))
+            .scalar() or 0)
+
+def carregar_janelas_bloco(telefones):
+    """
+    Relê `contatos.janela_expira_em` dos telefones de um bloco reservado. Quem voltou
+    a escrever durante a campanha teve a janela renovada e continua elegível; quem
+    perdeu o opt-in sai do mapa e é ignorado.
+    """
+    if not telefones:
+        return {}
+    with sessao_de_fundo():
+        linhas = (db.session.query(Contato.telefone, Contato.janela_expira_em)
+                  .filter(Contato.telefone.in_(telefones), Contato.opt_in.is_(True)).all())
+    return dict(linhas)
+
+def janela_24h_aberta(janela_expira_em):
+    return janela_expira_em is not None and janela_expira_em > agora_local()
+
+def processar_contato_disparo(numero, mensagens, janelas, limitador=None):
+    """
+    Envia a mensagem da campanha para um contato. A janela de 24h é conferida de
+    novo com o valor relido no início do bloco, porque ela pode expirar (ou ser
+    renovada) durante campanhas longas e entre uma queda e a retomada. Devolve o
+    novo estado do destinatário; "pendente" quando a campanha parou antes do envio.
+    """
+    if not disparo_status["ativo"]: return "pendente"
+    if not janela_24h_aberta(janelas.get(numero)):
+        registrar_log_disparo("Ignorado (janela de 24h expirou).", telefone=numero, resultado="ignorado")
+        with trava_disparo:
+            disparo_status["ignorados"] += 1
+        _avancar_progresso()
+        return "ignorado"
+
+    if limitador and not limitador.aguardar(lambda: disparo_status["ativo"]):
+        return "pendente"
+    # Com o disjuntor aberto a campanha espera a Graph API se recuperar em vez de queimar contatos.
+    if not cliente_graph.disjuntor.aguardar(lambda: disparo_status["ativo"]):
+        return "pendente"
+
+    mensagem_aleatoria = random.choice(mensagens)
+    if enviar_resposta_whatsapp(numero, mensagem_aleatoria, log_campanha=True):
+        registrar_log_disparo("Enviado.", telefone=numero, resultado="enviado")
+        estado = "enviado"
+    else:
+        registrar_log_disparo("Falha no envio.", "erro", numero, "falha")
+        estado = "falhou"
+    
+    _avancar_progresso()
+    return estado
+
+def disparar_conservador(campanha_id, mensagens, pendentes):
+    """Ritmo original: lotes de 5 contatos, 2-5s entre envios e 3-10 min entre lotes."""
+    total_lotes = (pendentes + 4) // 5
+    num_lote = 0
+    while disparo_status["ativo"]:
+        lote_atual = reservar_bloco(campanha_id, 5)
+        if not lote_atual: break
+        num_lote += 1
+        registrar_log_disparo(f"Processando lote {num_lote}/{total_lotes} ({len(lote_atual)} contatos).")
+        janelas = carregar_janelas_bloco([numero for _, numero in lote_atual])
+
+        resultados = []
+        for destinatario_id, numero in lote_atual:
+            estado = processar_contato_disparo(numero, mensagens, janelas)
+            resultados.append((destinatario_id, estado))
+            if estado in ("enviado", "falhou"):
+                time.sleep(random.randint(2, 5))
+        registrar_resultados(campanha_id, resultados)
+        
+        if num_lote < total_lotes and disparo_status["ativo"]:
+            intervalo = random.randint(180, 600)
+            registrar_log_disparo(f"Pausa de {intervalo//60} min e {intervalo%60}s antes do próximo lote.")
+            
+            for _ in range(intervalo):
+                if not disparo_status["ativo"]:
+                    registrar_log_disparo("Pausa interrompida.", "aviso")
+                    break
+                time.sleep(1)
+
+def disparar_rapido(campanha_id, mensagens):
+    """Pool de DISPARO_WORKERS threads compartilhando um token bucket de DISPARO_MSGS_POR_SEGUNDO."""
+    limitador = LimitadorTaxa(DISPARO_MSGS_POR_SEGUNDO)
+    registrar_log_disparo(f"Modo rápido: {DISPARO_WORKERS} workers, até {DISPARO_MSGS_POR_SEGUNDO:g} msgs/s.")
+
+    def processar(item, janelas):
+        numero = item[1]
+        try:
+            return processar_contato_disparo(numero, mensagens, janelas, limitador)
         except Exception as e:
-            print(f"❌ ERRO ao salvar no banco de dados: {e}")
+            logger.error("Erro ao processar ...%s no disparo: %s", numero[-4:], e)
+            _avancar_progresso()
+            return "falhou"
+
+    with ThreadPoolExecutor(max_workers=max(1, DISPARO_WORKERS)) as executor:
+        while disparo_status["ativo"]:
+            bloco = reservar_bloco(campanha_id, max(1, DISPARO_WORKERS) * 4)
+            if not bloco: break
+            janelas = carregar_janelas_bloco([numero for _, numero in bloco])
+            estados = list(executor.map(lambda item: processar(item, janelas), bloco))
+            registrar_resultados(campanha_id, [(destinatario_id, estado) for (destinatario_id, _), estado in zip(bloco, estados)])
+
+def executar_campanha(campanha_id):
+    """Executa (ou retoma) uma campanha cujo lease este processo acabou de assumir."""
+    global disparo_status
+    with sessao_de_fundo():
+        campanha = db.session.get(Campanha, campanha_id)
+        retomada = campanha.preparada
+        # Envios que estavam em andamento quando o dono anterior caiu podem ter saído;
+        # na dúvida, contam como falha e não são repetidos.
+        incertos = db.session.execute(
+            update(CampanhaDestinatario)
+            .where(CampanhaDestinatario.campanha_id == campanha_id, CampanhaDestinatario.estado == "enviando")
+            .values(estado="falhou").execution_options(synchronize_session=False)
+        ).rowcount
+        if incertos:
+            campanha.progresso += incertos
+        total_cadastros = None if retomada else preparar_destinatarios(campanha)
+        if campanha.status == "pendente":
+            campanha.status = "executando"
+        db.session.commit()
+
+        mensagens, perfil = json.loads(campanha.mensagens or "[]"), campanha.perfil
+        pendentes = (db.session.query(db.func.count(CampanhaDestinatario.id))
+                     .filter(CampanhaDestinatario.campanha_id == campanha_id, CampanhaDestinatario.estado == "pendente")
+                     .scalar())
+        ultimo_seq = (db.session.query(db.func.max(CampanhaLog.seq))
+                      .filter(CampanhaLog.campanha_id == campanha_id).scalar() or 0)
+        disparo_status.update({
+            "ativo": campanha.status == "executando", "total": campanha.total, "elegiveis": campanha.total,
+            "progresso": campanha.progresso, "ignorados": campanha.ignorados
+        })
+
+    assumir_log_campanha(campanha_id, ultimo_seq)
+    if retomada:
+        registrar_log_disparo(f"Retomando campanha {campanha_id} (perfil {perfil}): {pendentes} destinatários pendentes.", "aviso")
+        if incertos:
+            registrar_log_disparo(f"{incertos} envio(s) interrompido(s) marcados como falha para não repetir.", "aviso")
+    else:
+        registrar_log_disparo(
+            f"Iniciando disparos (perfil {perfil}): {total_cadastros} contatos, "
+            f"{disparo_status['total']} elegíveis e {disparo_status['ignorados']} ignorados (sem interação em 24h)."
+        )
+    publicar_progresso_campanha(forcar=True)
+
+    encerrar, lease_perdido = threading.Event(), threading.Event()
+    threading.Thread(target=manter_lease, args=(campanha_id, encerrar, lease_perdido), daemon=True).start()
+    try:
+        if not pendentes:
+            registrar_log_disparo("Nenhum contato elegível para enviar.", "aviso")
+        elif perfil == "rapido":
+            disparar_rapido(campanha_id, mensagens)
+        else:
+            disparar_conservador(campanha_id, mensagens, pendentes)
+    finally:
+        encerrar.set()
+        disparo_status["ativo"] = False
+
+    if lease_perdido.is_set():
+        registrar_log_disparo("Lease perdido: outro worker assumiu a campanha.", "erro")
+        gravar_log_campanha()
+        return
+    with sessao_de_fundo():
+        restantes = (db.session.query(db.func.count(CampanhaDestinatario.id))
+                     .filter(CampanhaDestinatario.campanha_id == campanha_id, CampanhaDestinatario.estado == "pendente")
+                     .scalar())
+    if restantes:
+        registrar_log_disparo("Campanha interrompida pelo usuário.", "aviso", resultado="interrompida")
+    registrar_log_disparo("Campanha finalizada.", resultado="interrompida" if restantes else "finalizada")
+    fechar_campanha(campanha_id, "interrompida" if restantes else "finalizada")
+    publicar_progresso_campanha(forcar=True)
+
+def agendador_campanhas():
+    """Procura campanhas sem dono (novas ou abandonadas por um worker que caiu) e as executa."""
+    while True:
+        acordar_agendador_campanhas.wait(timeout=CAMPANHA_POLL_S + random.uniform(0, 1))
+        acordar_agendador_campanhas.clear()
+        if disparo_status["ativo"]: continue
+        try:
+            with sessao_de_fundo():
+                encerrar_campanhas_paradas()
+                campanha_id = assumir_campanha()
+            if campanha_id:
+                executar_campanha(campanha_id)
+        except Exception as e:
+            logger.exception("Erro no agendador de campanhas: %s", e)
+            disparo_status["ativo"] = False
+
+def tarefa_disparo_massa(mensagens, perfil="conservador"):
+    """Cria uma campanha e a executa na thread atual."""
+    with sessao_de_fundo():
+        campanha_id = criar_campanha(mensagens, perfil)
+        assumida = assumir_campanha(campanha_id)
+    if assumida:
+        executar_campanha(campanha_id)
+
+
+# --- Retenção de Dados ---
+# Um único agendador por processo executa as políticas abaixo. Valores 0 desativam
+# a regra correspondente. O limite_mb vale para a própria tabela (com índices e
+# TOAST, via pg_total_relation_size); fora do Postgres compara o banco inteiro.
+# Entre workers do gunicorn, um advisory lock do Postgres garante que só uma
+# limpeza rode por vez.
+RETENCAO_INTERVALO_S = int(os.getenv("RETENCAO_INTERVALO_S", "600"))
+RETENCAO_LOTE = int(os.getenv("RETENCAO_LOTE", "500"))
+RETENCAO_MAX_LOTES = int(os.getenv("RETENCAO_MAX_LOTES", "20"))
+RETENCAO_TRAVA_PG = 7340031
+
+POLITICAS_RETENCAO = {
+    "mensagens": {
+        "coluna": "data_recebimento",
+        "max_dias": int(os.getenv("RETENCAO_MENSAGENS_DIAS", "0")),
+        "limite_mb": float(os.getenv("RETENCAO_MENSAGENS_LIMITE_MB", "500")),
+    },
+    "reclamacoes": {
+        "coluna": "timestamp",
+        "max_dias": int(os.getenv("RETENCAO_RECLAMACOES_DIAS", "0")),
+        "limite_mb": float(os.getenv("RETENCAO_RECLAMACOES_LIMITE_MB", "0")),
+    },
+}
+
+trava_retencao = threading.Lock()
+retencao_status = {"execucoes": 0, "ultima_execucao": None, "ultimo_relatorio": None}
+
+def tamanho_banco_bytes(conexao=None):
+    executar = (conexao or db.session).execute
+    dialeto = db.engine.dialect.name
+    if dialeto == 'postgresql':
+        return executar(text("SELECT pg_database_size(current_database())")).scalar() or 0
+    if dialeto == 'sqlite':
+        return (executar(text("PRAGMA page_count")).scalar() or 0) * (executar(text("PRAGMA page_size")).scalar() or 0)
+    return 0
+
+def tamanho_tabela_bytes(tabela, conexao=None):
+    """Tamanho da tabela com índices e TOAST; fora do Postgres, o do banco inteiro."""
+    if db.engine.dialect.name != 'postgresql':
+        return tamanho_banco_bytes(conexao)
+    executar = (conexao or db.session).execute
+    return executar(text("SELECT pg_total_relation_size(CAST(:t AS regclass))"), {"t": tabela}).scalar() or 0
+
+def apagar_lote_antigo(conexao, tabela, coluna, limite_data=None):
+    """
+    Apaga até RETENCAO_LOTE linhas mais antigas com um único DELETE baseado em
+    conjunto. Devolve (linhas, bytes); os bytes somam pg_column_size das linhas
+    removidas e só são medidos no Postgres.
+    """
+    filtro = f"WHERE {coluna} < :limite_data" if limite_data else ""
+    postgres = db.engine.dialect.name == 'postgresql'
+    retorno = f"pg_column_size({tabela}.*)" if postgres else "0"
+    # As reclamações devolvem também o status, para descontar o contador certo.
+    retorno_status = ", status" if tabela == "reclamacoes" else ", NULL"
+    sql = text(
+        f"DELETE FROM {tabela} WHERE id IN ("
+        f"SELECT id FROM {tabela} {filtro} ORDER BY {coluna} ASC LIMIT :n"
+        f") RETURNING {retorno}{retorno_status}"
+    )
+    parametros = {"n": RETENCAO_LOTE}
+    if limite_data: parametros["limite_data"] = limite_data
+    linhas = conexao.execute(sql, parametros).all()
+    decrementos = {}
+    for _, status in linhas:
+        chave = f"reclamacoes:status:{status or 'Registrada'}" if tabela == "reclamacoes" else "mensagens"
+        decrementos[chave] = decrementos.get(chave, 0) - 1
+    incrementar_contadores(decrementos, conexao)
+    conexao.commit()
+    return len(linhas), sum(bytes_ for bytes_, _ in linhas)
+
+def aplicar_politica_retencao(conexao, tabela, politica):
+    relatorio = {"linhas": 0, "bytes": 0, "regras": []}
+    lotes = 0
+
+    def apagar_em_lotes(limite_data):
+        nonlocal lotes
+        while lotes < RETENCAO_MAX_LOTES:
+            linhas, bytes_ = apagar_lote_antigo(conexao, tabela, politica["coluna"], limite_data)
+            lotes += 1
+            relatorio["linhas"] += linhas
+            relatorio["bytes"] += bytes_
+            if linhas < RETENCAO_LOTE or limite_data is None: break
+            time.sleep(0.05)  # Libera o banco entre lotes para não segurar locks por muito tempo.
+
+    if politica["max_dias"]:
+        relatorio["regras"].append("idade")
+        apagar_em_lotes(agora_local() - timedelta(days=politica["max_dias"]))
+
+    # O espaço só volta para o sistema após o VACUUM, então a regra por tamanho
+    # apaga no máximo um lote por execução em vez de insistir até o banco encolher.
+    if politica["limite_mb"]:
+        tamanho_mb = tamanho_tabela_bytes(tabela, conexao) / (1024 * 1024)
+        conexao.commit()
+        relatorio["tamanho_mb"] = round(tamanho_mb, 2)
+        if tamanho_mb > politica["limite_mb"]:
+            relatorio["regras"].append("tamanho")
+            apagar_em_lotes(None)
+
+    return relatorio
+
+def tarefa_limpeza_banco():
+    """
+    Executa uma rodada das políticas de retenção. Se outra rodada já estiver em
+    andamento (neste ou em outro worker), retorna None sem fazer nada.
+    """
+    if not trava_retencao.acquire(blocking=False): return None
+    try:
+        with sessao_de_fundo(), motor_sessao().connect() as conexao:
+            postgres = sessao_postgres_dedicada()
+            if postgres and not conexao.execute(text("SELECT pg_try_advisory_lock(:k)"), {"k": RETENCAO_TRAVA_PG}).scalar():
+                conexao.rollback()
+                return None
+            try:
+                inicio = time.time()
+                tamanho_antes = tamanho_banco_bytes(conexao)
+                conexao.commit()
+                tamanho_mb = tamanho_antes / (1024 * 1024)
+                logger.info("Tamanho atual do banco de dados: %.2f MB", tamanho_mb)
+
+                relatorio = {"tabelas": {}, "linhas": 0, "bytes": 0}
+                for tabela, politica in POLITICAS_RETENCAO.items():
+                    resultado = aplicar_politica_retencao(conexao, tabela, politica)
+                    relatorio["tabelas"][tabela] = resultado
+                    relatorio["linhas"] += resultado["linhas"]
+                    relatorio["bytes"] += resultado["bytes"]
+
+                relatorio.update({
+                    "tamanho_antes_bytes": tamanho_antes,
+                    "tamanho_depois_bytes": tamanho_banco_bytes(conexao),
+                    "duracao_s": round(time.time() - inicio, 3),
+                })
+                registrar_tamanho_banco(relatorio["tamanho_depois_bytes"])
+                conexao.commit()
+                if relatorio["linhas"]:
+                    logger.info("Limpeza concluída: %d linhas e %.1f KB removidos.", relatorio['linhas'], relatorio['bytes'] / 1024)
+                retencao_status["execucoes"] += 1
+                retencao_status["ultima_execucao"] = agora_local().isoformat()
+                retencao_status["ultimo_relatorio"] = relatorio
+                return relatorio
+            finally:
+                # Um lote que falhou deixa a transação abortada; sem o rollback o
+                # unlock também falharia e a trava ficaria presa à conexão.
+                conexao.rollback()
+                if postgres:
+                    try:
+                        conexao.execute(text("SELECT pg_advisory_unlock(:k)"), {"k": RETENCAO_TRAVA_PG})
+                        conexao.commit()
+                    except Exception as e:
+                        logger.warning("Não foi possível liberar a trava da limpeza: %s", e)
+    except Exception as e:
+        logger.exception("Erro durante a rotina de limpeza: %s", e)
+        return None
+    finally:
+        trava_retencao.release()
+
+def agendador_retencao():
+    while True:
+        # O jitter evita que todos os workers acordem ao mesmo tempo.
+        time.sleep(RETENCAO_INTERVALO_S + random.uniform(0, RETENCAO_INTERVALO_S * 0.1))
+        tarefa_limpeza_banco()
+
+# --- Cache de Mídia ---
+# Mídias baixadas ficam em disco, endereçadas pelo sha256 do conteúdo
+# (objetos/ab/abcdef...), com um índice media_id -> objeto em ids/<media_id>.json.
+# O mtime do objeto é atualizado a cada acerto e a expulsão remove os menos usados
+# quando o total passa de MEDIA_CACHE_MAX_MB. A cada MEDIA_PODA_INTERVALO_S uma poda
+# apaga os índices e miniaturas de objetos expulsos e os temporários de downloads
+# abandonados (parados há mais que MEDIA_TMP_MAX_S).
+MEDIA_CACHE_DIR = os.getenv("MEDIA_CACHE_DIR", os.path.join(tempfile.gettempdir(), "whatformula_midia"))
+MEDIA_CACHE_MAX_MB = int(os.getenv("MEDIA_CACHE_MAX_MB", "1024"))
+MEDIA_CACHE_MAX_AGE_S = int(os.getenv("MEDIA_CACHE_MAX_AGE_S", "604800"))
+# As URLs de download da Meta expiram em ~5 minutos.
+MEDIA_URL_TTL_S = int(os.getenv("MEDIA_URL_TTL_S", "240"))
+MEDIA_PREFETCH = os.getenv("MEDIA_PREFETCH", "0") == "1"
+MEDIA_PREFETCH_WORKERS = int(os.getenv("MEDIA_PREFETCH_WORKERS", "2"))
+MEDIA_PREFETCH_FILA_MAX = int(os.getenv("MEDIA_PREFETCH_FILA_MAX", "100"))
+MEDIA_PODA_INTERVALO_S = int(os.getenv("MEDIA_PODA_INTERVALO_S", "600"))
+# Um download ativo grava a cada bloco; parado por mais que alguns timeouts de leitura, morreu.
+MEDIA_TMP_MAX_S = max(60.0, GRAPH_TIMEOUT_S * 4)
+MEDIA_BLOCO_BYTES = 64 * 1024
+MEDIA_ID_VALIDO = re.compile(r"^[A-Za-z0-9_.-]{1,255}$")
+SHA256_VALIDO = re.compile(r"^[0-9a-f]{64}$")
+
+urls_midia = {}
+trava_urls_midia = threading.Lock()
+cache_midia_status = {"bytes": None, "acertos": 0, "downloads": 0, "expulsos": 0, "podados": 0, "podado_em": 0.0}
+trava_cache_midia = threading.Lock()
+executor_prefetch_midia = ThreadPoolExecutor(max_workers=max(1, MEDIA_PREFETCH_WORKERS), thread_name_prefix="prefetch-midia")
+vagas_prefetch_midia = threading.BoundedSemaphore(max(1, MEDIA_PREFETCH_FILA_MAX))
+
+def caminho_objeto_midia(sha256):
+    return os.path.join(MEDIA_CACHE_DIR, "objetos", sha256[:2], sha256)
+
+def caminho_indice_midia(media_id):
+    return os.path.join(MEDIA_CACHE_DIR, "ids", f"{media_id}.json")
+
+def ler_indice_midia(media_id):
+    """
+    Devolve o índice da mídia em cache (sha256, content_type, tamanho) ou None. Um
+    arquivo truncado ou editado à mão que não tenha esse formato conta como ausente.
+    """
+    try:
+        with open(caminho_indice_midia(media_id)) as f:
+            indice = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if (not isinstance(indice, dict) or not isinstance(indice.get("sha256"), str)
+            or not SHA256_VALIDO.match(indice["sha256"]) or not isinstance(indice.get("content_type"), str)):
+        return None
+    caminho = caminho_objeto_midia(indice["sha256"])
+    try:
+        os.utime(caminho)
+    except OSError:
+        return None
+    indice["caminho"] = caminho
+    return indice
+
+def resolver_url_midia(media_id, forcar=False):
+    """Resolve media_id -> URL de download pela Graph API, guardando o resultado por MEDIA_URL_TTL_S."""
+    agora = time.time()
+    with trava_urls_midia:
+        em_cache = urls_midia.get(media_id)
+        if em_cache and not forcar and em_cache[0] > agora:
+            return em_cache[1]
+    info = cliente_graph.info_midia(media_id)
+    with trava_urls_midia:
+        for chave in [k for k, (expira, _) in urls_midia.items() if expira <= agora]:
+            del urls_midia[chave]
+        urls_midia[media_id] = (agora + MEDIA_URL_TTL_S, info)
+    return info
+
+def abrir_download_midia(media_id):
+    """Abre o download em streaming; se a URL guardada já expirou, resolve de novo uma vez."""
+    info = resolver_url_midia(media_id)
+    try:
+        return info, cliente_graph.baixar_midia(info["url"], stream=True)
+    except ErroGraph as e:
+        if e.status not in (401, 403, 404): raise
+    info = resolver_url_midia(media_id, forcar=True)
+    return info, cliente_graph.baixar_midia(info["url"], stream=True)
+
+def gravar_midia_em_cache(media_id, resposta, content_type):
+    """
+    Repassa o download em blocos enquanto grava uma cópia temporária; só o download
+    completo vira objeto do cache. Se o cliente desistir no meio, a cópia é descartada.
+    """
+    pasta_tmp = os.path.join(MEDIA_CACHE_DIR, "tmp")
+    os.makedirs(pasta_tmp, exist_ok=True)
+    descritor, caminho_tmp = tempfile.mkstemp(dir=pasta_tmp)
+    hash_conteudo, tamanho, completo = hashlib.sha256(), 0, False
+    try:
+        with os.fdopen(descritor, "wb") as arquivo:
+            for bloco in resposta.iter_content(MEDIA_BLOCO_BYTES):
+                arquivo.write(bloco)
+                hash_conteudo.update(bloco)
+                tamanho += len(bloco)
+                yield bloco
+        completo = True
+    finally:
+        resposta.close()
+        if completo:
+            registrar_objeto_midia(media_id, caminho_tmp, hash_conteudo.hexdigest(), content_type, tamanho)
+        else:
+            try:
+                os.remove(caminho_tmp)
+            except OSError:
+                pass
+
+def registrar_objeto_midia(media_id, caminho_tmp, sha256, content_type, tamanho):
+    destino = caminho_objeto_midia(sha256)
+    novo = not os.path.exists(destino)
+    os.makedirs(os.path.dirname(destino), exist_ok=True)
+    os.replace(caminho_tmp, destino)
+    os.makedirs(os.path.dirname(caminho_indice_midia(media_id)), exist_ok=True)
+    indice_tmp = f"{caminho_indice_midia(media_id)}.{os.getpid()}.tmp"
+    with open(indice_tmp, "w") as f:
+        json.dump({"sha256": sha256, "content_type": content_type, "tamanho": tamanho}, f)
+    os.replace(indice_tmp, caminho_indice_midia(media_id))
+    with trava_cache_midia:
+        cache_midia_status["downloads"] += 1
+        if cache_midia_status["bytes"] is not None and novo:
+            cache_midia_status["bytes"] += tamanho
+        excedeu = cache_midia_status["bytes"] is None or cache_midia_status["bytes"] > MEDIA_CACHE_MAX_MB * 1024 * 1024
+    if excedeu:
+        expulsar_excedente_cache_midia()
+    podar_cache_midia()
+
+def expulsar_excedente_cache_midia():
+    """Recalcula o tamanho do cache e remove os objetos de mtime mais antigo até caber no limite."""
+    objetos = []
+    for raiz, _, arquivos in os.walk(os.path.join(MEDIA_CACHE_DIR, "objetos")):
+        for nome in arquivos:
+            caminho = os.path.join(raiz, nome)
+            try:
+                estado = os.stat(caminho)
+            except OSError:
+                continue
+            objetos.append((estado.st_mtime, estado.st_size, caminho))
+    total, limite, expulsos = sum(o[1] for o in objetos), MEDIA_CACHE_MAX_MB * 1024 * 1024, 0
+    # Os índices que apontam para objetos removidos são ignorados por ler_indice_midia
+    # até a próxima poda, que os apaga.
+    for _, tamanho, caminho in sorted(objetos):
+        if total <= limite: break
+        try:
+            os.remove(caminho)
+        except OSError:
+            continue
+        remover_arquivo(caminho_miniatura(os.path.basename(caminho)))
+        total -= tamanho
+        expulsos += 1
+    with trava_cache_midia:
+        cache_midia_status["bytes"] = total
+        cache_midia_status["expulsos"] += expulsos
+
+def remover_arquivo(caminho):
+    try:
+        os.remove(caminho)
+        return True
+    except OSError:
+        return False
+
+def podar_cache_midia(forcar=False):
+    """
+    Apaga os índices ids/*.json cujo objeto sumiu, as miniaturas órfãs e os
+    temporários (tmp/ e ids/*.tmp) sem escrita há MEDIA_TMP_MAX_S. Roda no máximo
+    uma vez a cada MEDIA_PODA_INTERVALO_S por processo. Devolve os arquivos apagados.
+    """
+    with trava_cache_midia:
+        if not forcar and time.time() - cache_midia_status["podado_em"] < MEDIA_PODA_INTERVALO_S: return 0
+        cache_midia_status["podado_em"] = time.time()
+    limite_tmp, podados = time.time() - MEDIA_TMP_MAX_S, 0
+
+    def entradas(pasta):
+        try:
+            with os.scandir(os.path.join(MEDIA_CACHE_DIR, pasta)) as iterador:
+                return [e for e in iterador if e.is_file()]
+        except OSError:
+            return []
+
+    def antigo(entrada):
+        try:
+            return entrada.stat().st_mtime < limite_tmp
+        except OSError:
+            return False
+
+    for entrada in entradas("tmp"):
+        if antigo(entrada):
+            podados += remover_arquivo(entrada.path)
+    for entrada in entradas("ids"):
+        if entrada.name.endswith(".tmp"):
+            if antigo(entrada):
+                podados += remover_arquivo(entrada.path)
+            continue
+        try:
+            with open(entrada.path) as f:
+                sha256 = json.load(f)["sha256"]
+        except (OSError, ValueError, KeyError):
+            sha256 = None
+        if sha256 is None or not os.path.exists(caminho_objeto_midia(sha256)):
+            podados += remover_arquivo(entrada.path)
+    for entrada in entradas("miniaturas"):
+        sha256 = entrada.name.rsplit(".", 1)[0]
+        if not os.path.exists(caminho_objeto_midia(sha256)) and antigo(entrada):
+            podados += remover_arquivo(entrada.path)
+    with trava_cache_midia:
+        cache_midia_status["podados"] += podados
+    return podados
+
+def armazenar_midia(media_id):
+    """Baixa a mídia para o cache se ela ainda não estiver lá (usado pelo prefetch)."""
+    if ler_indice_midia(media_id): return
+    info, resposta = abrir_download_midia(media_id)
+    content_type = resposta.headers.get("Content-Type") or info.get("mime_type") or "application/octet-stream"
+    for _ in gravar_midia_em_cache(media_id, resposta, content_type):
+        pass
+
+def _prefetch_midia(media_id):
+    try:
+        armazenar_midia(media_id)
+    except Exception as e:
+        logger.error("Erro no prefetch da mídia %s: %s", media_id, e)
+    finally:
+        vagas_prefetch_midia.release()
+
+def agendar_prefetch_midia(media_id):
+    """Baixa a mídia em segundo plano antes que a URL da Meta expire; com a fila cheia, desiste."""
+    if not (MEDIA_PREFETCH and META_ACCESS_TOKEN and media_id and MEDIA_ID_VALIDO.match(media_id)): return
+    if not vagas_prefetch_midia.acquire(blocking=False): return
+    executor_prefetch_midia.submit(_prefetch_midia, media_id)
+
+# --- Miniaturas ---
+# Imagens (Pillow) e vídeos (quadro via ffmpeg, se instalado) recebidos ganham uma
+# miniatura JPEG em MEDIA_CACHE_DIR/miniaturas/<sha256>.jpg, gerada em segundo plano
+# por um pool limitado. O painel carrega a miniatura e só busca o original no clique.
+THUMB_LADO_PX = int(os.getenv("THUMB_LADO_PX", "320"))
+THUMB_QUALIDADE = int(os.getenv("THUMB_QUALIDADE", "70"))
+THUMB_WORKERS = int(os.getenv("THUMB_WORKERS", "2"))
+THUMB_FILA_MAX = int(os.getenv("THUMB_FILA_MAX", "200"))
+THUMB_AO_RECEBER = os.getenv("THUMB_AO_RECEBER", "1") == "1"
+FFMPEG = shutil.which(os.getenv("FFMPEG_BIN", "ffmpeg"))
+
+executor_miniaturas = ThreadPoolExecutor(max_workers=max(1, THUMB_WORKERS), thread_name_prefix="miniaturas")
+vagas_fila_miniaturas = threading.BoundedSemaphore(max(1, THUMB_FILA_MAX))
+# Limita a CPU gasta com miniaturas também quando elas são geradas sob demanda pelo endpoint.
+vagas_geracao_miniaturas = threading.BoundedSemaphore(max(1, THUMB_WORKERS))
+
+def caminho_miniatura(sha256):
+    return os.path.join(MEDIA_CACHE_DIR, "miniaturas", f"{sha256}.jpg")
+
+def miniatura_suportada(content_type):
+    return bool(content_type) and (
+        content_type.startswith("image/") and Image is not None
+        or content_type.startswith("video/") and FFMPEG is not None
+    )
+
+def _gerar_jpeg(origem, content_type, destino):
+    if content_type.startswith("video/"):
+        subprocess.run(
+            [FFMPEG, "-v", "error", "-y", "-i", origem, "-frames:v", "1",
+             "-vf", f"scale='min({THUMB_LADO_PX},iw)':-2", "-q:v", "5", "-f", "image2", destino],
+            check=True, timeout=30, stdin=subprocess.DEVNULL
+        )
+        return
+    with Image.open(origem) as imagem:
+        imagem = ImageOps.exif_transpose(imagem)
+        imagem.thumbnail((THUMB_LADO_PX, THUMB_LADO_PX))
+        imagem.convert("RGB").save(destino, "JPEG", quality=THUMB_QUALIDADE, optimize=True, progressive=True)
+
+def gerar_miniatura(media_id):
+    """Garante o original no cache e gera a miniatura dele. Devolve o caminho ou None se não suportado."""
+    indice = ler_indice_midia(media_id)
+    if indice is None:
+        armazenar_midia(media_id)
+        indice = ler_indice_midia(media_id)
+    if indice is None or not miniatura_suportada(indice["content_type"]): return None
+    destino = caminho_miniatura(indice["sha256"])
+    if os.path.exists(destino): return destino
+
+    os.makedirs(os.path.dirname(destino), exist_ok=True)
+    temporario = f"{destino}.{os.getpid()}.{threading.get_ident()}.tmp.jpg"
+    with vagas_geracao_miniaturas:
+        try:
+            _gerar_jpeg(indice["caminho"], indice["content_type"], temporario)
+            os.replace(temporario, destino)
+        finally:
+            if os.path.exists(temporario):
+                os.remove(temporario)
+    return destino
+
+def _tarefa_miniatura(media_id):
+    try:
+        gerar_miniatura(media_id)
+    except Exception as e:
+        logger.error("Erro ao gerar miniatura da mídia %s: %s", media_id, e)
+    finally:
+        vagas_fila_miniaturas.release()
+
+def agendar_miniatura(media_id, media_type):
+    """Enfileira a miniatura de uma imagem ou vídeo recebido; com a fila cheia, fica para o endpoint."""
+    if not (THUMB_AO_RECEBER and META_ACCESS_TOKEN and MEDIA_ID_VALIDO.match(media_id or "")): return False
+    if not (media_type == "image" and Image is not None or media_type == "video" and FFMPEG is not None): return False
+    if not vagas_fila_miniaturas.acquire(blocking=False): return False
+    executor_miniaturas.submit(_tarefa_miniatura, media_id)
+    return True
+
+# --- Manutenção de Dados ---
+# Jobs pontuais sobre o histórico, disparados por endpoint e executados em segundo
+# plano, em lotes por id para não segurar locks nem memória.
+MANUTENCAO_LOTE = int(os.getenv("MANUTENCAO_LOTE", "2000"))
+
+trava_backfill_nomes = threading.Lock()
+backfill_nomes_status = {"executando": False, "lidas": 0, "atualizadas": 0, "participantes": 0,
+                         "iniciado_em": None, "finalizado_em": None, "erro": None}
+
+def nome_padrao(telefone):
+    return f"Pessoa ({telefone[-4:]})"
+
+def nome_generico(nome):
+    """True para um nome ausente (NULL) ou genérico ("Pessoa (1234)")."""
+    return not nome or nome.startswith("Pessoa (")
+
+def tarefa_backfill_nomes():
+    """
+    Reaplica a extração de nomes em todas as mensagens gravadas e atualiza o nome dos
+    participantes com o nome extraído mais recente de cada telefone.
+    """
+    if not trava_backfill_nomes.acquire(blocking=False): return
+    backfill_nomes_status.update({"executando": True, "lidas": 0, "atualizadas": 0, "participantes": 0,
+                                  "iniciado_em": agora_local().isoformat(), "finalizado_em": None, "erro": None})
+    try:
+        with sessao_de_fundo():
+            nome_recente, ultimo_id = {}, 0
+            while True:
+                lote = (db.session.query(Mensagem.id, Mensagem.telefone, Mensagem.nome, Mensagem.texto)
+                        .filter(Mensagem.id > ultimo_id).order_by(Mensagem.id).limit(MANUTENCAO_LOTE).all())
+                if not lote: break
+                ultimo_id = lote[-1].id
+                # Mídias sem legenda ficam com o marcador "[IMAGE RECEBIDA]", que não tem nome.
+                nomes = extrair_nomes([None if m.texto.startswith("[") and m.texto.endswith("RECEBIDA]") else m.texto for m in lote])
+                alteracoes = []
+                for m, nome in zip(lote, nomes):
+                    if nome:
+                        nome_recente[m.telefone] = nome
+                    novo = nome or nome_padrao(m.telefone)
+                    if novo != m.nome:
+                        alteracoes.append({"id": m.id, "nome": novo})
+                if alteracoes:
+                    db.session.execute(update(Mensagem), alteracoes)
+                    incrementar_contadores({VERSAO_MENSAGENS_CHAVE: 1})
+                db.session.commit()
+                backfill_nomes_status["lidas"] += len(lote)
+                backfill_nomes_status["atualizadas"] += len(alteracoes)
+                time.sleep(0.05)
+
+            # IS DISTINCT FROM (e não !=) para também trocar nomes NULL; linhas cujo nome
+            # não muda não são reescritas.
+            participantes, contatos = Participante.__table__, Contato.__table__
+            atualizar_participantes = (update(participantes)
+                                       .where(participantes.c.telefone == bindparam("b_telefone"),
+                                              participantes.c.nome.is_distinct_from(bindparam("b_nome")))
+                                       .values(nome=bindparam("b_nome")))
+            atualizar_contatos = (update(contatos)
+                                  .where(contatos.c.telefone == bindparam("b_telefone"),
+                                         contatos.c.ultimo_nome.is_distinct_from(bindparam("b_nome")))
+                                  .values(ultimo_nome=bindparam("b_nome")))
+            itens, contatos_alterados = list(nome_recente.items()), 0
+            for i in range(0, len(itens), MANUTENCAO_LOTE):
+                parametros = [{"b_telefone": t, "b_nome": n} for t, n in itens[i:i + MANUTENCAO_LOTE]]
+                resultado = db.session.execute(atualizar_participantes, parametros)
+                contatos_alterados += max(db.session.execute(atualizar_contatos, parametros).rowcount, 0)
+                db.session.commit()
+                backfill_nomes_status["participantes"] += max(resultado.rowcount, 0)
+        if backfill_nomes_status["participantes"] or contatos_alterados:
+            sinalizar_mudanca_participantes()
+        logger.info("Backfill de nomes: %d mensagens e %d participantes atualizados.",
+                    backfill_nomes_status['atualizadas'], backfill_nomes_status['participantes'])
+    except Exception as e:
+        backfill_nomes_status["erro"] = str(e)
+        logger.exception("Erro no backfill de nomes: %s", e)
+    finally:
+        backfill_nomes_status.update({"executando": False, "finalizado_em": agora_local().isoformat()})
+        trava_backfill_nomes.release()
+
+def preencher_contatos(conexao):
+    """
+    Monta `contatos` a partir do histórico de mensagens (migração e correções manuais).
+    Deve rodar numa transação: no Postgres a tabela fica travada contra escrita até o
+    commit, então os upserts de registrar_contatos esperam e se somam ao resultado em
+    vez de se perder entre o DELETE e o INSERT; as leituras seguem vendo a versão anterior.
+    """
+    if db.engine.dialect.name == 'postgresql':
+        expira = "MAX(m.data_recebimento) + INTERVAL '24 hours'"
+        conexao.execute(text("LOCK TABLE contatos IN EXCLUSIVE MODE"))
+    else:
+        expira = "datetime(MAX(m.data_recebimento), '+24 hours')"
+    conexao.execute(text("DELETE FROM contatos"))
+    # O nome é o da mensagem mais recente que tinha um nome extraído (senão, a mais recente).
+    conexao.execute(text(f"""
+        INSERT INTO contatos (telefone, ultimo_nome, ultima_mensagem_em, total_mensagens, janela_expira_em, opt_in)
+        SELECT m.telefone, n.nome, MAX(m.data_recebimento), COUNT(*), {expira}, TRUE
+        FROM mensagens m
+        JOIN cadastros c ON c.telefone = m.telefone
+        LEFT JOIN (
+            SELECT telefone, nome,
+                   ROW_NUMBER() OVER (PARTITION BY telefone
+                                      ORDER BY CASE WHEN nome LIKE 'Pessoa (%' THEN 1 ELSE 0 END, data_recebimento DESC, id DESC) AS ordem
+            FROM mensagens
+        ) n ON n.telefone = m.telefone AND n.ordem = 1
+        WHERE m.data_recebimento IS NOT NULL
+        GROUP BY m.telefone, n.nome
+    """))
+
+def _mesclar_contatos(pares):
+    linhas = {c.id: c for c in Contato.query.filter(Contato.id.in_([i for par in pares for i in par])).all()}
+    for removido_id, mantido_id in pares:
+        removido, mantido = linhas[removido_id], linhas[mantido_id]
+        mantido.total_mensagens += removido.total_mensagens
+        mantido.opt_in = mantido.opt_in and removido.opt_in
+        if removido.ultima_mensagem_em > mantido.ultima_mensagem_em:
+            mantido.ultima_mensagem_em, mantido.janela_expira_em = removido.ultima_mensagem_em, removido.janela_expira_em
+            if not nome_generico(removido.ultimo_nome):
+                mantido.ultimo_nome = removido.ultimo_nome
+
+trava_normalizacao_telefones = threading.Lock()
+normalizacao_telefones_status = {"executando": False, "tabelas": {}, "iniciado_em": None, "finalizado_em": None, "erro": None}
+
+def _lote_por_id(modelo, ultimo_id):
+    return (db.session.query(modelo.id, modelo.telefone).filter(modelo.id > ultimo_id)
+            .order_by(modelo.id).limit(MANUTENCAO_LOTE).all())
+
+def _mesclar_participantes(pares):
+    """O participante que fica herda o flag de boas-vindas e um nome melhor que o genérico."""
+    linhas = {p.id: p for p in Participante.query.filter(Participante.id.in_([i for par in pares for i in par])).all()}
+    for removido_id, mantido_id in pares:
+        removido, mantido = linhas[removido_id], linhas[mantido_id]
+        mantido.boas_vindas_enviada = mantido.boas_vindas_enviada or removido.boas_vindas_enviada
+        if nome_generico(mantido.nome) and not nome_generico(removido.nome):
+            mantido.nome = removido.nome
+        if removido.data_criacao and (not mantido.data_criacao or removido.data_criacao < mantido.data_criacao):
+            mantido.data_criacao = removido.data_criacao
+
+def _mesclar_cadastros(pares):
+    linhas = {c.id: c for c in Cadastro.query.filter(Cadastro.id.in_([i for par in pares for i in par])).all()}
+    for removido_id, mantido_id in pares:
+        removido, mantido = linhas[removido_id], linhas[mantido_id]
+        if removido.data_criacao and (not mantido.data_criacao or removido.data_criacao < mantido.data_criacao):
+            mantido.data_criacao = removido.data_criacao
+
+def normalizar_tabela_unica(modelo, mesclar, contador=None):
+    """
+    Reescreve os telefones de uma tabela com telefone único. Quando a forma canônica
+    já existe, a linha antiga é mesclada na existente e apagada. Um lote por transação.
+    """
+    relatorio, ultimo_id = {"lidas": 0, "reescritas": 0, "mescladas": 0}, 0
+    while True:
+        lote = _lote_por_id(modelo, ultimo_id)
+        if not lote: break
+        ultimo_id = lote[-1].id
+        relatorio["lidas"] += len(lote)
+        mudancas = {linha.id: normalizar_telefone(linha.telefone) for linha in lote
+                    if normalizar_telefone(linha.telefone) != linha.telefone}
+        if not mudancas: continue
+        existentes = dict(db.session.query(modelo.telefone, modelo.id)
+                          .filter(modelo.telefone.in_(set(mudancas.values()))).all())
+        mesclar_pares, reescrever = [], []
+        for linha_id, canonico in mudancas.items():
+            if canonico in existentes:
+                mesclar_pares.append((linha_id, existentes[canonico]))
+            else:
+                reescrever.append({"id": linha_id, "telefone": canonico})
+                existentes[canonico] = linha_id
+        if mesclar_pares:
+            mesclar(mesclar_pares)
+            db.session.flush()
+            db.session.execute(modelo.__table__.delete().where(modelo.id.in_([r for r, _ in mesclar_pares])))
+            if contador:
+                incrementar_contadores({contador: -len(mesclar_pares)})
+        if reescrever:
+            db.session.execute(update(modelo), reescrever)
+        db.session.commit()
+        relatorio["reescritas"] += len(reescrever)
+        relatorio["mescladas"] += len(mesclar_pares)
+        time.sleep(0.05)
+    return relatorio
+
+def normalizar_tabela_historico(modelo, contador_versao=None):
+    """
+    Reescreve os telefones de tabelas sem unicidade (histórico), um lote por transação.
+    `contador_versao` é incrementado junto com cada lote reescrito.
+    """
+    relatorio, ultimo_id = {"lidas": 0, "reescritas": 0}, 0
+    while True:
+        lote = _lote_por_id(modelo, ultimo_id)
+        if not lote: break
+        ultimo_id = lote[-1].id
+        relatorio["lidas"] += len(lote)
+        reescrever = [{"id": linha.id, "telefone": normalizar_telefone(linha.telefone)} for linha in lote
+                      if normalizar_telefone(linha.telefone) != linha.telefone]
+        if reescrever:
+            db.session.execute(update(modelo), reescrever)
+            if contador_versao:
+                incrementar_contadores({contador_versao: 1})
+            db.session.commit()
+            relatorio["reescritas"] += len(reescrever)
+            time.sleep(0.05)
+        else:
             db.session.rollback()
+    return relatorio
+
+def tarefa_normalizar_telefones():
+    """
+    Leva os telefones já gravados para a forma canônica e mescla os contatos que
+    existiam nas duas formas (com e sem o nono dígito), que dividiam o histórico e
+    recebiam a campanha duas vezes. Campanhas já preparadas não são alteradas.
+    """
+    if not trava_normalizacao_telefones.acquire(blocking=False): return
+    normalizacao_telefones_status.update({"executando": True, "tabelas": {}, "iniciado_em": agora_local().isoformat(),
+                                          "finalizado_em": None, "erro": None})
+    try:
+        with sessao_de_fundo():
+            tabelas = normalizacao_telefones_status["tabelas"]
+            tabelas["cadastros"] = normalizar_tabela_unica(Cadastro, _mesclar_cadastros, "cadastros")
+            tabelas["participantes"] = normalizar_tabela_unica(Participante, _mesclar_participantes)
+            tabelas["contatos"] = normalizar_tabela_unica(Contato, _mesclar_contatos)
+            tabelas["mensagens"] = normalizar_tabela_historico(Mensagem, VERSAO_MENSAGENS_CHAVE)
+            tabelas["reclamacoes"] = normalizar_tabela_historico(Reclamacao)
+        sinalizar_mudanca_participantes()
+        invalidar_estatisticas()
+        logger.info("Normalização de telefones concluída: %s", normalizacao_telefones_status['tabelas'])
+    except Exception as e:
+        db.session.rollback()
+        normalizacao_telefones_status["erro"] = str(e)
+        logger.exception("Erro na normalização de telefones: %s", e)
+    finally:
+        normalizacao_telefones_status.update({"executando": False, "finalizado_em": agora_local().isoformat()})
+        trava_normalizacao_telefones.release()
+
+# --- Estatísticas ---
+# Os totais vivem na tabela `contadores` e são atualizados por upsert na mesma
+# transação que grava (ou apaga) as linhas, então o /stats não precisa de COUNT(*).
+# Chaves: cadastros, mensagens, envios, reclamacoes:status:<status>,
+# mensagens:dia:AAAA-MM-DD e {mensagens,envios}:hora:AAAA-MM-DDTHH (recebidas/enviadas
+# no período, no horário local). O tamanho do banco é medido em segundo plano.
+STATS_TTL_S = float(os.getenv("STATS_TTL_S", "30"))
+STATS_TAMANHO_INTERVALO_S = int(os.getenv("STATS_TAMANHO_INTERVALO_S", "300"))
+STATS_DIAS = int(os.getenv("STATS_DIAS", "14"))
+STATS_HORAS_MANTIDAS = 48
+STATS_DIAS_MANTIDOS = 400
+
+estatisticas_cache = {"dados": None, "expira": 0.0}
+tamanho_banco_cache = {"bytes": None, "medido_em": None}
+trava_estatisticas = threading.Lock()
+
+def chaves_periodo(prefixo, momento, quantidade, dia=True):
+    if not quantidade: return {}
+    chaves = {f"{prefixo}:hora:{momento:%Y-%m-%dT%H}": quantidade}
+    if dia:
+        chaves[f"{prefixo}:dia:{momento:%Y-%m-%d}"] = quantidade
+    return chaves
+
+def incrementar_contadores(incrementos, conexao=None):
+    """Soma os incrementos em `contadores` dentro da transação corrente (upsert por chave)."""
+    linhas = [{"chave": chave, "valor": valor} for chave, valor in sorted(incrementos.items()) if valor]
+    if not linhas: return
+    dialeto = postgresql if db.engine.dialect.name == 'postgresql' else sqlite
+    stmt = dialeto.insert(Contador).values(linhas)
+    stmt = stmt.on_conflict_do_update(index_elements=['chave'], set_={"valor": Contador.valor + stmt.excluded.valor})
+    (conexao or db.session).execute(stmt)
+
+def recalcular_contadores(conexao):
+    """
+    Reconstrói `contadores` a partir das tabelas (migração e correções manuais).
+    Deve rodar numa transação: no Postgres a tabela fica travada contra escrita até
+    o commit, e os incrementos que chegarem nesse meio esperam e somam sobre a
+    contagem nova, sem se perder entre o DELETE e os INSERTs.
+    """
+    if db.engine.dialect.name == 'postgresql':
+        dia, hora = "to_char(data_recebimento, 'YYYY-MM-DD')", "to_char(data_recebimento, 'YYYY-MM-DD\"T\"HH24')"
+        conexao.execute(text("LOCK TABLE contadores IN EXCLUSIVE MODE"))
+    else:
+        dia, hora = "strftime('%Y-%m-%d', data_recebimento)", "strftime('%Y-%m-%dT%H', data_recebimento)"
+    # Só as chaves recontadas abaixo; as demais (envios por hora...) são mantidas.
+    conexao.execute(text(
+        "DELETE FROM contadores WHERE chave IN ('cadastros', 'mensagens', 'envios') "
+        "OR chave LIKE 'reclamacoes:status:%' OR chave LIKE 'mensagens:dia:%' OR chave LIKE 'mensagens:hora:%'"
+    ))
+    for sql in (
+        "INSERT INTO contadores (chave, valor) SELECT 'cadastros', COUNT(*) FROM cadastros",
+        "INSERT INTO contadores (chave, valor) SELECT 'mensagens', COUNT(*) FROM mensagens",
+        "INSERT INTO contadores (chave, valor) SELECT 'reclamacoes:status:' || COALESCE(status, 'Registrada'), COUNT(*) "
+        "FROM reclamacoes GROUP BY COALESCE(status, 'Registrada')",
+        f"INSERT INTO contadores (chave, valor) SELECT 'mensagens:dia:' || {dia}, COUNT(*) FROM mensagens "
+        f"WHERE data_recebimento IS NOT NULL GROUP BY {dia}",
+        f"INSERT INTO contadores (chave, valor) SELECT 'mensagens:hora:' || {hora}, COUNT(*) FROM mensagens "
+        f"WHERE data_recebimento >= :limite GROUP BY {hora}",
+        "INSERT INTO contadores (chave, valor) SELECT 'envios', COUNT(*) FROM campanha_destinatarios WHERE estado = 'enviado'",
+    ):
+        conexao.execute(text(sql), {"limite": agora_local() - timedelta(hours=STATS_HORAS_MANTIDAS)})
+
+def registrar_tamanho_banco(tamanho_bytes):
+    with trava_estatisticas:
+        tamanho_banco_cache.update({"bytes": tamanho_bytes, "medido_em": agora_local().isoformat(timespec='seconds')})
+
+def invalidar_estatisticas():
+    with trava_estatisticas:
+        estatisticas_cache["expira"] = 0.0
+
+def serie_periodo(contadores, prefixo, momentos, formato):
+    return {f"{m:{formato}}": contadores.get(f"{prefixo}:{m:{formato}}", 0) for m in momentos}
+
+def calcular_estatisticas():
+    contadores = dict(db.session.query(Contador.chave, Contador.valor).all())
+    if tamanho_banco_cache["bytes"] is None:
+        registrar_tamanho_banco(tamanho_banco_bytes())
+    agora = agora_local()
+    horas = [agora - timedelta(hours=h) for h in range(23, -1, -1)]
+    dias = [agora - timedelta(days=d) for d in range(STATS_DIAS - 1, -1, -1)]
+    por_status = {chave.split(":", 2)[2]: valor for chave, valor in contadores.items()
+                  if chave.startswith("reclamacoes:status:") and valor}
+    mensagens_hora = serie_periodo(contadores, "mensagens:hora", horas, "%Y-%m-%dT%H")
+    envios_hora = serie_periodo(contadores, "envios:hora", horas, "%Y-%m-%dT%H")
+    tamanho_bytes = tamanho_banco_cache["bytes"] or 0
+    return {
+        "total_cadastros": contadores.get("cadastros", 0),
+        "db_size": f"{tamanho_bytes / (1024 * 1024):.2f} MB",
+        "db_bytes": tamanho_bytes, "db_medido_em": tamanho_banco_cache["medido_em"],
+        "total_mensagens": contadores.get("mensagens", 0),
+        "total_reclamacoes": sum(por_status.values()), "reclamacoes_por_status": por_status,
+        "mensagens_por_dia": serie_periodo(contadores, "mensagens:dia", dias, "%Y-%m-%d"),
+        "mensagens_por_hora": mensagens_hora,
+        "mensagens_ultima_hora": mensagens_hora[f"{agora:%Y-%m-%dT%H}"],
+        "envios_total": contadores.get("envios", 0), "envios_por_hora": envios_hora,
+        "envios_ultima_hora": envios_hora[f"{agora:%Y-%m-%dT%H}"],
+        "atualizado_em": agora.isoformat(timespec='seconds')
+    }
+
+def obter_estatisticas():
+    with trava_estatisticas:
+        if estatisticas_cache["dados"] and time.time() < estatisticas_cache["expira"]:
+            return estatisticas_cache["dados"]
+    dados = calcular_estatisticas()
+    with trava_estatisticas:
+        estatisticas_cache.update({"dados": dados, "expira": time.time() + STATS_TTL_S})
+    return dados
+
+def podar_contadores():
+    """Remove as chaves por hora e por dia mais antigas que o período mantido."""
+    agora = agora_local()
+    db.session.execute(
+        Contador.__table__.delete().where(db.or_(
+            db.and_(Contador.chave.like("%:hora:%"),
+                    db.func.substr(Contador.chave, db.func.length(Contador.chave) - 12) <
+                    f"{agora - timedelta(hours=STATS_HORAS_MANTIDAS):%Y-%m-%dT%H}"),
+            db.and_(Contador.chave.like("%:dia:%"),
+                    db.func.substr(Contador.chave, db.func.length(Contador.chave) - 9) <
+                    f"{agora - timedelta(days=STATS_DIAS_MANTIDOS):%Y-%m-%d}"),
+        ))
+    )
+    db.session.commit()
+
+def agendador_estatisticas():
+    """Mede o tamanho do banco e poda os contadores antigos fora do caminho dos requests."""
+    # Num banco novo a tabela `contadores` só existe depois das migrações do início.
+    esquema_pronto.wait()
+    while True:
+        try:
+            with sessao_de_fundo():
+                registrar_tamanho_banco(tamanho_banco_bytes())
+                podar_contadores()
+        except Exception as e:
+            logger.exception("Erro ao atualizar as estatísticas: %s", e)
+        time.sleep(STATS_TAMANHO_INTERVALO_S)
+
+# --- Eventos em Tempo Real (SSE) ---
+# O painel assina /events e recebe avisos tipados (mensagem_nova, participante_novo,
+# reclamacao_nova, reclamacao_status, campanha_progresso); a cada aviso ele busca só
+# o delta correspondente. No Postgres os eventos passam por NOTIFY, então um evento
+# publicado em qualquer worker chega aos painéis conectados em todos eles; em outros
+# bancos a distribuição fica restrita ao próprio processo.
+# Cada conexão SSE ocupa uma thread por até EVENTOS_DURACAO_MAX_S: rode o gunicorn
+# com workers de threads (--worker-class gthread --threads N) ou gevent.
+EVENTOS_CANAL_PG = "painel_eventos"
+EVENTOS_HEARTBEAT_S = 15
+EVENTOS_DURACAO_MAX_S = int(os.getenv("EVENTOS_DURACAO_MAX_S", "300"))
+EVENTOS_MAX_CLIENTES = int(os.getenv("EVENTOS_MAX_CLIENTES", "50"))
+EVENTOS_PROGRESSO_INTERVALO_S = 1.0
+
+assinantes_eventos = set()
+trava_assinantes = threading.Lock()
+_ouvinte_eventos_pid = None
+_ultimo_progresso_publicado = 0.0
+
+def distribuir_evento_local(payload):
+    """Entrega um evento (JSON com tipo e dados) a todos os clientes SSE deste processo."""
+    try:
+        evento = json.loads(payload)
+    except ValueError:
+        return
+    quadro = f"event: {evento['tipo']}\ndata: {json.dumps(evento['dados'])}\n\n"
+    with trava_assinantes:
+        assinantes = list(assinantes_eventos)
+    for fila in assinantes:
+        try:
+            fila.put_nowait(quadro)
+        except queue.Full:
+            pass  # Cliente lento: ele perde o aviso, mas a sincronização periódica cobre.
+
+def publicar_evento(tipo, dados):
+    payload = json.dumps({"tipo": tipo, "dados": dados})
+    try:
+        if not sessao_postgres_dedicada():
+            distribuir_evento_local(payload)
+            return
+        with motor_banco.connect() as conexao:
+            conexao.execute(text("SELECT pg_notify(:canal, :payload)"), {"canal": EVENTOS_CANAL_PG, "payload": payload})
+            conexao.commit()
+    except Exception as e:
+        logger.error("Erro ao publicar evento %s: %s", tipo, e)
+
+def publicar_progresso_campanha(forcar=False):
+    """Publica o progresso do disparo no máximo uma vez por segundo (ou sempre, se forçado)."""
+    global _ultimo_progresso_publicado
+    agora = time.time()
+    if not forcar and agora - _ultimo_progresso_publicado < EVENTOS_PROGRESSO_INTERVALO_S: return
+    _ultimo_progresso_publicado = agora
+    publicar_evento("campanha_progresso", {
+        "ativo": disparo_status["ativo"], "progresso": disparo_status["progresso"],
+        "total": disparo_status["total"], "ignorados": disparo_status["ignorados"]
+    })
+
+def ouvinte_eventos_pg():
+    """Mantém um LISTEN em uma conexão dedicada e repassa cada NOTIFY aos clientes locais."""
+    while True:
+        conexao = None
+        try:
+            conexao = motor_sessao().raw_connection()
+            conexao.detach()  # Conexão própria: não volta para o pool com o LISTEN ativo.
+            bruta = conexao.driver_connection
+            bruta.autocommit = True
+            bruta.cursor().execute(f"LISTEN {EVENTOS_CANAL_PG}")
+            while True:
+                if select.select([bruta], [], [], EVENTOS_HEARTBEAT_S) == ([], [], []): continue
+                bruta.poll()
+                while bruta.notifies:
+                    distribuir_evento_local(bruta.notifies.pop(0).payload)
+        except Exception as e:
+            logger.error("Erro no ouvinte de eventos: %s", e)
+            time.sleep(5)
+        finally:
+            if conexao is not None:
+                try: conexao.close()
+                except Exception: pass
+
+def garantir_ouvinte_eventos():
+    """Sobe o ouvinte do Postgres na primeira assinatura deste processo."""
+    global _ouvinte_eventos_pid
+    if _ouvinte_eventos_pid == os.getpid() or not sessao_postgres_dedicada(): return
+    with trava_assinantes:
+        if _ouvinte_eventos_pid == os.getpid(): return
+        _ouvinte_eventos_pid = os.getpid()
+    threading.Thread(target=ouvinte_eventos_pg, daemon=True).start()
 
-def extrair_nome(texto):
-    if not texto or not isinstance(texto, str): return None
-    match = re.search(r"(?:meu nome é|chamo-me|sou o|sou a)\s+([A-Za-zÀ-ú\s]+)", texto, re.IGNORECASE)
-    if match: return match.group(1).strip().title()
-    partes = texto.split()
-    if len(partes) >= 2 and partes[0].isalpha() and len(partes[0]) > 2:
-        return f"{partes[0].title()} {partes[1].title() if partes[1].isalpha() else ''}".strip()
-    return None
-
-def adicionar_ao_sorteio(telefone, nome_extraido):
-    if telefone not in db_participantes_sorteio:
-        nome_final = nome_extraido or f"Participante ({telefone[-4:]})"
-        db_participantes_sorteio[telefone] = {"nome": nome_final, "telefone": telefone}
-        return True
-    return False
+# --- Ingestão do Webhook ---
 
-def formatar_numero_br(numero):
+def interpretar_mensagem(message_data):
+    """Converte uma mensagem da API da Meta no formato gravado em `mensagens`."""
+    remetente = formatar_numero_br(message_data['from'])
+    message_type = message_data.get('type')
+    
+    mensagem_para_painel, nome_extraido, media_id = "", None, None
+
+    if message_type == 'text':
+        mensagem_para_painel = message_data['text']['body']
+        nome_extraido = extrair_nome(mensagem_para_painel)
+    elif message_type in ['image', 'video', 'document', 'audio']:
+        media_id = message_data[message_type]['id']
+        legenda = message_data[message_type].get('caption')
+        if legenda:
+            mensagem_para_painel = legenda
+            nome_extraido = extrair_nome(legenda)
+        else:
+            mensagem_para_painel = f"[{message_type.upper()} RECEBIDA]"
+    
+    return {
+        "telefone": remetente, "nome": nome_extraido or f"Pessoa ({remetente[-4:]})",
+        "texto": mensagem_para_painel, "media_id": media_id, "media_type": message_type
+    }
+
+def extrair_mensagens_notificacao(data):
     """
-    Corrige números de celular do Brasil que podem vir da API sem o nono dígito.
-    Exemplo: 554498369564 (12 dígitos) -> 5544998369564 (13 dígitos)
+    Percorre todas as entries, changes e messages de uma notificação. A Meta pode
+    agrupar várias mensagens em um único POST; mensagens malformadas são ignoradas
+    individualmente sem descartar o restante do lote.
     """
-    if not isinstance(numero, str): return numero
-    
-    if numero.startswith('55') and len(numero) == 12:
-        ddd = int(numero[2:4])
-        if 11 <= ddd <= 99:
-            print(f"INFO: Corrigindo número brasileiro de 12 para 13 dígitos: {numero}")
-            numero_corrigido = f"{numero[:4]}9{numero[4:]}"
-            print(f"INFO: Número corrigido para {numero_corrigido}")
-            return numero_corrigido
-            
-    return numero
+    itens = []
+    for entry in data.get('entry') or []:
+        if not isinstance(entry, dict): continue
+        for change in entry.get('changes') or []:
+            if not isinstance(change, dict): continue
+            for message_data in (change.get('value') or {}).get('messages') or []:
+                try:
+                    itens.append(interpretar_mensagem(message_data))
+                except (KeyError, IndexError, TypeError) as e:
+                    logger.warning("Formato de mensagem não esperado: %s", e)
+    return itens
 
-def enviar_resposta_whatsapp(destinatario, mensagem):
+def processar_notificacao(data):
     """
-    CORREÇÃO DE ENVIO: Atualizada a versão da API para v19.0, adicionado "type": "text" 
-    explícito e melhorado o log de erros para diagnóstico.
+    Processa uma notificação do webhook já validada: persiste, extrai o nome e
+    responde. Devolve False se a gravação no banco falhou.
     """
-    if not all([META_ACCESS_TOKEN, META_PHONE_NUMBER_ID]):
-        disparo_status["log"].append(f"AVISO: Credenciais não configuradas. Simulando envio para {destinatario}")
-        return False
-    
-    url = f"https://graph.facebook.com/v19.0/{META_PHONE_NUMBER_ID}/messages"
-    headers = {"Authorization": f"Bearer {META_ACCESS_TOKEN}", "Content-Type": "application/json"}
-    data = {
-        "messaging_product": "whatsapp",
-        "to": destinatario,
-        "type": "text",
-        "text": {"body": mensagem}
-    }
-    
-    try:
-        response = requests.post(url, headers=headers, data=json.dumps(data), timeout=15)
-        response.raise_for_status()
-        print(f"Mensagem enviada para {destinatario}. Status: {response.status_code}")
-        return True
-    except requests.exceptions.Timeout:
-        print(f"ERRO: Timeout ao enviar mensagem para {destinatario}")
-        disparo_status["log"].append(f"ERRO: Timeout (15s) para ...{destinatario[-4:]}")
+    itens = extrair_mensagens_notificacao(data)
+    if not itens: return True
+    inicio = time.perf_counter()
+    for item in itens:
+        metricas.contar("whatformula_webhook_mensagens_total", tipo=item["media_type"])
+
+    boas_vindas = salvar_lote_no_banco(itens)
+    if boas_vindas is None: return False
+    for item in itens:
+        # A miniatura já baixa o original para o cache; o prefetch cobre os demais tipos.
+        if item["media_id"] and not agendar_miniatura(item["media_id"], item["media_type"]):
+            agendar_prefetch_midia(item["media_id"])
+    for telefone in boas_vindas:
+        enviar_resposta_whatsapp(telefone, "Obrigado por sua mensagem! Você já está participando do nosso sorteio semanal. Boa sorte! 🤞")
+    metricas.observar("whatformula_webhook_processamento_segundos", (time.perf_counter() - inicio) * 1000)
+    return True
+
+def gravar_notificacao_pendente(data):
+    """Grava o payload no spool, já reservado para este processo, e devolve o id da linha."""
+    pendente = NotificacaoPendente(payload=json.dumps(data), lease_dono=id_processo(),
+                                   lease_expira=agora_local() + timedelta(seconds=WEBHOOK_LEASE_S))
+    db.session.add(pendente)
+    db.session.commit()
+    return pendente.id
+
+def processar_pendente(pendente_id, data):
+    """
+    Processa uma notificação do spool se o lease ainda for deste processo e apaga a
+    linha quando a gravação dá certo. Se falhar, a linha fica e volta à fila quando o
+    lease vencer. Devolve True se a notificação foi processada.
+    """
+    with sessao_de_fundo():
+        # Renova o lease: a notificação pode ter esperado na fila além da validade.
+        reservada = db.session.execute(
+            update(NotificacaoPendente)
+            .where(NotificacaoPendente.id == pendente_id, NotificacaoPendente.lease_dono == id_processo())
+            .values(lease_expira=agora_local() + timedelta(seconds=WEBHOOK_LEASE_S))
+            .returning(NotificacaoPendente.id)
+            .execution_options(synchronize_session=False)
+        ).scalar()
+        db.session.commit()
+    if reservada is None:
+        logger.info("Notificação %s do spool já foi assumida por outro processo.", pendente_id)
         return False
-    except requests.exceptions.RequestException as e:
-        print(f"ERRO ao enviar para {destinatario}. Resposta completa da API: {e.response.text}")
-        disparo_status["log"].append(f"ERRO ao enviar para ...{destinatario[-4:]}: Checar console para detalhes.")
+    if not processar_notificacao(data):
         return False
+    with sessao_de_fundo():
+        db.session.execute(NotificacaoPendente.__table__.delete().where(NotificacaoPendente.id == pendente_id))
+        db.session.commit()
+    return True
 
-def tarefa_disparo_massa(mensagens):
-    global disparo_status
-    with app.app_context():
-        # Pega a lista de números já corrigida (se aplicável) do banco de dados
-        cadastros = Cadastro.query.all()
-        numeros = [c.telefone for c in cadastros]
-        random.shuffle(numeros)
-        
-        disparo_status["total"] = len(numeros)
-        disparo_status["progresso"] = 0
-        disparo_status["log"] = [f"Iniciando disparos para {len(numeros)} contatos..."]
-        
-        if not numeros:
-            disparo_status["log"].append("Nenhum contato cadastrado para enviar.")
-            disparo_status["ativo"] = False
-            return
-
-        limite_24h = datetime.utcnow() - timedelta(hours=24)
+def reenfileirar_pendentes():
+    """
+    Assume as notificações do spool com lease vencido (processo que caiu ou gravação
+    que falhou) e as devolve à fila; sem o modo assíncrono, processa-as aqui mesmo.
+    """
+    vagas = min(100, WEBHOOK_FILA_MAX - fila_webhook.qsize()) if WEBHOOK_ASYNC else 100
+    if vagas <= 0: return 0
+    with sessao_de_fundo():
+        agora = agora_local()
+        livre = db.or_(NotificacaoPendente.lease_expira.is_(None), NotificacaoPendente.lease_expira < agora)
+        candidatas = (db.session.query(NotificacaoPendente.id)
+                      .filter(livre, NotificacaoPendente.tentativas < WEBHOOK_MAX_TENTATIVAS)
+                      .order_by(NotificacaoPendente.id).limit(vagas).scalar_subquery())
+        assumidas = db.session.execute(
+            update(NotificacaoPendente)
+            .where(NotificacaoPendente.id.in_(candidatas), livre)
+            .values(lease_dono=id_processo(), lease_expira=agora + timedelta(seconds=WEBHOOK_LEASE_S),
+                    tentativas=NotificacaoPendente.tentativas + 1)
+            .returning(NotificacaoPendente.id, NotificacaoPendente.payload, NotificacaoPendente.recebida_em)
+            .execution_options(synchronize_session=False)
+        ).all()
+        db.session.commit()
+    for pendente_id, payload, recebida_em in sorted(assumidas):
+        logger.warning("Reprocessando a notificação %s do spool, recebida em %s.", pendente_id, recebida_em)
+        if not WEBHOOK_ASYNC:
+            processar_pendente(pendente_id, json.loads(payload))
+            continue
+        try:
+            fila_webhook.put_nowait((time.time(), pendente_id, json.loads(payload)))
+        except queue.Full:
+            break  # o lease vence e a próxima rodada tenta de novo
+    return len(assumidas)
 
-        for i in range(0, len(numeros), 5):
-            if not disparo_status["ativo"]:
-                disparo_status["log"].append("Campanha interrompida pelo usuário.")
-                break
-            
-            lote_atual = numeros[i:i+5]
-            num_lote = (i // 5) + 1
-            total_lotes = (len(numeros) + 4) // 5
-            disparo_status["log"].append(f"--- Processando Lote {num_lote}/{total_lotes} ({len(lote_atual)} contatos) ---")
-
-            for numero in lote_atual:
-                if not disparo_status["ativo"]: break
-
-                interacao_recente = Mensagem.query.filter(Mensagem.telefone == numero, Mensagem.data_recebimento > limite_24h).first()
-                if not interacao_recente:
-                    disparo_status["log"].append(f"Ignorado ...{numero[-4:]} (sem interação em 24h)")
-                    disparo_status["progresso"] += 1
-                    continue
-
-                mensagem_aleatoria = random.choice(mensagens)
-                disparo_status["log"].append(f"Tentando enviar para ...{numero[-4:]}")
-                if enviar_resposta_whatsapp(numero, mensagem_aleatoria):
-                    disparo_status["log"].append(f"-> Sucesso para ...{numero[-4:]}")
-                else:
-                    disparo_status["log"].append(f"-> Falha para ...{numero[-4:]}")
-                
-                disparo_status["progresso"] += 1
-                time.sleep(random.randint(2, 5))
-            
-            if i + 5 < len(numeros) and disparo_status["ativo"]:
-                intervalo = random.randint(180, 600)
-                disparo_status["log"].append(f"Pausa de {intervalo//60} min e {intervalo%60}s antes do próximo lote.")
-                
-                for _ in range(intervalo):
-                    if not disparo_status["ativo"]:
-                        disparo_status["log"].append("Pausa interrompida.")
-                        break
-                    time.sleep(1)
-                
-                if not disparo_status["ativo"]:
-                    break
-    
-    disparo_status["log"].append("--- Campanha Finalizada ---")
-    disparo_status["ativo"] = False
+def agendador_spool_webhook():
+    """Devolve à fila, periodicamente, as notificações do spool abandonadas."""
+    # A tabela `webhook_pendentes` só existe depois das migrações do início num banco novo.
+    esquema_pronto.wait()
+    while True:
+        try:
+            reenfileirar_pendentes()
+        except Exception as e:
+            logger.exception("Erro ao reprocessar o spool do webhook: %s", e)
+        time.sleep(WEBHOOK_REPROCESSAR_S + random.uniform(0, WEBHOOK_REPROCESSAR_S * 0.1))
 
+def _registrar_fila(**incrementos):
+    with trava_fila_status:
+        for chave, valor in incrementos.items():
+            fila_status[chave] += valor
 
-def tarefa_limpeza_banco():
-    with app.app_context():
+def consumidor_fila_webhook():
+    """Consome a fila de ingestão indefinidamente, registrando o atraso de cada item."""
+    while True:
+        enfileirado_em, pendente_id, data = fila_webhook.get()
         try:
-            query = text("SELECT pg_database_size(current_database())")
-            tamanho_bytes = db.session.execute(query).scalar()
-            tamanho_mb = tamanho_bytes / (1024 * 1024)
-            print(f"Tamanho atual do banco de dados: {tamanho_mb:.2f} MB")
-
-            if tamanho_mb > 500:
-                print("Iniciando rotina de limpeza de mensagens antigas...")
-                mensagens_para_apagar = Mensagem.query.order_by(Mensagem.data_recebimento.asc()).limit(500).all()
-                if mensagens_para_apagar:
-                    for msg in mensagens_para_apagar:
-                        db.session.delete(msg)
-                    db.session.commit()
-                    print("✅ 500 mensagens mais antigas foram apagadas.")
+            atraso = time.time() - enfileirado_em
+            metricas.observar("whatformula_webhook_atraso_fila_segundos", atraso * 1000)
+            with trava_fila_status:
+                fila_status["ultimo_atraso_s"] = round(atraso, 3)
+                fila_status["maior_atraso_s"] = max(fila_status["maior_atraso_s"], round(atraso, 3))
+            if processar_pendente(pendente_id, data):
+                _registrar_fila(processadas=1)
+            else:
+                _registrar_fila(erros=1)
         except Exception as e:
-            print(f"❌ ERRO durante a rotina de limpeza: {e}")
+            _registrar_fila(erros=1)
+            logger.exception("Erro no consumidor da fila do webhook: %s", e)
+        finally:
+            fila_webhook.task_done()
+
+def drenar_fila_webhook(timeout=10):
+    """Dá aos consumidores uma chance de esvaziar a fila antes de o processo encerrar."""
+    limite = time.time() + timeout
+    while fila_webhook.unfinished_tasks and time.time() < limite:
+        time.sleep(0.1)
+
+def iniciar_tarefas_de_fundo():
+    """
+    Inicia as threads de fundo uma vez por processo. É chamada no primeiro request
+    (e não na importação) porque, sob o gunicorn, threads criadas antes do fork
+    não existem nos workers.
+    """
+    global _tarefas_iniciadas_pid
+    if _tarefas_iniciadas_pid == os.getpid(): return
+    with _trava_tarefas:
+        if _tarefas_iniciadas_pid == os.getpid(): return
+        _tarefas_iniciadas_pid = os.getpid()
+        if WEBHOOK_ASYNC:
+            for _ in range(WEBHOOK_CONSUMIDORES):
+                threading.Thread(target=consumidor_fila_webhook, daemon=True).start()
+            atexit.register(drenar_fila_webhook)
+        threading.Thread(target=agendador_spool_webhook, daemon=True).start()
+        if PARTICIPANTES_CARGA_ASSINCRONA:
+            threading.Thread(target=tarefa_migracoes_iniciais, daemon=True).start()
+            threading.Thread(target=tarefa_carga_participantes, daemon=True).start()
+        else:
+            tarefa_migracoes_iniciais()
+            tarefa_carga_participantes()
+        if RETENCAO_INTERVALO_S > 0:
+            threading.Thread(target=agendador_retencao, daemon=True).start()
+        threading.Thread(target=agendador_campanhas, daemon=True).start()
+        if STATS_TAMANHO_INTERVALO_S > 0:
+            threading.Thread(target=agendador_estatisticas, daemon=True).start()
+
+@app.before_request
+def garantir_tarefas_de_fundo():
+    iniciar_tarefas_de_fundo()
+
+@metricas.coletor
+def coletar_metricas_filas():
+    with trava_fila_status:
+        notificacoes = {(("evento", chave),): fila_status[chave] for chave in ("recebidas", "processadas", "erros", "processadas_inline")}
+    with trava_assinantes:
+        clientes_eventos = len(assinantes_eventos)
+    # As filas dos executores não têm API pública de tamanho; `_work_queue` é a fila interna deles.
+    profundidades = {
+        (("fila", "webhook"),): fila_webhook.qsize(),
+        (("fila", "prefetch_midia"),): executor_prefetch_midia._work_queue.qsize(),
+        (("fila", "miniaturas"),): executor_miniaturas._work_queue.qsize(),
+    }
+    return [
+        ("whatformula_webhook_notificacoes_total", "counter", "Notificações do webhook por evento da fila de ingestão.", notificacoes),
+        ("whatformula_fila_profundidade", "gauge", "Itens aguardando em cada fila de trabalho.", profundidades),
+        ("whatformula_eventos_clientes", "gauge", "Painéis conectados ao canal de eventos (SSE).", {(): clientes_eventos}),
+        ("whatformula_campanha_ativa", "gauge", "1 enquanto este processo executa uma campanha.", {(): int(bool(disparo_status["ativo"]))}),
+        ("whatformula_campanha_restantes", "gauge", "Destinatários ainda não concluídos da campanha deste processo.",
+         {(): max(0, disparo_status["total"] - disparo_status["progresso"]) if disparo_status["ativo"] else 0}),
+    ]
 
 # --- Endpoints da API ---
 
@@ -264,80 +2812,421 @@ def whatsapp_webhook():
         return "Token de verificação inválido", 403
 
     if request.method == 'POST':
-        data = request.json
-        try:
-            if 'entry' in data and data['entry'][0]['changes'][0]['value'].get('messages'):
-                message_data = data['entry'][0]['changes'][0]['value']['messages'][0]
-                remetente_original = message_data['from']
-                
-                remetente = formatar_numero_br(remetente_original)
-                
-                message_type = message_data.get('type')
-                
-                mensagem_para_painel, nome_extraido, media_id = "", None, None
-
-                if message_type == 'text':
-                    mensagem_para_painel = message_data['text']['body']
-                    nome_extraido = extrair_nome(mensagem_para_painel)
-                elif message_type in ['image', 'video', 'document', 'audio']:
-                    media_id = message_data[message_type]['id']
-                    legenda = message_data[message_type].get('caption')
-                    if legenda:
-                        mensagem_para_painel = legenda
-                        nome_extraido = extrair_nome(legenda)
-                    else:
-                        mensagem_para_painel = f"[{message_type.upper()} RECEBIDA]"
-                
-                nome_final = nome_extraido or f"Pessoa ({remetente[-4:]})"
-                salvar_no_banco(remetente, nome_final, mensagem_para_painel, media_id, message_type)
-                
-                if adicionar_ao_sorteio(remetente, nome_final):
-                    enviar_resposta_whatsapp(remetente, "Obrigado por sua mensagem! Você já está participando do nosso sorteio semanal. Boa sorte! 🤞")
-                
-                threading.Thread(target=tarefa_limpeza_banco).start()
-        except (KeyError, IndexError) as e:
-            print(f"Formato de notificação não esperado: {e}")
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict) or not isinstance(data.get('entry'), list):
+            logger.debug("Notificação ignorada: payload sem 'entry'.")
+            return "OK", 200
+
+        _registrar_fila(recebidas=1)
+        if WEBHOOK_ASYNC:
+            try:
+                pendente_id = gravar_notificacao_pendente(data)
+            except Exception as e:
+                # Sem o spool não há como garantir o processamento: a Meta reenvia após o erro.
+                logger.exception("Erro ao gravar a notificação no spool: %s", e)
+                db.session.rollback()
+                return "Erro ao registrar a notificação", 500
+            try:
+                fila_webhook.put_nowait((time.time(), pendente_id, data))
+            except queue.Full:
+                # Fila cheia: processa no próprio request; se falhar, a linha fica no spool.
+                _registrar_fila(processadas_inline=1)
+                processar_pendente(pendente_id, data)
+            return "OK", 200
+
+        processar_notificacao(data)
         return "OK", 200
 
+@app.route('/events')
+def eventos():
+    with trava_assinantes:
+        if len(assinantes_eventos) >= EVENTOS_MAX_CLIENTES:
+            return jsonify({"status": "error", "message": "Limite de conexões de eventos atingido."}), 503
+        fila = queue.Queue(maxsize=100)
+        assinantes_eventos.add(fila)
+    garantir_ouvinte_eventos()
+
+    def gerar():
+        # A conexão é encerrada após EVENTOS_DURACAO_MAX_S para liberar a thread; o
+        # EventSource do navegador reconecta sozinho após o tempo de `retry`.
+        fim = time.time() + EVENTOS_DURACAO_MAX_S
+        try:
+            yield "retry: 3000\n\n"
+            while time.time() < fim:
+                try:
+                    yield fila.get(timeout=EVENTOS_HEARTBEAT_S)
+                except queue.Empty:
+                    yield ": ping\n\n"
+        finally:
+            with trava_assinantes:
+                assinantes_eventos.discard(fila)
+
+    return Response(gerar(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/health', methods=['GET'])
+def health():
+    pronto = participantes_prontos.is_set()
+    return jsonify({"status": "ok" if pronto else "carregando", "participantes_prontos": pronto,
+                    "migracoes_concluidas": esquema_pronto.is_set()}), 200 if pronto else 503
+
+@app.route('/status_limpeza', methods=['GET'])
+def get_status_limpeza(): return jsonify(retencao_status)
+
+@app.route('/backfill_nomes', methods=['GET', 'POST'])
+def backfill_nomes():
+    """POST inicia a reextração de nomes sobre o histórico; GET mostra o andamento."""
+    if request.method == 'POST':
+        if trava_backfill_nomes.locked():
+            return jsonify({"status": "error", "message": "O backfill de nomes já está em andamento."}), 409
+        threading.Thread(target=tarefa_backfill_nomes, daemon=True).start()
+        return jsonify({"status": "success", "message": "Backfill de nomes iniciado."}), 202
+    return jsonify(backfill_nomes_status)
+
+@app.route('/normalizar_telefones', methods=['GET', 'POST'])
+def normalizar_telefones():
+    """POST inicia a normalização/mescla dos telefones gravados; GET mostra o andamento."""
+    if request.method == 'POST':
+        if trava_normalizacao_telefones.locked():
+            return jsonify({"status": "error", "message": "A normalização de telefones já está em andamento."}), 409
+        threading.Thread(target=tarefa_normalizar_telefones, daemon=True).start()
+        return jsonify({"status": "success", "message": "Normalização de telefones iniciada."}), 202
+    return jsonify(normalizacao_telefones_status)
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Métricas deste processo no formato texto do Prometheus."""
+    return Response(metricas.texto(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.route('/status_graph', methods=['GET'])
+def get_status_graph():
+    """Latência por operação, erros, novas tentativas e estado do disjuntor da Graph API."""
+    return jsonify(cliente_graph.para_dict())
+
+@app.route('/status_midia', methods=['GET'])
+def get_status_midia():
+    with trava_cache_midia:
+        status = dict(cache_midia_status)
+    return jsonify({**status, "limite_bytes": MEDIA_CACHE_MAX_MB * 1024 * 1024, "prefetch": MEDIA_PREFETCH})
+
+@app.route('/status_fila', methods=['GET'])
+def get_status_fila():
+    with fila_webhook.mutex:
+        mais_antigo = fila_webhook.queue[0][0] if fila_webhook.queue else None
+    with trava_fila_status:
+        status = dict(fila_status)
+    status.update({
+        "modo_assincrono": WEBHOOK_ASYNC,
+        "profundidade": fila_webhook.qsize(),
+        "capacidade": WEBHOOK_FILA_MAX,
+        "consumidores": WEBHOOK_CONSUMIDORES if WEBHOOK_ASYNC else 0,
+        "atraso_mais_antigo_s": round(time.time() - mais_antigo, 3) if mais_antigo else 0.0,
+        "pendentes_spool": db.session.query(db.func.count(NotificacaoPendente.id)).scalar()
+    })
+    return jsonify(status)
+
 @app.route('/setup-db')
 def setup_db():
     with app.app_context():
         try:
-            db.create_all()
-            return "<h1>Sucesso!</h1><p>As tabelas foram criadas/verificadas no banco de dados. Você já pode fechar esta página.</p>"
+            # Chamada manual e única, então roda mesmo atrás do PgBouncer sem DATABASE_URL_DIRETA.
+            aplicadas = aplicar_migracoes(forcar=True)
+            detalhe = f" Migrações aplicadas: {', '.join(map(str, aplicadas))}." if aplicadas else " Nenhuma migração pendente."
+            return f"<h1>Sucesso!</h1><p>As tabelas foram criadas/verificadas no banco de dados.{detalhe} Você já pode fechar esta página.</p>"
         except Exception as e:
             return f"<h1>Erro</h1><p>Ocorreu um erro ao criar as tabelas: {e}</p>", 500
 
+def campanha_ativa():
+    return (db.session.query(Campanha.id)
+            .filter(Campanha.status.in_(ESTADOS_CAMPANHA_ATIVA)).order_by(Campanha.id).first())
+
 @app.route('/iniciar_disparo', methods=['POST'])
 def iniciar_disparo():
-    global disparo_status
-    if disparo_status["ativo"]:
-        return jsonify({"status": "error", "message": "Uma campanha já está em andamento."}), 400
     data = request.json
     mensagens = [msg for msg in [data.get('msg1'), data.get('msg2'), data.get('msg3')] if msg and msg.strip()]
     if not mensagens:
         return jsonify({"status": "error", "message": "Forneça pelo menos uma mensagem."}), 400
-    disparo_status["ativo"] = True
-    threading.Thread(target=tarefa_disparo_massa, args=(mensagens,)).start()
-    return jsonify({"status": "success", "message": "Campanha de disparo iniciada."})
+    perfil = data.get('perfil') or DISPARO_PERFIL_PADRAO
+    if perfil not in PERFIS_DISPARO:
+        return jsonify({"status": "error", "message": f"Perfil de envio inválido: {perfil}."}), 400
+    if db.engine.dialect.name == 'postgresql':
+        # Serializa a verificação + criação entre workers (liberado no commit).
+        db.session.execute(text("SELECT pg_advisory_xact_lock(:k)"), {"k": CAMPANHA_TRAVA_PG})
+    if campanha_ativa():
+        db.session.rollback()
+        return jsonify({"status": "error", "message": "Uma campanha já está em andamento."}), 400
+    campanha_id = criar_campanha(mensagens, perfil)
+    return jsonify({"status": "success", "message": "Campanha de disparo iniciada.", "campanha_id": campanha_id})
+
+@app.route('/disparo/previa', methods=['GET'])
+def previa_disparo():
+    """
+    Quantos contatos receberiam uma campanha iniciada agora, com o mesmo critério
+    de `preparar_destinatarios`. A janela ainda é conferida de novo a cada bloco.
+    """
+    total_cadastros = db.session.query(db.func.count(Cadastro.id)).scalar() or 0
+    elegiveis = contar_elegiveis_24h(agora_local() - timedelta(hours=24))
+    return jsonify({"status": "success", "contatos": total_cadastros, "elegiveis": elegiveis,
+                    "ignorados": max(total_cadastros - elegiveis, 0)})
 
 @app.route('/status_disparo', methods=['GET'])
-def get_status_disparo(): return jsonify(disparo_status)
+def get_status_disparo():
+    """
+    Status da campanha mais recente. O worker que a executa responde do buffer em
+    memória; os demais leem o progresso e o log gravados no banco.
+    """
+    try:
+        depois = int(request.args.get('after', 0))
+    except ValueError:
+        return jsonify({"status": "error", "message": "Parâmetro 'after' inválido."}), 400
+
+    campanha = db.session.query(Campanha).order_by(Campanha.id.desc()).first()
+    if disparo_status["ativo"] or campanha is None or campanha.id == disparo_status["campanha_id"] and campanha.lease_dono == id_processo():
+        versao = (disparo_status["ativo"], disparo_status["progresso"], disparo_status["total"],
+                  disparo_status["campanha_id"], disparo_status["ultimo_seq"])
+
+        def gerar():
+            with trava_log:
+                entradas = [e for e in disparo_log if e["seq"] > depois]
+                # Entradas que já saíram do buffer continuam disponíveis em /campanhas/<id>/log.
+                truncado = bool(disparo_log) and disparo_log[0]["seq"] > depois + 1
+            return jsonify({**disparo_status, "log": entradas, "truncado": truncado})
+        return com_etag(versao, gerar)
+
+    ultimo_seq = (db.session.query(db.func.max(CampanhaLog.seq))
+                  .filter(CampanhaLog.campanha_id == campanha.id).scalar() or 0)
+    versao = (campanha.id, campanha.status, campanha.progresso, campanha.ignorados, campanha.total, ultimo_seq)
+
+    def gerar_do_banco():
+        entradas = (db.session.query(CampanhaLog.seq, CampanhaLog.momento, CampanhaLog.nivel, CampanhaLog.telefone,
+                                     CampanhaLog.resultado, CampanhaLog.mensagem)
+                    .filter(CampanhaLog.campanha_id == campanha.id, CampanhaLog.seq > depois)
+                    .order_by(CampanhaLog.seq).limit(DISPARO_LOG_MAX).all())
+        return jsonify({
+            "ativo": campanha.status in ESTADOS_CAMPANHA_ATIVA, "status": campanha.status,
+            "progresso": campanha.progresso, "total": campanha.total, "elegiveis": campanha.total,
+            "ignorados": campanha.ignorados, "campanha_id": campanha.id, "ultimo_seq": ultimo_seq,
+            "log": [{"seq": e.seq, "momento": e.momento.isoformat(timespec='seconds'), "nivel": e.nivel,
+                     "telefone": e.telefone, "resultado": e.resultado, "mensagem": e.mensagem} for e in entradas],
+            "truncado": False
+        })
+    return com_etag(versao, gerar_do_banco)
+
+@app.route('/campanhas/<int:campanha_id>/log', methods=['GET'])
+def get_log_campanha(campanha_id):
+    try:
+        depois = int(request.args.get('after', 0))
+        limite = min(max(int(request.args.get('limit', PAGINA_MAXIMA)), 1), PAGINA_MAXIMA)
+    except ValueError:
+        return jsonify({"status": "error", "message": "Parâmetros inválidos."}), 400
+    campanha = db.session.get(Campanha, campanha_id)
+    if not campanha:
+        return jsonify({"status": "error", "message": "Campanha não encontrada"}), 404
+    entradas = (db.session.query(CampanhaLog.seq, CampanhaLog.momento, CampanhaLog.nivel, CampanhaLog.telefone,
+                                 CampanhaLog.resultado, CampanhaLog.mensagem)
+                .filter(CampanhaLog.campanha_id == campanha_id, CampanhaLog.seq > depois)
+                .order_by(CampanhaLog.seq).limit(limite).all())
+    return jsonify({
+        "campanha": {
+            "id": campanha.id, "perfil": campanha.perfil, "status": campanha.status, "total": campanha.total,
+            "progresso": campanha.progresso, "ignorados": campanha.ignorados,
+            "iniciada_em": campanha.iniciada_em.isoformat(),
+            "finalizada_em": campanha.finalizada_em.isoformat() if campanha.finalizada_em else None
+        },
+        "log": [{"seq": e.seq, "momento": e.momento.isoformat(), "nivel": e.nivel, "telefone": e.telefone,
+                 "resultado": e.resultado, "mensagem": e.mensagem} for e in entradas]
+    })
 
 @app.route('/parar_disparo', methods=['POST'])
 def parar_disparo():
     global disparo_status
+    # O worker que executa a campanha percebe o novo status antes de reservar o próximo bloco.
+    paradas = db.session.execute(
+        update(Campanha).where(Campanha.status.in_(("pendente", "executando"))).values(status="parando")
+        .returning(Campanha.id).execution_options(synchronize_session=False)
+    ).scalars().all()
+    db.session.commit()
     if disparo_status["ativo"]:
         disparo_status["ativo"] = False
+    if paradas:
         return jsonify({"status": "success", "message": "Campanha será interrompida."})
     return jsonify({"status": "error", "message": "Nenhuma campanha ativa para parar."})
 
+# --- Paginação por Cursor ---
+# Com `limit` ou `cursor` na query string, /mensagens e /reclamacoes respondem
+# {"itens": [...], "proximo_cursor": "..."} paginando por (data, id), sem OFFSET.
+# Sem esses parâmetros mantêm o formato antigo (lista). Nos dois casos o JSON é
+# gerado em fluxo, à medida que as linhas chegam do cursor no servidor.
+PAGINA_PADRAO = 200
+PAGINA_MAXIMA = 1000
+LINHAS_POR_BLOCO = 100
+
+def codificar_cursor(momento, id_linha):
+    return base64.urlsafe_b64encode(f"{momento.isoformat()}|{id_linha}".encode()).decode()
+
+def decodificar_cursor(cursor):
+    momento, id_linha = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+    return datetime.fromisoformat(momento), int(id_linha)
+
+def ler_paginacao():
+    """Devolve (limite, cursor) da query string; limite None indica o formato antigo."""
+    limite, cursor = request.args.get('limit'), request.args.get('cursor')
+    if limite is None and cursor is None: return None, None
+    limite = min(max(int(limite or PAGINA_PADRAO), 1), PAGINA_MAXIMA)
+    return limite, (decodificar_cursor(cursor) if cursor else None)
+
+def paginar(consulta, coluna_data, coluna_id, limite, cursor):
+    if cursor:
+        consulta = consulta.filter(db.tuple_(coluna_data, coluna_id) < db.tuple_(*cursor))
+    consulta = consulta.order_by(coluna_data.desc(), coluna_id.desc())
+    if limite is not None:
+        consulta = consulta.limit(limite + 1)
+    return consulta.yield_per(500)
+
+def json_em_fluxo(linhas, serializar, limite=None):
+    """
+    Serializa as linhas em blocos, sem montar a lista inteira na memória. No modo
+    paginado a consulta traz limite + 1 linhas; a existência da última indica que
+    há próxima página, cujo cursor é o (timestamp, id) do último item enviado.
+    """
+    partes, total, ultimo_item, proximo = [], 0, None, None
+    yield "[" if limite is None else '{"itens": ['
+    for linha in linhas:
+        if limite is not None and total == limite:
+            proximo = codificar_cursor(datetime.fromisoformat(ultimo_item["timestamp"]), ultimo_item["id"])
+            break
+        ultimo_item = serializar(linha)
+        partes.append(("," if total else "") + json.dumps(ultimo_item))
+        total += 1
+        if len(partes) >= LINHAS_POR_BLOCO:
+            yield "".join(partes)
+            partes = []
+    yield "".join(partes)
+    yield "]" if limite is None else f'], "proximo_cursor": {json.dumps(proximo)}}}'
+
+def resposta_em_fluxo(linhas, serializar, limite=None):
+    return Response(stream_with_context(json_em_fluxo(linhas, serializar, limite)), mimetype='application/json')
+
+# --- Respostas Incrementais ---
+# Com `since`, /mensagens, /participantes e /reclamacoes devolvem só o que mudou
+# depois daquele ponto: {"itens": [...], "desde": <novo ponto>}. Todas as leituras
+# do painel levam um ETag calculado de uma versão barata (máximos/contagens); se
+# o cliente mandar o mesmo valor em If-None-Match, a resposta é 304 sem corpo.
+#
+# Em /mensagens e /participantes o ponto é um cursor (data, id) da linha mais nova
+# já entregue. Os ids são reservados antes do commit, então uma linha pode ficar
+# visível depois de outra de id maior; por isso cada delta relê também as linhas
+# de id menor gravadas nos DELTA_JANELA_S anteriores ao cursor, e o painel mescla
+# por id. Em /reclamacoes, cujas linhas mudam de status, o cursor é o (atualizado_em,
+# id) da última linha entregue e a janela relida é a dos DELTA_JANELA_S anteriores a
+# ele. Quando o lote enche, "mais" é true e o painel pede o próximo na hora.
+#
+# Jobs que reescrevem mensagens já gravadas (backfill de nomes, normalização de
+# telefones) não mudam os máximos nem a contagem; eles incrementam o contador
+# "mensagens:versao", que entra na versão de /mensagens.
+DELTA_JANELA_S = int(os.getenv("DELTA_JANELA_S", "60"))
+VERSAO_MENSAGENS_CHAVE = "mensagens:versao"
+
+def com_etag(versao, gerar_resposta):
+    etag = hashlib.sha1(repr((request.path, request.query_string, versao)).encode()).hexdigest()[:20]
+    if etag in request.if_none_match:
+        resposta = Response(status=304)
+    else:
+        resposta = gerar_resposta()
+    resposta.set_etag(etag)
+    resposta.headers['Cache-Control'] = 'no-cache'
+    return resposta
+
+def max_id(modelo):
+    return db.session.query(db.func.max(modelo.id)).scalar() or 0
+
+def valores_contadores(*chaves):
+    valores = dict(db.session.query(Contador.chave, Contador.valor).filter(Contador.chave.in_(chaves)).all())
+    return tuple(valores.get(chave, 0) for chave in chaves)
+
+def ler_desde(since, coluna_data, coluna_id):
+    """
+    Cursor (data, id) do parâmetro `since`. Um id inteiro (formato antigo, ou o
+    primeiro delta depois de uma página) usa a data da própria linha.
+    """
+    if not since or since == "0": return None, 0
+    if since.isdigit():
+        id_linha = int(since)
+        return db.session.query(coluna_data).filter(coluna_id == id_linha).scalar(), id_linha
+    return decodificar_cursor(since)
+
+def consultar_delta(consulta, coluna_data, coluna_id, desde, limite):
+    """
+    Linhas com id acima do cursor, em ordem de id, somadas às de id menor gravadas
+    até DELTA_JANELA_S antes dele. Devolve (linhas, mais, novo cursor).
+    """
+    momento, id_desde = desde
+    atrasadas = []
+    if momento is not None and DELTA_JANELA_S:
+        # Os atrasos prováveis estão logo abaixo do cursor; a janela é lida de cima para baixo.
+        atrasadas = (consulta.filter(coluna_id <= id_desde, coluna_data >= momento - timedelta(seconds=DELTA_JANELA_S))
+                     .order_by(coluna_id.desc()).limit(limite).all())[::-1]
+    novas = consulta.filter(coluna_id > id_desde).order_by(coluna_id).limit(limite + 1).all()
+    mais = len(novas) > limite
+    novas = novas[:limite]
+    if novas:
+        # O momento só avança: a janela fica ancorada na linha mais nova já vista.
+        datas = [getattr(linha, coluna_data.key) for linha in novas] + [momento]
+        momento = max((d for d in datas if d is not None), default=None)
+        id_desde = getattr(novas[-1], coluna_id.key)
+    cursor = codificar_cursor(momento, id_desde) if momento is not None else str(id_desde)
+    return atrasadas + novas, mais, cursor
+
+def consultar_delta_por_data(consulta, coluna_data, coluna_id, desde, limite):
+    """
+    Delta em ordem de (data, id), para linhas que mudam depois de criadas: as que
+    estão acima do cursor, somadas às de até DELTA_JANELA_S antes dele (commits
+    atrasados, relógios adiantados). Devolve (linhas, mais, novo cursor).
+    """
+    momento, id_desde = desde
+    consulta = consulta.filter(coluna_data.isnot(None))
+    chave, atrasadas = db.tuple_(coluna_data, coluna_id), []
+    if momento is not None:
+        if DELTA_JANELA_S:
+            atrasadas = (consulta.filter(chave <= db.tuple_(momento, id_desde),
+                                         coluna_data >= momento - timedelta(seconds=DELTA_JANELA_S))
+                         .order_by(coluna_data.desc(), coluna_id.desc()).limit(limite).all())[::-1]
+        consulta = consulta.filter(chave > db.tuple_(momento, id_desde))
+    novas = consulta.order_by(coluna_data, coluna_id).limit(limite + 1).all()
+    mais = len(novas) > limite
+    novas = novas[:limite]
+    if novas:
+        momento, id_desde = getattr(novas[-1], coluna_data.key), getattr(novas[-1], coluna_id.key)
+    cursor = codificar_cursor(momento, id_desde) if momento is not None else "0"
+    return atrasadas + novas, mais, cursor
+
+def serializar_mensagem(msg):
+    return {
+        "id": msg.id, "nome": msg.nome, "telefone": msg.telefone, "texto": msg.texto,
+        "media_id": msg.media_id, "media_type": msg.media_type,
+        "timestamp": msg.data_recebimento.isoformat()
+    }
+
+def serializar_reclamacao(r):
+    return {
+        "id": r.id, "nome": r.nome, "telefone": r.telefone, "texto": r.texto,
+        "status": r.status, "media_id": r.media_id, "media_type": r.media_type,
+        "timestamp": r.timestamp.isoformat(),
+        "atualizado_em": r.atualizado_em.isoformat() if r.atualizado_em else None
+    }
+
 @app.route('/mensagens', methods=['GET'])
 def get_mensagens():
     start_date_str = request.args.get('start_date')
     end_date_str = request.args.get('end_date')
+    try:
+        limite, cursor = ler_paginacao()
+    except ValueError:
+        return jsonify({"status": "error", "message": "Parâmetros de paginação inválidos."}), 400
     
-    query = Mensagem.query
+    query = db.session.query(
+        Mensagem.id, Mensagem.nome, Mensagem.telefone, Mensagem.texto,
+        Mensagem.media_id, Mensagem.media_type, Mensagem.data_recebimento
+    )
     if start_date_str and end_date_str:
         try:
             start_date = datetime.strptime(start_date_str, '%Y-%m-%d')
@@ -349,24 +3238,38 @@ def get_mensagens():
         three_days_ago = datetime.utcnow() - timedelta(days=3)
         query = query.filter(Mensagem.data_recebimento >= three_days_ago)
 
-    mensagens_db = query.order_by(Mensagem.data_recebimento.desc()).limit(200).all()
-    return jsonify([{
-        "id": msg.id, "nome": msg.nome, "telefone": msg.telefone, "texto": msg.texto,
-        "media_id": msg.media_id, "media_type": msg.media_type,
-        "timestamp": msg.data_recebimento.isoformat()
-    } for msg in mensagens_db])
+    # Promover apaga a mensagem e cria uma reclamação, então o máximo das duas
+    # tabelas muda tanto com mensagens novas quanto com mensagens removidas; a
+    # contagem cobre a retenção e "mensagens:versao" os jobs que reescrevem linhas.
+    versao = (max_id(Mensagem), max_id(Reclamacao), *valores_contadores("mensagens", VERSAO_MENSAGENS_CHAVE))
+
+    since = request.args.get('since')
+    if since is not None:
+        try:
+            desde = ler_desde(since, Mensagem.data_recebimento, Mensagem.id)
+        except ValueError:
+            return jsonify({"status": "error", "message": "Parâmetro 'since' inválido."}), 400
+        linhas, mais, cursor = consultar_delta(query, Mensagem.data_recebimento, Mensagem.id, desde, PAGINA_MAXIMA)
+        # A janela relida muda o conteúdo sem mudar os máximos: o ETag vem do próprio delta.
+        delta = {"itens": [serializar_mensagem(m) for m in linhas], "desde": cursor, "mais": mais}
+        return com_etag(delta, lambda: jsonify(delta))
+
+    if limite is None:
+        # Formato antigo: as 200 mais recentes, em uma lista.
+        linhas = paginar(query, Mensagem.data_recebimento, Mensagem.id, None, None).limit(PAGINA_PADRAO)
+        return com_etag(versao, lambda: resposta_em_fluxo(linhas, serializar_mensagem))
+    return com_etag(versao, lambda: resposta_em_fluxo(
+        paginar(query, Mensagem.data_recebimento, Mensagem.id, limite, cursor), serializar_mensagem, limite))
 
 @app.route('/stats', methods=['GET'])
 def get_stats():
+    """Estatísticas servidas do cache (STATS_TTL_S), montadas a partir de `contadores`."""
     with app.app_context():
         try:
-            total_cadastros = db.session.query(Cadastro).count()
-            query = text("SELECT pg_database_size(current_database())")
-            tamanho_bytes = db.session.execute(query).scalar() or 0
-            tamanho_mb = f"{tamanho_bytes / (1024 * 1024):.2f} MB"
-            return jsonify({"total_cadastros": total_cadastros, "db_size": tamanho_mb})
+            estatisticas = obter_estatisticas()
+            return com_etag(estatisticas["atualizado_em"], lambda: jsonify(estatisticas))
         except Exception as e:
-            print(f"Erro ao buscar stats: {e}")
+            logger.exception("Erro ao buscar stats: %s", e)
             return jsonify({"total_cadastros": "N/A", "db_size": "N/A"})
 
 @app.route('/promover_reclamacao', methods=['POST'])
@@ -384,48 +3287,348 @@ def promover_reclamacao():
             )
             db.session.add(nova_reclamacao)
             db.session.delete(mensagem_a_promover)
+            incrementar_contadores({"mensagens": -1, "reclamacoes:status:Registrada": 1})
             db.session.commit()
+            invalidar_estatisticas()
+            publicar_evento("reclamacao_nova", {"id": nova_reclamacao.id, "mensagem_id": mensagem_id})
             return jsonify({"status": "success"})
     return jsonify({"status": "error", "message": "Mensagem não encontrada"}), 404
 
 @app.route('/media/<media_id>')
 def get_media(media_id):
+    """
+    Serve do cache em disco (com ETag, Cache-Control e Range); na primeira vez,
+    repassa o download da Graph API em blocos enquanto o grava no cache.
+    """
+    if not MEDIA_ID_VALIDO.match(media_id): return "Mídia inválida", 400
+    indice = ler_indice_midia(media_id)
+    if indice:
+        with trava_cache_midia:
+            cache_midia_status["acertos"] += 1
+        resposta = send_file(indice["caminho"], mimetype=indice["content_type"], conditional=True,
+                             etag=indice["sha256"], max_age=MEDIA_CACHE_MAX_AGE_S)
+        resposta.cache_control.public = False
+        resposta.cache_control.private = True
+        return resposta
+
     if not META_ACCESS_TOKEN: return "Token de acesso não configurado", 500
-    url_info = f"https://graph.facebook.com/v19.0/{media_id}/"
-    headers = {"Authorization": f"Bearer {META_ACCESS_TOKEN}"}
     try:
-        info_response = requests.get(url_info, headers=headers)
-        info_response.raise_for_status()
-        media_url = info_response.json()['url']
-        media_response = requests.get(media_url, headers=headers)
-        media_response.raise_for_status()
-        return Response(media_response.content, content_type=media_response.headers['Content-Type'])
-    except requests.exceptions.RequestException as e:
-        print(f"Erro ao buscar mídia {media_id}: {e}")
-        return "Erro ao buscar mídia", 500
+        info, media_response = abrir_download_midia(media_id)
+    except ErroGraph as e:
+        logger.warning("Erro ao buscar mídia %s: %s", media_id, e)
+        return "Erro ao buscar mídia", 503 if e.tipo == "disjuntor" else 500
+    content_type = media_response.headers.get('Content-Type') or info.get('mime_type') or 'application/octet-stream'
+    headers = {"Cache-Control": "private, no-cache"}
+    if media_response.headers.get('Content-Length') and not media_response.headers.get('Content-Encoding'):
+        headers["Content-Length"] = media_response.headers['Content-Length']
+    return Response(stream_with_context(gravar_midia_em_cache(media_id, media_response, content_type)),
+                    content_type=content_type, headers=headers)
+
+@app.route('/media/<media_id>/thumb')
+def get_media_thumb(media_id):
+    """Miniatura JPEG da mídia; gerada na hora se o pipeline ainda não a produziu."""
+    if not MEDIA_ID_VALIDO.match(media_id): return "Mídia inválida", 400
+    indice = ler_indice_midia(media_id)
+    caminho = caminho_miniatura(indice["sha256"]) if indice else None
+    if not (caminho and os.path.exists(caminho)):
+        if indice is None and not META_ACCESS_TOKEN: return "Token de acesso não configurado", 500
+        try:
+            caminho = gerar_miniatura(media_id)
+        except ErroGraph as e:
+            logger.warning("Erro ao buscar mídia %s: %s", media_id, e)
+            return "Erro ao buscar mídia", 503 if e.tipo == "disjuntor" else 500
+        except Exception as e:
+            logger.error("Erro ao gerar miniatura da mídia %s: %s", media_id, e)
+            caminho = None
+        if caminho is None: return "Miniatura indisponível para esta mídia", 404
+    resposta = send_file(caminho, mimetype="image/jpeg", conditional=True, max_age=MEDIA_CACHE_MAX_AGE_S)
+    resposta.cache_control.public = False
+    resposta.cache_control.private = True
+    return resposta
 
 @app.route('/participantes', methods=['GET'])
-def get_participantes(): return jsonify(list(db_participantes_sorteio.values()))
+def get_participantes():
+    since = request.args.get('since')
+    if since is None:
+        atualizar_cache_participantes()
+        return com_etag((len(db_participantes_sorteio), cache_participantes["versao"]),
+                        lambda: jsonify(list(db_participantes_sorteio.values())))
+    # O ponto tem duas partes, "<cursor dos registros>~<data dos nomes>": a segunda
+    # acompanha Contato.ultima_mensagem_em, que avança quando o contato escreve (e
+    # pode trazer um nome novo), com a mesma janela de releitura dos registros.
+    cursor_registros, _, nomes_texto = since.partition("~")
+    try:
+        desde = ler_desde(cursor_registros, Participante.data_criacao, Participante.id)
+        nomes_desde = datetime.fromisoformat(nomes_texto) if nomes_texto else None
+    except ValueError:
+        return jsonify({"status": "error", "message": "Parâmetro 'since' inválido."}), 400
+    limite = PAGINA_MAXIMA * 10
+    renomeados = []
+    if nomes_desde is None:
+        # Primeira leitura: os nomes já vêm atuais; acompanha a partir do mais recente.
+        nomes_desde = db.session.query(db.func.max(Contato.ultima_mensagem_em)).scalar()
+    else:
+        renomeados = (consulta_participantes().add_columns(Contato.ultima_mensagem_em)
+                      .filter(Contato.ultima_mensagem_em >= nomes_desde - timedelta(seconds=DELTA_JANELA_S))
+                      .order_by(Contato.ultima_mensagem_em).limit(limite).all())
+        nomes_desde = max([nomes_desde] + [linha.ultima_mensagem_em for linha in renomeados])
+    consulta = consulta_participantes().add_columns(Participante.data_criacao)
+    linhas, mais, cursor = consultar_delta(consulta, Participante.data_criacao, Participante.id, desde, limite)
+    por_id = {id_participante: {"id": id_participante, "nome": nome or f"Pessoa ({telefone[-4:]})", "telefone": telefone}
+              for id_participante, telefone, nome, _ in list(renomeados) + linhas}
+    if nomes_desde is not None:
+        cursor = f"{cursor}~{nomes_desde.isoformat()}"
+    # Quando "versao" muda (mescla, backfill), o painel descarta a lista e recarrega.
+    delta = {"itens": sorted(por_id.values(), key=lambda p: p["id"]), "desde": cursor,
+             "mais": mais or len(renomeados) == limite, "versao": versao_registro_participantes()}
+    return com_etag(delta, lambda: jsonify(delta))
+
+def ler_desde_reclamacoes(since):
+    """Cursor (atualizado_em, id); uma data ISO pura (formato antigo) vale como (data, 0)."""
+    if not since or since == "0": return None, 0
+    try:
+        return datetime.fromisoformat(since), 0
+    except ValueError:
+        return decodificar_cursor(since)
 
 @app.route('/reclamacoes', methods=['GET'])
 def get_reclamacoes():
-    reclamacoes_db = Reclamacao.query.order_by(Reclamacao.timestamp.desc()).all()
-    return jsonify([{
-        "id": r.id, "nome": r.nome, "telefone": r.telefone, "texto": r.texto,
-        "status": r.status, "media_id": r.media_id, "media_type": r.media_type,
-        "timestamp": r.timestamp.isoformat()
-    } for r in reclamacoes_db])
+    try:
+        limite, cursor = ler_paginacao()
+    except ValueError:
+        return jsonify({"status": "error", "message": "Parâmetros de paginação inválidos."}), 400
+    query = db.session.query(
+        Reclamacao.id, Reclamacao.nome, Reclamacao.telefone, Reclamacao.texto, Reclamacao.status,
+        Reclamacao.media_id, Reclamacao.media_type, Reclamacao.timestamp, Reclamacao.atualizado_em
+    )
+    versao = db.session.query(db.func.max(Reclamacao.atualizado_em), db.func.count(Reclamacao.id)).one()
+
+    since = request.args.get('since')
+    if since is not None:
+        try:
+            desde = ler_desde_reclamacoes(since)
+        except ValueError:
+            return jsonify({"status": "error", "message": "Parâmetro 'since' inválido."}), 400
+        def gerar_delta():
+            linhas, mais, cursor = consultar_delta_por_data(query, Reclamacao.atualizado_em, Reclamacao.id,
+                                                            desde, PAGINA_MAXIMA)
+            return jsonify({"itens": [serializar_reclamacao(r) for r in linhas], "desde": cursor,
+                            "mais": mais, "total": versao[1]})
+        return com_etag(tuple(versao), gerar_delta)
+
+    return com_etag(tuple(versao), lambda: resposta_em_fluxo(
+        paginar(query, Reclamacao.timestamp, Reclamacao.id, limite, cursor), serializar_reclamacao, limite))
 
 @app.route('/reclamacoes/<int:id>/status', methods=['POST'])
 def update_reclamacao_status(id):
     with app.app_context():
         reclamacao = Reclamacao.query.get(id)
         if reclamacao:
-            reclamacao.status = request.json.get('status')
+            status_anterior, novo_status = reclamacao.status or 'Registrada', (request.json or {}).get('status')
+            if not novo_status:
+                return jsonify({'status': "error", 'message': "Informe o novo 'status'."}), 400
+            reclamacao.status = novo_status
+            if novo_status != status_anterior:
+                incrementar_contadores({f"reclamacoes:status:{status_anterior}": -1, f"reclamacoes:status:{novo_status}": 1})
             db.session.commit()
+            invalidar_estatisticas()
+            publicar_evento("reclamacao_status", {"id": id, "status": reclamacao.status})
             return jsonify({"status": "success"})
     return jsonify({'status': "error", 'message': 'Reclamação não encontrada'}), 404
 
+# --- Sorteio ---
+# O sorteio roda no servidor direto sobre a tabela `participantes`, ordenada por id,
+# num snapshot único da requisição (REPEATABLE READ no Postgres): a contagem, o maior
+# id, o hash e os vencedores saem todos da mesma lista, que é a registrada. Os
+# números vêm de um gerador determinístico HMAC-SHA256(semente, contador) com
+# rejeição (sem viés de módulo); a semente sai de `secrets`.
+#
+# No algoritmo v2 cada número é um id em [1, maior id], lido pela chave primária;
+# ids que não existem (apagados por mesclas) são descartados e sorteia-se outro. Uma
+# escolha custa em média maior_id / total leituras por índice: ~1 com o registro
+# denso, mais à medida que as mesclas abrem buracos. O v1 sorteava uma posição e a
+# lia com OFFSET k, que custa k linhas por escolha; fica só para conferir os
+# sorteios gravados com ele.
+#
+# Com a semente, o hash da lista, as exclusões e a versão do registro gravados em
+# `sorteios`, qualquer sorteio pode ser refeito e conferido em /sorteio/<id>/verificar
+# enquanto o registro não for reescrito. Mesclas e normalizações de telefones mudam
+# a lista (e incrementam "participantes:versao"); depois delas a conferência informa
+# que o sorteio não pode mais ser refeito, em vez de acusar divergência.
+SORTEIO_ALGORITMO = "hmac-sha256-v2"
+SORTEIO_MAX_VENCEDORES = int(os.getenv("SORTEIO_MAX_VENCEDORES", "100"))
+SORTEIO_AMOSTRA = 24
+
+def abrir_instantaneo_sorteio():
+    """Fixa um snapshot para o resto da transação; precisa vir antes de qualquer consulta dela."""
+    if db.engine.dialect.name == 'postgresql':
+        db.session.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+
+def hash_lista_sorteio(maior_id):
+    """sha256 de "id:telefone" dos participantes até `maior_id`, um por linha, em ordem de id."""
+    if db.engine.dialect.name == 'postgresql':
+        return db.session.execute(text(
+            "SELECT encode(sha256(convert_to(COALESCE(string_agg(id || ':' || telefone, E'\\n' ORDER BY id), ''), 'UTF8')), 'hex') "
+            "FROM participantes WHERE id <= :maior"
+        ), {"maior": maior_id}).scalar()
+    hash_lista, separador = hashlib.sha256(), b""
+    for id_participante, telefone in (db.session.query(Participante.id, Participante.telefone)
+                                      .filter(Participante.id <= maior_id).order_by(Participante.id).yield_per(5000)):
+        hash_lista.update(separador + f"{id_participante}:{telefone}".encode())
+        separador = b"\n"
+    return hash_lista.hexdigest()
+
+def participante_sorteado(linha):
+    id_participante, telefone, nome = linha
+    return {"id": id_participante, "nome": nome or f"Pessoa ({telefone[-4:]})", "telefone": telefone}
+
+def buscador_por_posicao(maior_id):
+    """v1: função posição -> participante (na ordem por id, até `maior_id`), via OFFSET."""
+    consulta = consulta_participantes().filter(Participante.id <= maior_id).order_by(Participante.id)
+    return lambda indice: participante_sorteado(consulta.offset(indice).limit(1).one())
+
+def buscador_por_id(maior_id):
+    """v2: função k -> participante de id k + 1 (até `maior_id`), ou None se o id não existe."""
+    def buscar(indice):
+        linha = consulta_participantes().filter(Participante.id == indice + 1, Participante.id <= maior_id).first()
+        return participante_sorteado(linha) if linha else None
+    return buscar
+
+def preparar_sorteio(algoritmo, total, maior_id):
+    """(limite do gerador, função de busca) do algoritmo gravado no sorteio."""
+    if algoritmo == "hmac-sha256-v1":
+        return total, buscador_por_posicao(maior_id)
+    return maior_id, buscador_por_id(maior_id)
+
+def contar_excluidos_presentes(maior_id, excluidos):
+    excluidos, presentes = sorted(excluidos), 0
+    for i in range(0, len(excluidos), 1000):
+        presentes += (db.session.query(db.func.count(Participante.id))
+                      .filter(Participante.id <= maior_id, Participante.telefone.in_(excluidos[i:i + 1000])).scalar() or 0)
+    return presentes
+
+def gerador_sorteio(semente):
+    """Inteiros uniformes em [0, limite) a partir de HMAC-SHA256(semente, contador)."""
+    chave, contador = bytes.fromhex(semente), 0
+
+    def proximo(limite):
+        nonlocal contador
+        teto = (1 << 256) - (1 << 256) % limite
+        while True:
+            valor = int.from_bytes(hmac.new(chave, str(contador).encode(), hashlib.sha256).digest(), "big")
+            contador += 1
+            if valor < teto:
+                return valor % limite
+    return proximo
+
+def sortear_vencedores(limite, buscar, semente, quantidade, excluidos):
+    """
+    Sorteia índices em [0, limite) e descarta repetidos, excluídos e os que `buscar`
+    não encontra (None). `buscar(indice)` devolve o participante daquele índice;
+    `quantidade` não pode passar do número de elegíveis.
+    """
+    proximo, escolhidos, vencedores = gerador_sorteio(semente), set(), []
+    while len(vencedores) < quantidade:
+        indice = proximo(limite)
+        if indice in escolhidos: continue
+        escolhidos.add(indice)
+        participante = buscar(indice)
+        if participante is None or participante["telefone"] in excluidos: continue
+        vencedores.append({"posicao": len(vencedores) + 1, "id": participante["id"],
+                           "nome": participante["nome"], "telefone": participante["telefone"]})
+    return vencedores
+
+def vencedores_anteriores(dias=None):
+    consulta = db.session.query(Sorteio.vencedores)
+    if dias:
+        consulta = consulta.filter(Sorteio.realizado_em >= agora_local() - timedelta(days=dias))
+    return {v["telefone"] for (vencedores,) in consulta for v in json.loads(vencedores)}
+
+@app.route('/sorteio', methods=['GET', 'POST'])
+def sorteio():
+    """
+    POST sorteia. Corpo (todos opcionais): quantidade, excluir (telefones),
+    excluir_vencedores_anteriores (bool) e dias (janela dessa regra). GET lista os
+    últimos sorteios.
+    """
+    if request.method == 'GET':
+        sorteios = Sorteio.query.order_by(Sorteio.id.desc()).limit(50).all()
+        return jsonify([serializar_sorteio(s) for s in sorteios])
+
+    abrir_instantaneo_sorteio()
+    data = request.get_json(silent=True) or {}
+    try:
+        quantidade = int(data.get('quantidade', 1))
+        dias = int(data['dias']) if data.get('dias') else None
+    except (TypeError, ValueError):
+        return jsonify({"status": "error", "message": "Parâmetros 'quantidade'/'dias' inválidos."}), 400
+    if not 1 <= quantidade <= SORTEIO_MAX_VENCEDORES:
+        return jsonify({"status": "error", "message": f"A quantidade deve estar entre 1 e {SORTEIO_MAX_VENCEDORES}."}), 400
+
+    excluidos = {formatar_numero_br(str(t)) for t in data.get('excluir') or []}
+    if data.get('excluir_vencedores_anteriores'):
+        excluidos |= vencedores_anteriores(dias)
+    total, maior_id = db.session.query(db.func.count(Participante.id), db.func.max(Participante.id)).one()
+    if not total:
+        return jsonify({"status": "error", "message": "Nenhum participante para sortear."}), 400
+
+    elegiveis = total - contar_excluidos_presentes(maior_id, excluidos)
+    if elegiveis <= 0:
+        return jsonify({"status": "error", "message": "Todos os participantes foram excluídos."}), 400
+
+    semente = secrets.token_hex(32)
+    limite, buscar = preparar_sorteio(SORTEIO_ALGORITMO, total, maior_id)
+    vencedores = sortear_vencedores(limite, buscar, semente, min(quantidade, elegiveis), excluidos)
+    # Só para a animação do painel: alguns nomes a partir de um id ao acaso, sem relação com o resultado.
+    amostra = [nome or f"Pessoa ({telefone[-4:]})" for _, telefone, nome in consulta_participantes()
+               .filter(Participante.id >= random.randint(1, maior_id)).order_by(Participante.id).limit(SORTEIO_AMOSTRA)]
+    registro = Sorteio(algoritmo=SORTEIO_ALGORITMO, semente=semente, total_participantes=total,
+                       maior_participante_id=maior_id, hash_participantes=hash_lista_sorteio(maior_id), quantidade=quantidade,
+                       excluidos=json.dumps(sorted(excluidos)), vencedores=json.dumps(vencedores),
+                       versao_registro=versao_registro_participantes())
+    db.session.add(registro)
+    db.session.commit()
+    return jsonify({**serializar_sorteio(registro), "amostra": amostra})
+
+@app.route('/sorteio/<int:sorteio_id>/verificar', methods=['GET'])
+def verificar_sorteio(sorteio_id):
+    """
+    Refaz o sorteio com a semente gravada sobre os participantes atuais até o maior
+    id registrado. Se a lista mudou e o registro foi reescrito por manutenção depois
+    do sorteio, responde `verificavel: false` em vez de acusar divergência.
+    """
+    abrir_instantaneo_sorteio()
+    registro = db.session.get(Sorteio, sorteio_id)
+    if registro is None:
+        return jsonify({"status": "error", "message": "Sorteio não encontrado."}), 404
+    maior_id = registro.maior_participante_id
+    hash_confere = hash_lista_sorteio(maior_id) == registro.hash_participantes
+    originais = json.loads(registro.vencedores)
+    # Sorteios anteriores à migração 8 não têm a versão: qualquer manutenção conta.
+    if not hash_confere and versao_registro_participantes() != (registro.versao_registro or 0):
+        return jsonify({"id": registro.id, "hash_confere": False, "vencedores_conferem": None, "valido": None,
+                        "verificavel": False, "vencedores": originais,
+                        "motivo": "O registro de participantes foi reescrito (mescla ou normalização de telefones) "
+                                  "depois do sorteio; a lista sorteada não pode mais ser refeita."})
+    excluidos = set(json.loads(registro.excluidos))
+    total = db.session.query(db.func.count(Participante.id)).filter(Participante.id <= maior_id).scalar() or 0
+    elegiveis = total - contar_excluidos_presentes(maior_id, excluidos)
+    limite, buscar = preparar_sorteio(registro.algoritmo, total, maior_id)
+    refeitos = (sortear_vencedores(limite, buscar, registro.semente, len(originais), excluidos)
+                if total and elegiveis >= len(originais) else [])
+    vencedores_conferem = [v["id"] for v in refeitos] == [v["id"] for v in originais]
+    return jsonify({"id": registro.id, "hash_confere": hash_confere, "vencedores_conferem": vencedores_conferem,
+                    "valido": hash_confere and vencedores_conferem, "verificavel": True})
+
+def serializar_sorteio(registro):
+    return {
+        "id": registro.id, "realizado_em": registro.realizado_em.isoformat(), "algoritmo": registro.algoritmo,
+        "semente": registro.semente, "total_participantes": registro.total_participantes,
+        "maior_participante_id": registro.maior_participante_id, "hash_participantes": registro.hash_participantes,
+        "quantidade": registro.quantidade, "excluidos": len(json.loads(registro.excluidos)),
+        "vencedores": json.loads(registro.vencedores)
+    }
+
 # --- Interface Visual (Painel HTML) ---
 HTML_TEMPLATE = """
 <!DOCTYPE html>
@@ -439,17 +3642,20 @@ HTML_TEMPLATE = """
             <div class="space-y-1 text-left">
                 <p><span class="font-semibold">Contatos:</span> <span id="stats-total-cadastros-header">0</span></p>
                 <p><span class="font-semibold">Uso DB:</span> <span id="stats-db-size-header">0 MB</span></p>
+                <p><span class="font-semibold">Msgs (última hora):</span> <span id="stats-msgs-hora-header">0</span></p>
+                <p><span class="font-semibold">Envios (última hora):</span> <span id="stats-envios-hora-header">0</span></p>
             </div>
         </div>
     </header>
 <div class="grid grid-cols-1 lg:grid-cols-4 gap-8">
-    <div class="bg-white p-6 rounded-xl shadow-lg"><h2 class="text-2xl font-bold text-center mb-4 border-b pb-3 text-green-600">Disparo em Massa</h2><div class="space-y-2 text-sm"><div><label for="msg1" class="font-medium">Mensagem 1:</label><textarea id="msg1" rows="3" class="w-full p-1 border rounded"></textarea></div><div><label for="msg2" class="font-medium">Mensagem 2:</label><textarea id="msg2" rows="3" class="w-full p-1 border rounded"></textarea></div><div><label for="msg3" class="font-medium">Mensagem 3:</label><textarea id="msg3" rows="3" class="w-full p-1 border rounded"></textarea></div></div><button id="start-disparo-btn" class="w-full bg-green-600 text-white font-bold py-2 px-4 rounded-lg hover:bg-green-700 transition mt-3 text-sm">Iniciar Disparos</button><button id="stop-disparo-btn" class="w-full bg-red-600 text-white font-bold py-2 px-4 rounded-lg hover:bg-red-700 transition mt-2 text-sm" style="display: none;">Parar Disparos</button><div class="mt-4"><p class="text-center font-semibold">Status: <span id="disparo-progresso">0/0</span></p><div class="log-box" id="disparo-log"><p>Aguardando...</p></div></div></div>
+    <div class="bg-white p-6 rounded-xl shadow-lg"><h2 class="text-2xl font-bold text-center mb-4 border-b pb-3 text-green-600">Disparo em Massa</h2><div class="space-y-2 text-sm"><div><label for="msg1" class="font-medium">Mensagem 1:</label><textarea id="msg1" rows="3" class="w-full p-1 border rounded"></textarea></div><div><label for="msg2" class="font-medium">Mensagem 2:</label><textarea id="msg2" rows="3" class="w-full p-1 border rounded"></textarea></div><div><label for="msg3" class="font-medium">Mensagem 3:</label><textarea id="msg3" rows="3" class="w-full p-1 border rounded"></textarea></div><div><label for="perfil-disparo" class="font-medium">Ritmo:</label><select id="perfil-disparo" class="w-full p-1 border rounded"><option value="conservador">Conservador (lotes com pausas)</option><option value="rapido">Rápido (limite da Cloud API)</option></select></div></div><button id="start-disparo-btn" class="w-full bg-green-600 text-white font-bold py-2 px-4 rounded-lg hover:bg-green-700 transition mt-3 text-sm">Iniciar Disparos</button><button id="stop-disparo-btn" class="w-full bg-red-600 text-white font-bold py-2 px-4 rounded-lg hover:bg-red-700 transition mt-2 text-sm" style="display: none;">Parar Disparos</button><div class="mt-4"><p class="text-center font-semibold">Status: <span id="disparo-progresso">0/0</span></p><div class="log-box" id="disparo-log"><p>Aguardando...</p></div></div></div>
     <div class="bg-white p-6 rounded-xl shadow-lg"><h2 class="text-2xl font-bold text-center mb-4 border-b pb-3 text-cyan-600">Caixa de Entrada</h2>
         <div class="bg-slate-100 p-3 rounded-lg border mb-4"><h3 class="font-semibold text-sm mb-2 text-center">Buscar Mensagens</h3><div class="grid grid-cols-2 gap-2 text-sm"><div><label for="filter-start-date">De:</label><input type="date" id="filter-start-date" class="w-full p-1 border rounded"></div><div><label for="filter-end-date">Até:</label><input type="date" id="filter-end-date" class="w-full p-1 border rounded"></div></div><button id="search-messages-btn" class="w-full bg-blue-600 text-white font-bold py-1 px-2 rounded-lg hover:bg-blue-700 transition mt-2 text-xs">Buscar por Período</button><button id="reset-messages-btn" class="w-full bg-gray-500 text-white font-bold py-1 px-2 rounded-lg hover:bg-gray-600 transition mt-1 text-xs">Ver Últimos 3 Dias</button></div>
-        <div id="messages-list" class="space-y-3 max-h-[600px] overflow-y-auto pr-2"></div>
+        <div id="messages-list" class="max-h-[600px] overflow-y-auto pr-2"></div>
+        <button id="more-messages-btn" class="w-full bg-slate-200 text-slate-700 font-semibold py-1 px-2 rounded-lg hover:bg-slate-300 transition mt-2 text-xs" style="display: none;">Carregar mais</button>
     </div>
-    <div class="bg-white p-6 rounded-xl shadow-lg"><h2 class="text-2xl font-bold text-center mb-4 border-b pb-3 text-indigo-600">Direto no Sorteio</h2><div id="sorteio-container" class="text-center p-4 border-2 border-dashed rounded-lg min-h-[150px] flex items-center justify-center"><div id="winner-display" class="hidden"></div><p id="sorteio-placeholder" class="text-slate-500">Aguardando...</p></div><button id="draw-button" class="w-full bg-indigo-600 text-white font-bold py-3 px-4 rounded-lg hover:bg-indigo-700 mt-4 text-lg shadow-md" disabled>SORTEAR AGORA!</button><div class="mt-6"><h3 class="font-bold text-lg mb-2">Participantes (<span id="participant-count">0</span>)</h3><div class="bg-slate-50 p-3 rounded-lg max-h-60 overflow-y-auto border"><ul id="participants-list" class="space-y-2 text-sm"></ul></div></div></div>
-    <div class="bg-white p-6 rounded-xl shadow-lg"><h2 class="text-2xl font-bold text-center mb-4 border-b pb-3 text-red-600">Fala que Eu Registro</h2><div class="bg-slate-100 p-3 rounded-lg border mb-4"><h3 class="font-semibold text-sm mb-2 text-center">Gerar Relatório</h3><div class="grid grid-cols-2 gap-2 text-sm"><div><label for="filter-date" class="block font-medium">Data:</label><input type="date" id="filter-date" class="w-full p-1 border rounded"></div><div><label for="filter-status" class="block font-medium">Status:</label><select id="filter-status" class="w-full p-1 border rounded"><option value="todos">Todos</option><option value="Registrada">Registrada</option><option value="Em Análise">Em Análise</option><option value="Solucionada">Solucionada</option><option value="Sem Solução">Sem Solução</option></select></div></div><button id="print-button" class="w-full bg-gray-600 text-white font-bold py-2 px-4 rounded-lg hover:bg-gray-700 transition mt-3 text-sm">Imprimir Relatório</button></div><div class="bg-slate-50 border rounded-lg p-4 mb-6"><h3 class="font-bold text-lg text-center mb-3">Placar</h3><div class="flex justify-around text-center"><div><p class="text-3xl font-bold" id="registered-count">0</p><p class="text-sm text-slate-500">Registradas</p></div><div><p class="text-3xl font-bold text-green-600" id="solved-count">0</p><p class="text-sm text-slate-500">Solucionadas</p></div></div></div><div id="complaints-list" class="space-y-3 max-h-96 overflow-y-auto pr-2"></div></div>
+    <div class="bg-white p-6 rounded-xl shadow-lg"><h2 class="text-2xl font-bold text-center mb-4 border-b pb-3 text-indigo-600">Direto no Sorteio</h2><div id="sorteio-container" class="text-center p-4 border-2 border-dashed rounded-lg min-h-[150px] flex items-center justify-center"><div id="winner-display" class="hidden"></div><p id="sorteio-placeholder" class="text-slate-500">Aguardando...</p></div><div class="flex items-center justify-between gap-2 mt-3 text-sm"><label for="sorteio-quantidade" class="font-medium">Vencedores:</label><input type="number" id="sorteio-quantidade" min="1" max="100" value="1" class="w-16 p-1 border rounded"><label class="flex items-center gap-1"><input type="checkbox" id="sorteio-excluir-anteriores"> Excluir já sorteados</label></div><button id="draw-button" class="w-full bg-indigo-600 text-white font-bold py-3 px-4 rounded-lg hover:bg-indigo-700 mt-4 text-lg shadow-md" disabled>SORTEAR AGORA!</button><div class="mt-6"><h3 class="font-bold text-lg mb-2">Participantes (<span id="participant-count">0</span>)</h3><ul id="participants-list" class="bg-slate-50 p-3 rounded-lg max-h-60 overflow-y-auto border text-sm"></ul></div></div>
+    <div class="bg-white p-6 rounded-xl shadow-lg"><h2 class="text-2xl font-bold text-center mb-4 border-b pb-3 text-red-600">Fala que Eu Registro</h2><div class="bg-slate-100 p-3 rounded-lg border mb-4"><h3 class="font-semibold text-sm mb-2 text-center">Gerar Relatório</h3><div class="grid grid-cols-2 gap-2 text-sm"><div><label for="filter-date" class="block font-medium">Data:</label><input type="date" id="filter-date" class="w-full p-1 border rounded"></div><div><label for="filter-status" class="block font-medium">Status:</label><select id="filter-status" class="w-full p-1 border rounded"><option value="todos">Todos</option><option value="Registrada">Registrada</option><option value="Em Análise">Em Análise</option><option value="Solucionada">Solucionada</option><option value="Sem Solução">Sem Solução</option></select></div></div><button id="print-button" class="w-full bg-gray-600 text-white font-bold py-2 px-4 rounded-lg hover:bg-gray-700 transition mt-3 text-sm">Imprimir Relatório</button></div><div class="bg-slate-50 border rounded-lg p-4 mb-6"><h3 class="font-bold text-lg text-center mb-3">Placar</h3><div class="flex justify-around text-center"><div><p class="text-3xl font-bold" id="registered-count">0</p><p class="text-sm text-slate-500">Registradas</p></div><div><p class="text-3xl font-bold text-green-600" id="solved-count">0</p><p class="text-sm text-slate-500">Solucionadas</p></div></div></div><div id="complaints-list" class="max-h-96 overflow-y-auto pr-2"></div></div>
 </div></div>
 <script>
 document.addEventListener('DOMContentLoaded', () => {
@@ -474,66 +3680,292 @@ document.addEventListener('DOMContentLoaded', () => {
     const msg1 = document.getElementById('msg1');
     const msg2 = document.getElementById('msg2');
     const msg3 = document.getElementById('msg3');
+    const perfilDisparo = document.getElementById('perfil-disparo');
     const statsTotalCadastros = document.getElementById('stats-total-cadastros-header');
     const statsDbSize = document.getElementById('stats-db-size-header');
+    const statsMsgsHora = document.getElementById('stats-msgs-hora-header');
+    const statsEnviosHora = document.getElementById('stats-envios-hora-header');
     const searchMessagesBtn = document.getElementById('search-messages-btn');
     const resetMessagesBtn = document.getElementById('reset-messages-btn');
     const filterStartDate = document.getElementById('filter-start-date');
     const filterEndDate = document.getElementById('filter-end-date');
+    const moreMessagesBtn = document.getElementById('more-messages-btn');
+
+    // Lista virtual: só os itens visíveis (mais uma margem) ficam no DOM; o espaço dos
+    // demais vira altura nos espaçadores de cima e de baixo. Os nós são reaproveitados
+    // pela chave e só são refeitos quando o item muda, então o custo de cada
+    // atualização não depende do tamanho da lista.
+    function criarListaVirtual(container, { chave, criar, alturaEstimada, classeItem, vazio }) {
+        const tagItem = container.tagName === 'UL' ? 'li' : 'div';
+        const topo = document.createElement(tagItem);
+        const fundo = document.createElement(tagItem);
+        const aviso = document.createElement(tagItem);
+        aviso.className = 'text-slate-400 text-center';
+        aviso.textContent = vazio;
+        container.replaceChildren(topo, fundo);
+        let itens = [];
+        let posicoes = [0];
+        let posicoesSujas = true;
+        let agendado = false;
+        const alturas = new Map();
+        const nos = new Map();
+
+        function recalcularPosicoes() {
+            posicoes = new Array(itens.length + 1);
+            posicoes[0] = 0;
+            itens.forEach((item, i) => { posicoes[i + 1] = posicoes[i] + (alturas.get(chave(item)) ?? alturaEstimada); });
+            posicoesSujas = false;
+        }
+
+        // Primeiro índice cujo fim passa de `y` (busca binária nas posições acumuladas).
+        function indiceEm(y) {
+            let baixo = 0, alto = itens.length;
+            while (baixo < alto) {
+                const meio = (baixo + alto) >> 1;
+                if (posicoes[meio + 1] <= y) baixo = meio + 1; else alto = meio;
+            }
+            return baixo;
+        }
+
+        function desenhar() {
+            agendado = false;
+            if (itens.length === 0) {
+                nos.clear();
+                container.replaceChildren(aviso);
+                return;
+            }
+            if (aviso.isConnected) container.replaceChildren(topo, fundo);
+            if (posicoesSujas) recalcularPosicoes();
+            const visivel = Math.max(container.clientHeight, 600);
+            const inicio = indiceEm(Math.max(container.scrollTop - visivel / 2, 0));
+            const fim = Math.min(indiceEm(container.scrollTop + visivel * 1.5) + 1, itens.length);
+
+            const visiveis = new Set();
+            let referencia = topo.nextSibling;
+            for (let i = inicio; i < fim; i++) {
+                const item = itens[i];
+                const k = chave(item);
+                const assinatura = JSON.stringify(item);
+                visiveis.add(k);
+                let no = nos.get(k);
+                if (!no || no.assinatura !== assinatura) {
+                    const el = document.createElement(tagItem);
+                    el.className = classeItem;
+                    el.appendChild(criar(item));
+                    if (no) {
+                        // O nó antigo pode ser a própria referência: ela passa a ser o substituto.
+                        if (no.el === referencia) referencia = el;
+                        no.el.replaceWith(el);
+                    }
+                    no = { el, assinatura };
+                    nos.set(k, no);
+                }
+                if (no.el === referencia) referencia = referencia.nextSibling;
+                else container.insertBefore(no.el, referencia);
+            }
+            for (const [k, no] of nos) {
+                if (!visiveis.has(k)) { no.el.remove(); nos.delete(k); }
+            }
+
+            let mudou = false;
+            visiveis.forEach(k => {
+                const altura = nos.get(k).el.offsetHeight;
+                if (altura && alturas.get(k) !== altura) { alturas.set(k, altura); mudou = true; }
+            });
+            if (mudou) recalcularPosicoes();
+            topo.style.height = `${posicoes[inicio]}px`;
+            fundo.style.height = `${posicoes[itens.length] - posicoes[fim]}px`;
+        }
+
+        function agendarDesenho() {
+            if (agendado) return;
+            agendado = true;
+            requestAnimationFrame(desenhar);
+        }
+
+        container.addEventListener('scroll', agendarDesenho, { passive: true });
+        // Imagens (lazy) mudam a altura do card quando carregam: remede na próxima pintura.
+        container.addEventListener('load', agendarDesenho, true);
+        return {
+            definir(novos) {
+                itens = novos;
+                posicoesSujas = true;
+                agendarDesenho();
+            },
+            redesenhar: agendarDesenho
+        };
+    }
+
+    const listaMensagens = criarListaVirtual(messagesList, {
+        chave: m => m.id, criar: m => criarCardMensagem(m), alturaEstimada: 120, classeItem: 'pb-3',
+        vazio: 'Nenhuma mensagem encontrada.'
+    });
+    const listaParticipantes = criarListaVirtual(participantsList, {
+        chave: p => p.telefone, criar: p => criarItemParticipante(p), alturaEstimada: 46, classeItem: 'pb-2',
+        vazio: 'Nenhum participante.'
+    });
+    const listaReclamacoes = criarListaVirtual(complaintsList, {
+        chave: r => r.id, criar: r => criarCardReclamacao(r), alturaEstimada: 110, classeItem: 'pb-3',
+        vazio: 'Nenhuma reclamação com os filtros.'
+    });
 
+    let mensagensCache = [];
     let reclamacoesCache = [];
     let participantesCache = [];
+    let desdeParticipantes = '0';
+    let versaoParticipantes = null;
+    let desdeReclamacoes = '0';
+    let desdeMensagens = '0';
+    let primeiraCarga = true;
+    const etags = {};
+
+    // Busca incremental: reenvia o ETag da última resposta da mesma URL e recebe
+    // null quando o servidor responde 304 (nada mudou).
+    async function buscarComEtag(chave, url) {
+        const anterior = etags[chave];
+        const headers = (anterior && anterior.url === url) ? { 'If-None-Match': anterior.etag } : {};
+        const res = await fetch(url, { headers });
+        if (res.status === 304) return null;
+        const etag = res.headers.get('ETag');
+        if (etag) etags[chave] = { url, etag };
+        return res.json();
+    }
 
     async function fetchMainData() {
         try {
-            const [pRes, rRes] = await Promise.all([
-                fetch(`${API_URL}/participantes`), fetch(`${API_URL}/reclamacoes`)
+            const [pDelta, rDelta] = await Promise.all([
+                buscarComEtag('participantes', `${API_URL}/participantes?since=${encodeURIComponent(desdeParticipantes)}`),
+                buscarComEtag('reclamacoes', `${API_URL}/reclamacoes?since=${encodeURIComponent(desdeReclamacoes)}`)
             ]);
-            participantesCache = await pRes.json();
-            reclamacoesCache = await rRes.json();
-            renderizarParticipantes(participantesCache);
-            renderizarReclamacoes();
-            atualizarPlacar(reclamacoesCache);
+            // Participantes mesclados ou renomeados em lote: o delta não cobre, recarrega tudo.
+            const recarregarParticipantes = pDelta && versaoParticipantes !== null && pDelta.versao !== versaoParticipantes;
+            if (pDelta) versaoParticipantes = pDelta.versao;
+            if (recarregarParticipantes) {
+                participantesCache = []; desdeParticipantes = '0';
+            } else if (pDelta) {
+                if (pDelta.itens.length || primeiraCarga || desdeParticipantes === '0') {
+                    // O delta relê uma janela já entregue: mescla por id em vez de concatenar.
+                    const porId = new Map(participantesCache.map(p => [p.id, p]));
+                    pDelta.itens.forEach(p => porId.set(p.id, p));
+                    participantesCache = Array.from(porId.values());
+                    renderizarParticipantes(participantesCache);
+                }
+                desdeParticipantes = pDelta.desde;
+            }
+            if (rDelta && (rDelta.itens.length || primeiraCarga)) {
+                const porId = new Map(reclamacoesCache.map(r => [r.id, r]));
+                rDelta.itens.forEach(r => porId.set(r.id, r));
+                // Ordena só quando chega algo novo, não a cada desenho (timestamps ISO comparam como texto).
+                reclamacoesCache = Array.from(porId.values())
+                    .sort((a, b) => (b.timestamp || '').localeCompare(a.timestamp || ''));
+                desdeReclamacoes = rDelta.desde;
+                renderizarReclamacoes();
+                atualizarPlacar(reclamacoesCache);
+            }
+            // Reclamações removidas no servidor não aparecem no delta: recarrega tudo.
+            if (rDelta && rDelta.total < reclamacoesCache.length) {
+                reclamacoesCache = []; desdeReclamacoes = '0';
+                return fetchMainData();
+            }
+            primeiraCarga = false;
+            // Registro grande (ou recarga): busca os lotes seguintes sem esperar o próximo ciclo.
+            if (recarregarParticipantes || (pDelta && pDelta.mais) || (rDelta && rDelta.mais)) return fetchMainData();
         } catch (error) { console.error("Erro ao buscar dados principais:", error); }
     }
     
-    async function fetchMessages(startDate = null, endDate = null) {
-        let url = `${API_URL}/mensagens`;
-        if (startDate && endDate) {
-            url += `?start_date=${startDate}&end_date=${endDate}`;
+    let filtroMensagens = '';
+    let proximoCursorMensagens = null;
+
+    async function fetchMessages(startDate = null, endDate = null, cursor = null) {
+        if (cursor === null) {
+            filtroMensagens = (startDate && endDate) ? `&start_date=${startDate}&end_date=${endDate}` : '';
         }
+        let url = `${API_URL}/mensagens?limit=200${filtroMensagens}`;
+        if (cursor) { url += `&cursor=${encodeURIComponent(cursor)}`; }
         try {
             const mRes = await fetch(url);
-            renderizarMensagens(await mRes.json());
+            const pagina = await mRes.json();
+            proximoCursorMensagens = pagina.proximo_cursor;
+            moreMessagesBtn.style.display = proximoCursorMensagens ? 'block' : 'none';
+            if (cursor === null) {
+                desdeMensagens = String(pagina.itens.reduce((maior, m) => Math.max(maior, m.id), 0));
+            }
+            renderizarMensagens(pagina.itens, cursor !== null);
         } catch (error) { console.error("Erro ao buscar mensagens:", error); }
     }
 
+    // Só as mensagens novas desde a última vista; não se aplica a buscas por período.
+    async function fetchNovasMensagens() {
+        if (filtroMensagens) return;
+        try {
+            const delta = await buscarComEtag('mensagens', `${API_URL}/mensagens?since=${encodeURIComponent(desdeMensagens)}`);
+            if (!delta) return;
+            desdeMensagens = delta.desde;
+            const conhecidas = new Set(mensagensCache.map(m => m.id));
+            const novas = delta.itens.filter(m => !conhecidas.has(m.id));
+            if (novas.length) {
+                mensagensCache = novas.concat(mensagensCache).sort((a, b) => b.id - a.id);
+                listaMensagens.definir(mensagensCache);
+            }
+            if (delta.mais) return fetchNovasMensagens();
+        } catch (error) { console.error("Erro ao buscar mensagens novas:", error); }
+    }
+
     async function fetchStats() {
         try {
             const response = await fetch(`${API_URL}/stats`);
             const stats = await response.json();
             statsTotalCadastros.textContent = stats.total_cadastros;
             statsDbSize.textContent = stats.db_size;
+            statsMsgsHora.textContent = stats.mensagens_ultima_hora ?? '-';
+            statsEnviosHora.textContent = stats.envios_ultima_hora ?? '-';
         } catch (error) { console.error("Erro ao buscar stats:", error); }
     }
     
+    let campanhaLogId = null;
+    let ultimoSeqLog = 0;
+
+    // Busca só as entradas novas do log (after=seq) e as acrescenta ao final da caixa.
     async function fetchDisparoStatus() {
         try {
-            const response = await fetch(`${API_URL}/status_disparo`);
-            const status = await response.json();
-            disparoProgresso.textContent = `${status.progresso}/${status.total}`;
-            disparoLog.innerHTML = status.log.map(l => `<p>${l}</p>`).join('');
-            disparoLog.scrollTop = disparoLog.scrollHeight;
+            const status = await buscarComEtag('status_disparo', `${API_URL}/status_disparo?after=${ultimoSeqLog}`);
+            if (!status) return;
+            disparoProgresso.textContent = `${status.progresso}/${status.total} (${status.ignorados} ignorados)`;
+            if (status.campanha_id !== campanhaLogId || status.ultimo_seq < ultimoSeqLog) {
+                campanhaLogId = status.campanha_id;
+                ultimoSeqLog = 0;
+                disparoLog.innerHTML = '';
+                return fetchDisparoStatus();
+            }
+            if (status.truncado && ultimoSeqLog === 0) {
+                disparoLog.appendChild(linhaLog('(entradas anteriores omitidas)'));
+            }
+            status.log.forEach(e => {
+                const telefone = e.telefone ? ` ${e.telefone}` : '';
+                disparoLog.appendChild(linhaLog(`[${e.momento.slice(11)}]${telefone} ${e.mensagem}`));
+                ultimoSeqLog = e.seq;
+            });
+            while (disparoLog.childElementCount > 500) disparoLog.firstElementChild.remove();
+            if (status.log.length) disparoLog.scrollTop = disparoLog.scrollHeight;
             startDisparoBtn.style.display = status.ativo ? 'none' : 'block';
             stopDisparoBtn.style.display = status.ativo ? 'block' : 'none';
         } catch (error) { console.error("Erro ao buscar status do disparo:", error); }
     }
 
+    function linhaLog(texto) {
+        const p = document.createElement('p');
+        p.textContent = texto;
+        return p;
+    }
+
     function createMediaElement(msg) {
         let contentHtml = `<p class="mt-2 text-sm text-slate-700">${msg.texto}</p>`;
         if (msg.media_id) {
             if (msg.media_type === 'image') {
-                contentHtml = `<img src="/media/${msg.media_id}" class="w-full h-auto rounded mt-2 cursor-pointer" onclick="window.open('/media/${msg.media_id}', '_blank')">`;
+                // Sem miniatura (ex.: servidor sem Pillow), cai para a imagem original (ver tratarErroMiniatura).
+                contentHtml = `<a href="/media/${msg.media_id}" target="_blank" class="block mt-2"><img src="/media/${msg.media_id}/thumb" loading="lazy" data-original="/media/${msg.media_id}" class="w-full h-auto rounded"></a>`;
+            } else if (msg.media_type === 'video') {
+                contentHtml = `<a href="/media/${msg.media_id}" target="_blank" class="relative block mt-2 text-sm text-blue-600 hover:underline"><img src="/media/${msg.media_id}/thumb" loading="lazy" data-sem-miniatura="Ver video" class="w-full h-auto rounded"><span class="absolute inset-0 flex items-center justify-center text-4xl text-white drop-shadow">▶</span></a>`;
             } else {
                 contentHtml = `<div class="mt-2"><a href="/media/${msg.media_id}" target="_blank" class="text-sm text-blue-600 hover:underline">Ver ${msg.media_type}</a></div>`;
             }
@@ -544,34 +3976,46 @@ document.addEventListener('DOMContentLoaded', () => {
         return contentHtml;
     }
 
-    function renderizarMensagens(data) {
-        messagesList.innerHTML = '';
-        if (data.length === 0) {
-            messagesList.innerHTML = '<p class="text-slate-400 text-center">Nenhuma mensagem encontrada.</p>'; return;
+    // Erros de imagem não borbulham: um único ouvinte em captura atende todos os cards.
+    function tratarErroMiniatura(event) {
+        const img = event.target;
+        if (img.tagName !== 'IMG') return;
+        if (img.dataset.original) {
+            const original = img.dataset.original;
+            delete img.dataset.original;
+            img.src = original;
+        } else if (img.dataset.semMiniatura) {
+            img.parentElement.replaceChildren(img.dataset.semMiniatura);
         }
-        data.forEach(msg => {
-            const dataFormatada = new Date(msg.timestamp).toLocaleString('pt-BR');
-            const card = document.createElement('div');
-            card.className = 'p-3 rounded-lg border bg-slate-50';
-            card.innerHTML = `<div><p class="font-bold text-sm">${msg.nome}</p><p class="text-xs text-slate-500">${msg.telefone} - ${dataFormatada}</p></div> ${createMediaElement(msg)} <button data-id="${msg.id}" class="promote-btn w-full text-xs bg-cyan-500 text-white font-semibold py-1 px-2 rounded hover:bg-cyan-600 transition mt-2">Promover para Reclamação</button>`;
-            messagesList.appendChild(card);
-        });
-        addPromoteListeners();
+    }
+
+    function renderizarMensagens(data, anexar = false) {
+        mensagensCache = anexar ? mensagensCache.concat(data) : data;
+        if (!anexar) messagesList.scrollTop = 0;
+        listaMensagens.definir(mensagensCache);
+    }
+
+    function criarCardMensagem(msg) {
+        const dataFormatada = new Date(msg.timestamp).toLocaleString('pt-BR');
+        const card = document.createElement('div');
+        card.className = 'p-3 rounded-lg border bg-slate-50';
+        card.innerHTML = `<div><p class="font-bold text-sm">${msg.nome}</p><p class="text-xs text-slate-500">${msg.telefone} - ${dataFormatada}</p></div> ${createMediaElement(msg)} <button data-id="${msg.id}" class="promote-btn w-full text-xs bg-cyan-500 text-white font-semibold py-1 px-2 rounded hover:bg-cyan-600 transition mt-2">Promover para Reclamação</button>`;
+        return card;
+    }
+
+    function criarItemParticipante(p) {
+        const div = document.createElement('div');
+        div.className = 'bg-white p-2 rounded border border-slate-200';
+        div.textContent = `${p.nome} - ${p.telefone}`;
+        return div;
     }
     
     function renderizarParticipantes(data) {
-        participantsList.innerHTML = '';
         participantCount.textContent = data.length;
+        listaParticipantes.definir(data);
         if (data.length === 0) {
-            participantsList.innerHTML = '<li class="text-slate-400 text-center">Nenhum participante.</li>';
             drawButton.disabled = true; sorteioPlaceholder.textContent = 'Aguardando...';
         } else {
-            data.forEach(p => {
-                const li = document.createElement('li');
-                li.className = 'bg-white p-2 rounded border border-slate-200 roulette-item';
-                li.textContent = `${p.nome} - ${p.telefone}`;
-                participantsList.appendChild(li);
-            });
             drawButton.disabled = false; sorteioPlaceholder.textContent = 'Clique para sortear!';
         }
     }
@@ -586,21 +4030,18 @@ document.addEventListener('DOMContentLoaded', () => {
         });
     }
 
+    const statusColors = { 'Registrada': 'bg-yellow-100', 'Em Análise': 'bg-blue-100', 'Solucionada': 'bg-green-100', 'Sem Solução': 'bg-red-100' };
+
+    function criarCardReclamacao(r) {
+        const card = document.createElement('div');
+        card.className = `p-4 rounded-lg border ${statusColors[r.status]}`;
+        card.innerHTML = `<div class="flex justify-between items-start"><div><p class="font-bold">${r.nome}</p><p class="text-xs text-slate-600">${r.telefone}</p></div><select data-id="${r.id}" class="status-select text-sm rounded border-slate-300 p-1"><option value="Registrada" ${r.status === 'Registrada' ? 'selected' : ''}>Registrada</option><option value="Em Análise" ${r.status === 'Em Análise' ? 'selected' : ''}>Em Análise</option><option value="Solucionada" ${r.status === 'Solucionada' ? 'selected' : ''}>Solucionada</option><option value="Sem Solução" ${r.status === 'Sem Solução' ? 'selected' : ''}>Sem Solução</option></select></div>${createMediaElement(r)}`;
+        return card;
+    }
+
+    // O cache já vem ordenado; aqui só filtra, e a lista virtual redesenha o que estiver visível.
     function renderizarReclamacoes() {
-        const filteredReclamacoes = getFilteredReclamacoes();
-        complaintsList.innerHTML = '';
-        if (filteredReclamacoes.length === 0) {
-            complaintsList.innerHTML = '<p class="text-slate-400 text-center">Nenhuma reclamação com os filtros.</p>'; return;
-        }
-        filteredReclamacoes.sort((a, b) => new Date(b.timestamp) - new Date(a.timestamp));
-        filteredReclamacoes.forEach(r => {
-            const statusColors = { 'Registrada': 'bg-yellow-100', 'Em Análise': 'bg-blue-100', 'Solucionada': 'bg-green-100', 'Sem Solução': 'bg-red-100' };
-            const card = document.createElement('div');
-            card.className = `p-4 rounded-lg border ${statusColors[r.status]}`;
-            card.innerHTML = `<div class="flex justify-between items-start"><div><p class="font-bold">${r.nome}</p><p class="text-xs text-slate-600">${r.telefone}</p></div><select data-id="${r.id}" class="status-select text-sm rounded border-slate-300 p-1"><option value="Registrada" ${r.status === 'Registrada' ? 'selected' : ''}>Registrada</option><option value="Em Análise" ${r.status === 'Em Análise' ? 'selected' : ''}>Em Análise</option><option value="Solucionada" ${r.status === 'Solucionada' ? 'selected' : ''}>Solucionada</option><option value="Sem Solução" ${r.status === 'Sem Solução' ? 'selected' : ''}>Sem Solução</option></select></div>${createMediaElement(r)}`;
-            complaintsList.appendChild(card);
-        });
-        addStatusChangeListeners();
+        listaReclamacoes.definir(getFilteredReclamacoes());
     }
 
     function atualizarPlacar(reclamacoes) {
@@ -618,49 +4059,57 @@ document.addEventListener('DOMContentLoaded', () => {
         } catch (error) { console.error("Erro ao promover mensagem:", error); }
     }
 
-    function addPromoteListeners() {
-        document.querySelectorAll('.promote-btn').forEach(btn => {
-            btn.addEventListener('click', (event) => { promoverMensagem(parseInt(event.target.dataset.id)); });
-        });
-    }
 
-    // CORREÇÃO SORTEIO: Função do sorteio restaurada e melhorada
-    function realizarSorteio() {
+    // O sorteio é feito e registrado no servidor; a animação só gira uma amostra de nomes.
+    async function realizarSorteio() {
         if (participantesCache.length === 0) return;
         drawButton.disabled = true;
         sorteioPlaceholder.classList.add('hidden');
         winnerDisplay.classList.remove('hidden');
+        winnerDisplay.innerHTML = '<p class="text-slate-500">Sorteando...</p>';
 
-        const rouletteItems = participantsList.querySelectorAll('.roulette-item');
-        let spinCount = 0;
-        const totalSpins = 30 + Math.floor(Math.random() * 10);
-        const winnerIndex = Math.floor(Math.random() * participantesCache.length);
-        const winner = participantesCache[winnerIndex];
+        let resultado;
+        try {
+            const response = await fetch(`${API_URL}/sorteio`, {
+                method: 'POST', headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({
+                    quantidade: parseInt(document.getElementById('sorteio-quantidade').value) || 1,
+                    excluir_vencedores_anteriores: document.getElementById('sorteio-excluir-anteriores').checked
+                })
+            });
+            resultado = await response.json();
+            if (!response.ok) throw new Error(resultado.message || 'Falha no sorteio.');
+        } catch (error) {
+            console.error("Erro ao sortear:", error);
+            winnerDisplay.innerHTML = `<p class="text-red-600">${error.message}</p>`;
+            sorteioPlaceholder.classList.add('hidden');
+            drawButton.disabled = false;
+            return;
+        }
 
+        const amostra = resultado.amostra.length ? resultado.amostra : [resultado.vencedores[0].nome];
+        const totalSpins = 30 + Math.floor(Math.random() * 10);
+        let spinCount = 0;
         const interval = setInterval(() => {
-            rouletteItems.forEach(item => item.classList.remove('bg-yellow-300', 'scale-110'));
-            
-            const currentIndex = spinCount % participantesCache.length;
-            rouletteItems[currentIndex].classList.add('bg-yellow-300', 'scale-110');
-            rouletteItems[currentIndex].scrollIntoView({ behavior: 'smooth', block: 'center' });
-
+            winnerDisplay.innerHTML = `<p class="text-2xl font-bold text-slate-400">${amostra[spinCount % amostra.length]}</p>`;
             spinCount++;
-            if (spinCount > totalSpins && currentIndex === winnerIndex) {
-                clearInterval(interval);
-                winnerDisplay.innerHTML = `
-                    <h3 class="text-lg font-bold text-indigo-700 animate-pulse">🏆 VENCEDOR! 🏆</h3>
-                    <p class="text-2xl font-bold mt-2">${winner.nome}</p>
-                    <p class="text-slate-600">${winner.telefone}</p>
-                    <button id="reset-sorteio-btn" class="mt-4 text-xs bg-gray-500 text-white font-semibold py-1 px-3 rounded hover:bg-gray-600 transition">Sortear Novamente</button>
-                `;
-                document.getElementById('reset-sorteio-btn').addEventListener('click', () => {
-                    winnerDisplay.classList.add('hidden');
-                    winnerDisplay.innerHTML = '';
-                    sorteioPlaceholder.classList.remove('hidden');
-                    drawButton.disabled = false;
-                    rouletteItems.forEach(item => item.classList.remove('bg-yellow-300', 'scale-110'));
-                });
-            }
+            if (spinCount <= totalSpins) return;
+            clearInterval(interval);
+            const vencedores = resultado.vencedores.map(v => `
+                <p class="text-2xl font-bold mt-2">${resultado.vencedores.length > 1 ? v.posicao + 'º ' : ''}${v.nome}</p>
+                <p class="text-slate-600">${v.telefone}</p>`).join('');
+            winnerDisplay.innerHTML = `
+                <h3 class="text-lg font-bold text-indigo-700 animate-pulse">🏆 ${resultado.vencedores.length > 1 ? 'VENCEDORES' : 'VENCEDOR'}! 🏆</h3>
+                ${vencedores}
+                <p class="text-xs text-slate-400 mt-2" title="${resultado.semente}">Sorteio #${resultado.id} · semente ${resultado.semente.slice(0, 12)}… · ${resultado.total_participantes} participantes</p>
+                <button id="reset-sorteio-btn" class="mt-4 text-xs bg-gray-500 text-white font-semibold py-1 px-3 rounded hover:bg-gray-600 transition">Sortear Novamente</button>
+            `;
+            document.getElementById('reset-sorteio-btn').addEventListener('click', () => {
+                winnerDisplay.classList.add('hidden');
+                winnerDisplay.innerHTML = '';
+                sorteioPlaceholder.classList.remove('hidden');
+                drawButton.disabled = false;
+            });
         }, 100);
     }
     
@@ -674,17 +4123,19 @@ document.addEventListener('DOMContentLoaded', () => {
         } catch (error) { console.error("Erro ao atualizar status:", error); }
     }
 
-    function addStatusChangeListeners() {
-        document.querySelectorAll('.status-select').forEach(select => {
-            select.addEventListener('change', (event) => {
-                updateStatus(parseInt(event.target.dataset.id), event.target.value);
-            });
-        });
-    }
+    // Event Listeners (delegados: um ouvinte por lista, não por card)
+    messagesList.addEventListener('click', (event) => {
+        const botao = event.target.closest('.promote-btn');
+        if (botao) promoverMensagem(parseInt(botao.dataset.id));
+    });
+    complaintsList.addEventListener('change', (event) => {
+        if (event.target.matches('.status-select')) updateStatus(parseInt(event.target.dataset.id), event.target.value);
+    });
+    messagesList.addEventListener('error', tratarErroMiniatura, true);
+    complaintsList.addEventListener('error', tratarErroMiniatura, true);
 
-    // Event Listeners
     startDisparoBtn.addEventListener('click', async () => {
-        const payload = { msg1: msg1.value, msg2: msg2.value, msg3: msg3.value };
+        const payload = { msg1: msg1.value, msg2: msg2.value, msg3: msg3.value, perfil: perfilDisparo.value };
         if (!payload.msg1 && !payload.msg2 && !payload.msg3) { 
             // Substituindo alert por uma indicação visual
             startDisparoBtn.textContent = 'Escreva pelo menos uma mensagem!';
@@ -717,6 +4168,10 @@ document.addEventListener('DOMContentLoaded', () => {
         if (start && end) { fetchMessages(start, end); }
     });
 
+    moreMessagesBtn.addEventListener('click', () => {
+        if (proximoCursorMensagens) { fetchMessages(null, null, proximoCursorMensagens); }
+    });
+
     resetMessagesBtn.addEventListener('click', () => {
         filterStartDate.value = '';
         filterEndDate.value = '';
@@ -727,10 +4182,40 @@ document.addEventListener('DOMContentLoaded', () => {
     fetchMainData();
     fetchMessages();
     fetchStats();
-    setInterval(fetchMainData, 20000);
-    setInterval(fetchMessages, 20000);
-    setInterval(fetchStats, 60000);
-    setInterval(fetchDisparoStatus, 5000);
+    // Com o canal de eventos conectado, o polling vira só uma sincronização de segurança.
+    let sseConectado = false;
+    function agendar(fn, intervaloPolling, intervaloComEventos) {
+        let ultimo = Date.now();
+        setInterval(() => {
+            const limite = sseConectado ? intervaloComEventos : intervaloPolling;
+            if (Date.now() - ultimo >= limite) { ultimo = Date.now(); fn(); }
+        }, 1000);
+    }
+
+    function conectarEventos() {
+        if (!window.EventSource) return;
+        const fonte = new EventSource(`${API_URL}/events`);
+        fonte.onopen = () => { sseConectado = true; };
+        fonte.onerror = () => { sseConectado = false; };
+        fonte.addEventListener('mensagem_nova', () => fetchNovasMensagens());
+        fonte.addEventListener('participante_novo', () => fetchMainData());
+        fonte.addEventListener('reclamacao_status', () => fetchMainData());
+        fonte.addEventListener('reclamacao_nova', (e) => {
+            const { mensagem_id } = JSON.parse(e.data);
+            mensagensCache = mensagensCache.filter(m => m.id !== mensagem_id);
+            listaMensagens.definir(mensagensCache);
+            fetchMainData();
+        });
+        fonte.addEventListener('campanha_progresso', () => fetchDisparoStatus());
+    }
+
+    conectarEventos();
+    agendar(fetchMainData, 20000, 120000);
+    agendar(fetchNovasMensagens, 20000, 120000);
+    // Mensagens promovidas em outra aba não chegam pelo delta; ressincroniza de vez em quando.
+    agendar(() => { if (!filtroMensagens) fetchMessages(); }, 300000, 300000);
+    agendar(fetchStats, 60000, 60000);
+    agendar(fetchDisparoStatus, 5000, 60000);
 });
 </script></body></html>
 """
@@ -740,14 +4225,11 @@ def home():
     return render_template_string(HTML_TEMPLATE)
 
 if __name__ == '__main__':
-    # Garante que as tabelas existam e carrega os participantes do DB
-    with app.app_context():
-        db.create_all()
-    carregar_participantes_iniciais()
+    # Garante que as tabelas existam e carrega os participantes do DB (processo único, sem disputa)
+    aplicar_migracoes(forcar=True)
+    iniciar_tarefas_de_fundo()
     
-    print("===================================================")
-    print("🚀 Servidor do Painel v9 (Modo Meta API + DB) iniciado!")
-    print("Acesse o painel em: http://127.0.0.1:5000")
-    print("===================================================")
+    logger.info("Servidor do Painel v9 (Modo Meta API + DB) iniciado!")
+    logger.info("Acesse o painel em: http://127.0.0.1:%s", os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 5000)), debug=False)
 
@@ -0,0 +1,269 @@
+"""
+Teste de carga reproduzível dos caminhos quentes do app.
+
+Sobe a Graph API falsa (bench/graph_falso.py), aponta o app para ela e roda, no
+próprio processo (Flask test client, sem servidor WSGI nem rede), os cenários:
+
+    webhook        notificações geradas por bench/gerador_webhook.py em paralelo
+    mensagens      GET /mensagens (primeira página e a seguinte, pelo cursor)
+    reclamacoes    GET /reclamacoes
+    participantes  GET /participantes, com e sem If-None-Match
+    campanha       um tarefa_disparo_massa completo no perfil escolhido
+
+Para cada cenário: vazão, latência p50/p99 e comandos SQL por requisição (lidos
+do registro de métricas do app). O banco padrão é um SQLite temporário; para o
+Postgres use --banco postgresql://... apontando para um banco só de teste.
+
+    python bench/bench_carga.py [--cenarios webhook,campanha] [--notificacoes 2000]
+                                [--banco URL] [--saida resultado.json] [--comparar anterior.json]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+RAIZ = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, RAIZ)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from graph_falso import criar_servidor  # noqa: E402
+from gerador_webhook import GeradorWebhook  # noqa: E402
+
+CENARIOS = ("webhook", "mensagens", "reclamacoes", "participantes", "campanha")
+
+
+def percentil(valores, p):
+    """Percentil pelo posto mais próximo (valores já ordenados)."""
+    if not valores: return None
+    return valores[min(len(valores) - 1, max(0, int(round(p * len(valores) + 0.5)) - 1))]
+
+
+def resumo(latencias_ms, duracao_s, consultas, erros=0, **extra):
+    ordenadas = sorted(latencias_ms)
+    total = len(ordenadas)
+    return {
+        "requisicoes": total, "erros": erros, "duracao_s": round(duracao_s, 3),
+        "vazao_por_s": round(total / duracao_s, 1) if duracao_s else None,
+        "p50_ms": round(percentil(ordenadas, 0.5), 2) if total else None,
+        "p99_ms": round(percentil(ordenadas, 0.99), 2) if total else None,
+        "consultas_sql": consultas, "consultas_por_requisicao": round(consultas / total, 2) if total else None,
+        **extra
+    }
+
+
+class Bancada:
+    def __init__(self, app_completo, args):
+        self.app = app_completo
+        self.args = args
+        self.local = threading.local()
+        self.gerador = GeradorWebhook(contatos=args.contatos, semente=args.semente, fracao_midia=args.fracao_midia)
+
+    def cliente(self):
+        if not hasattr(self.local, "cliente"):
+            self.local.cliente = self.app.app.test_client()
+        return self.local.cliente
+
+    def consultas_sql(self):
+        serie = self.app.metricas.series["whatformula_db_consultas_total"]
+        return sum(serie.values())
+
+    def medir(self, itens, executar, concorrencia=1):
+        """Executa `executar(cliente, item)` para cada item e mede a latência de cada chamada."""
+        latencias, erros, trava = [], [0], threading.Lock()
+
+        def uma(item):
+            inicio = time.perf_counter()
+            status = executar(self.cliente(), item)
+            ms = (time.perf_counter() - inicio) * 1000
+            with trava:
+                latencias.append(ms)
+                if status >= 400: erros[0] += 1
+
+        consultas_antes, inicio = self.consultas_sql(), time.perf_counter()
+        if concorrencia > 1:
+            with ThreadPoolExecutor(max_workers=concorrencia) as executor:
+                list(executor.map(uma, itens))
+        else:
+            for item in itens:
+                uma(item)
+        return latencias, time.perf_counter() - inicio, consultas_antes, erros[0]
+
+    def webhook(self):
+        notificacoes = self.gerador.notificacoes(self.args.notificacoes, self.args.por_notificacao)
+        latencias, duracao, consultas_antes, erros = self.medir(
+            notificacoes, lambda c, n: c.post("/webhook", json=n).status_code, self.args.concorrencia)
+        # Com WEBHOOK_ASYNC=1 a resposta sai antes da persistência: a vazão conta até a fila esvaziar.
+        inicio_dreno = time.perf_counter()
+        self.app.fila_webhook.join()
+        duracao += time.perf_counter() - inicio_dreno
+        return resumo(latencias, duracao, self.consultas_sql() - consultas_antes, erros,
+                      mensagens=len(notificacoes) * self.args.por_notificacao)
+
+    def leituras(self, url, quantidade=None):
+        quantidade = quantidade or self.args.leituras
+        latencias, duracao, consultas_antes, erros = self.medir(
+            range(quantidade), lambda c, _: c.get(url).status_code, self.args.concorrencia)
+        return resumo(latencias, duracao, self.consultas_sql() - consultas_antes, erros)
+
+    def mensagens(self):
+        resultado = {"primeira_pagina": self.leituras("/mensagens?limit=200")}
+        cursor = self.cliente().get("/mensagens?limit=200").get_json().get("proximo_cursor")
+        if cursor:
+            resultado["pagina_seguinte"] = self.leituras(f"/mensagens?limit=200&cursor={cursor}")
+        return resultado
+
+    def reclamacoes(self):
+        with self.app.app.app_context():
+            ids = [i for (i,) in self.app.db.session.query(self.app.Mensagem.id)
+                   .order_by(self.app.Mensagem.id.desc()).limit(self.args.reclamacoes)]
+            existentes = self.app.db.session.query(self.app.Reclamacao).count()
+        if existentes < self.args.reclamacoes:
+            for mensagem_id in ids:
+                self.cliente().post("/promover_reclamacao", json={"id": mensagem_id})
+        return self.leituras("/reclamacoes?limit=200")
+
+    def participantes(self):
+        completo = self.leituras("/participantes")
+        etag = self.cliente().get("/participantes").headers.get("ETag")
+        latencias, duracao, consultas_antes, erros = self.medir(
+            range(self.args.leituras),
+            lambda c, _: c.get("/participantes", headers={"If-None-Match": etag}).status_code,
+            self.args.concorrencia)
+        return {"completo": completo, "etag_304": resumo(latencias, duracao, self.consultas_sql() - consultas_antes, erros)}
+
+    def histograma_envios(self):
+        histograma = self.app.cliente_graph.latencias.get("enviar_mensagem")
+        return histograma, (histograma.instantaneo()[0] if histograma else None)
+
+    def campanha(self, graph):
+        app = self.app
+        with app.app.app_context():
+            elegiveis = len(app.carregar_elegiveis_24h(app.agora_local() - app.timedelta(hours=24)))
+        chamadas_antes, consultas_antes = graph.instantaneo(), self.consultas_sql()
+        _, envios_antes = self.histograma_envios()
+        inicio = time.perf_counter()
+        app.tarefa_disparo_massa(["Mensagem de teste de carga."], self.args.perfil)
+        # O agendador do app pode ter assumido a campanha antes: espera ela terminar de qualquer forma.
+        while True:
+            with app.app.app_context():
+                campanha = app.Campanha.query.order_by(app.Campanha.id.desc()).first()
+            if campanha.status not in app.ESTADOS_CAMPANHA_ATIVA: break
+            time.sleep(0.2)
+        duracao = time.perf_counter() - inicio
+        chamadas = {k: v - chamadas_antes.get(k, 0) for k, v in graph.instantaneo().items()
+                    if k.startswith("mensagens") and v != chamadas_antes.get(k, 0)}
+        # Só as chamadas desta campanha (o histograma do cliente também tem as boas-vindas do webhook).
+        histograma, envios_depois = self.histograma_envios()
+        envios = [depois - antes for depois, antes in zip(envios_depois or [], envios_antes or [0] * len(envios_depois or []))]
+        latencia = {"p50_ms": histograma.percentil(0.5, envios, sum(envios)),
+                    "p99_ms": histograma.percentil(0.99, envios, sum(envios))} if histograma else {}
+        return {
+            "status": campanha.status, "elegiveis": elegiveis, "concluidos": campanha.progresso,
+            "duracao_s": round(duracao, 3), "envios_por_s": round(campanha.progresso / duracao, 1) if duracao else None,
+            "graph_chamadas": chamadas, "graph_p50_ms": latencia.get("p50_ms"), "graph_p99_ms": latencia.get("p99_ms"),
+            "consultas_sql": self.consultas_sql() - consultas_antes,
+            "consultas_por_destinatario": round((self.consultas_sql() - consultas_antes) / max(1, campanha.progresso), 2),
+        }
+
+
+def versao_atual():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=RAIZ, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def linhas_relatorio(resultados, prefixo=""):
+    for nome, dados in resultados.items():
+        if isinstance(dados, dict) and not any(isinstance(v, (int, float)) for v in dados.values()):
+            yield from linhas_relatorio(dados, f"{prefixo}{nome}/")
+        elif isinstance(dados, dict):
+            yield f"{prefixo}{nome}", dados
+
+
+def imprimir(resultados, anteriores=None):
+    anteriores = dict(linhas_relatorio(anteriores or {}))
+    for nome, dados in linhas_relatorio(resultados):
+        partes = []
+        for chave in ("vazao_por_s", "envios_por_s", "p50_ms", "p99_ms", "graph_p50_ms", "graph_p99_ms",
+                      "consultas_por_requisicao", "consultas_por_destinatario"):
+            if dados.get(chave) is None: continue
+            texto = f"{chave}={dados[chave]}"
+            antes = anteriores.get(nome, {}).get(chave)
+            if antes:
+                texto += f" ({(dados[chave] - antes) / antes:+.0%})"
+            partes.append(texto)
+        print(f"{nome:28} {'  '.join(partes)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cenarios", default=",".join(CENARIOS))
+    parser.add_argument("--banco", help="URL do banco (padrão: SQLite temporário)")
+    parser.add_argument("--notificacoes", type=int, default=2000)
+    parser.add_argument("--por-notificacao", type=int, default=1)
+    parser.add_argument("--contatos", type=int, default=500)
+    parser.add_argument("--fracao-midia", type=float, default=0.1)
+    parser.add_argument("--leituras", type=int, default=200)
+    parser.add_argument("--reclamacoes", type=int, default=200)
+    parser.add_argument("--concorrencia", type=int, default=8)
+    parser.add_argument("--perfil", default="rapido", choices=("rapido", "conservador"))
+    parser.add_argument("--webhook-async", action="store_true", help="liga WEBHOOK_ASYNC no app")
+    parser.add_argument("--latencia-ms", type=float, default=50.0, help="latência da Graph API falsa")
+    parser.add_argument("--taxa-429", type=float, default=0.0)
+    parser.add_argument("--taxa-falha", type=float, default=0.0)
+    parser.add_argument("--semente", type=int, default=42)
+    parser.add_argument("--saida", help="grava o resultado em JSON")
+    parser.add_argument("--comparar", help="JSON de uma rodada anterior para comparar")
+    args = parser.parse_args()
+    cenarios = [c for c in args.cenarios.split(",") if c]
+    desconhecidos = set(cenarios) - set(CENARIOS)
+    if desconhecidos:
+        parser.error(f"cenários desconhecidos: {', '.join(sorted(desconhecidos))}")
+
+    servidor, graph, url_graph = criar_servidor(latencia_ms=args.latencia_ms, jitter_ms=args.latencia_ms / 4,
+                                                taxa_429=args.taxa_429, taxa_falha=args.taxa_falha)
+    temporario = tempfile.mkdtemp(prefix="bench_whatformula_")
+    # O ambiente precisa estar pronto antes de importar o app (a configuração é lida na importação).
+    os.environ.update({
+        "DATABASE_URL": args.banco or f"sqlite:///{os.path.join(temporario, 'bench.db')}",
+        "GRAPH_API_URL": url_graph, "META_ACCESS_TOKEN": "bench", "META_PHONE_NUMBER_ID": "bench",
+        "MEDIA_CACHE_DIR": os.path.join(temporario, "midia"), "PARTICIPANTES_CARGA_ASSINCRONA": "0",
+        "WEBHOOK_ASYNC": "1" if args.webhook_async else "0",
+    })
+    # As falhas injetadas geram logs de erro a cada envio: silenciados, a menos que LOG_LEVEL seja definido.
+    for chave, valor in {"LOG_LEVEL": "CRITICAL", "RETENCAO_INTERVALO_S": "0", "STATS_TAMANHO_INTERVALO_S": "0",
+                         "DISPARO_MSGS_POR_SEGUNDO": "1000", "GRAPH_BACKOFF_BASE_S": "0.05"}.items():
+        os.environ.setdefault(chave, valor)
+    import app_completo
+
+    app_completo.aplicar_migracoes()
+    bancada = Bancada(app_completo, args)
+    bancada.cliente().get("/participantes")  # aquecimento: o primeiro request sobe as tarefas de fundo
+    print(f"Banco: {app_completo.motor_banco.dialect.name}  Graph falsa: {url_graph}  Versão: {versao_atual()}")
+    resultados = {}
+    if "webhook" in cenarios or "campanha" in cenarios:
+        resultados["webhook"] = bancada.webhook()
+    for cenario in cenarios:
+        if cenario == "webhook": continue
+        resultados[cenario] = bancada.campanha(graph) if cenario == "campanha" else getattr(bancada, cenario)()
+
+    anteriores = None
+    if args.comparar:
+        with open(args.comparar, encoding="utf-8") as arquivo:
+            anteriores = json.load(arquivo)["resultados"]
+    imprimir(resultados, anteriores)
+    if args.saida:
+        with open(args.saida, "w", encoding="utf-8") as arquivo:
+            json.dump({"versao": versao_atual(), "banco": app_completo.motor_banco.dialect.name,
+                       "parametros": vars(args), "resultados": resultados}, arquivo, ensure_ascii=False, indent=2)
+    servidor.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Benchmark e medição de acurácia da extração de nomes.
+
+Compara extracao_nome.extrair_nome com a heurística anterior sobre o corpus
+bench/corpus_nomes.tsv e mede o custo por mensagem.
+
+    python bench/bench_extracao_nome.py [--repeticoes N]
+    python bench/bench_extracao_nome.py --corpus bench/corpus_nomes_validacao.tsv
+
+O segundo corpus é uma amostra separada, não usada para ajustar as regras; os
+limites de acurácia dos dois ficam em tests/test_extracao_nome.py.
+"""
+import argparse
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from extracao_nome import extrair_nome  # noqa: E402
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus_nomes.tsv")
+
+
+def extrair_nome_anterior(texto):
+    """A implementação original de app_completo.extrair_nome, para comparação."""
+    if not texto or not isinstance(texto, str): return None
+    match = re.search(r"(?:meu nome é|chamo-me|sou o|sou a)\s+([A-Za-zÀ-ú\s]+)", texto, re.IGNORECASE)
+    if match: return match.group(1).strip().title()
+    partes = texto.split()
+    if len(partes) >= 2 and partes[0].isalpha() and len(partes[0]) > 2:
+        return f"{partes[0].title()} {partes[1].title() if partes[1].isalpha() else ''}".strip()
+    return None
+
+
+def carregar_corpus(caminho):
+    casos = []
+    with open(caminho, encoding="utf-8") as arquivo:
+        for linha in arquivo:
+            if not linha.strip() or linha.startswith("#"): continue
+            texto, _, esperado = linha.rstrip("\n").partition("\t")
+            casos.append((texto, esperado.strip() or None))
+    return casos
+
+
+def acuracia(funcao, casos, mostrar_erros=False):
+    acertos = 0
+    for texto, esperado in casos:
+        obtido = funcao(texto)
+        if obtido == esperado:
+            acertos += 1
+        elif mostrar_erros:
+            print(f"  ✗ {texto!r}: esperado {esperado!r}, obtido {obtido!r}")
+    return acertos / len(casos)
+
+
+def microssegundos_por_mensagem(funcao, casos, repeticoes):
+    textos = [texto for texto, _ in casos]
+    inicio = time.perf_counter()
+    for _ in range(repeticoes):
+        for texto in textos:
+            funcao(texto)
+    return (time.perf_counter() - inicio) / (repeticoes * len(textos)) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeticoes", type=int, default=2000)
+    parser.add_argument("--corpus", default=CORPUS)
+    args = parser.parse_args()
+
+    casos = carregar_corpus(args.corpus)
+    print(f"Corpus: {len(casos)} mensagens")
+    for rotulo, funcao in (("anterior", extrair_nome_anterior), ("extracao_nome", extrair_nome)):
+        print(f"{rotulo}:")
+        taxa = acuracia(funcao, casos, mostrar_erros=rotulo == "extracao_nome")
+        custo = microssegundos_por_mensagem(funcao, casos, args.repeticoes)
+        print(f"  acurácia {taxa:.1%}, {custo:.2f} µs/mensagem")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Gerador de notificações do webhook da Cloud API para os testes de carga.
+
+Monta payloads no formato da Meta (entry -> changes -> value -> messages) com
+mensagens de texto e de mídia, agrupando várias mensagens por notificação como a
+Meta faz sob carga. A semente fixa torna cada rodada reproduzível.
+
+    python bench/gerador_webhook.py [--notificacoes 3] [--por-notificacao 5]
+"""
+import argparse
+import json
+import random
+import time
+import uuid
+
+TEXTOS = (
+    "oi, quero participar", "meu nome é {nome}", "bom dia! {nome} aqui", "me chamo {nome} {sobrenome}",
+    "como faço para participar do sorteio?", "{nome}", "olá, tudo bem?", "quero reclamar do atendimento",
+    "sou a {nome} da {sobrenome}", "boa noite, participando!",
+)
+NOMES = ("Ana", "Bruno", "Carla", "Diego", "Elisa", "Fábio", "Gabriela", "Hugo", "Íris", "João", "Larissa", "Marcos")
+SOBRENOMES = ("Silva", "Souza", "Oliveira", "Santos", "Pereira", "Costa", "Rodrigues", "Almeida")
+DDDS = (11, 21, 31, 41, 44, 51, 61, 71, 81, 91)
+
+
+class GeradorWebhook:
+    def __init__(self, contatos=1000, semente=42, fracao_midia=0.1):
+        self.aleatorio = random.Random(semente)
+        self.fracao_midia = fracao_midia
+        self.telefones = [f"55{self.aleatorio.choice(DDDS)}9{self.aleatorio.randrange(10**7, 10**8)}"
+                          for _ in range(contatos)]
+
+    def mensagem_texto(self, telefone=None):
+        texto = self.aleatorio.choice(TEXTOS).format(nome=self.aleatorio.choice(NOMES),
+                                                     sobrenome=self.aleatorio.choice(SOBRENOMES))
+        return self._mensagem(telefone, "text", {"text": {"body": texto}})
+
+    def mensagem_midia(self, telefone=None, tipo="image"):
+        midia = {"id": f"midia{uuid.UUID(int=self.aleatorio.getrandbits(128)).hex[:16]}", "mime_type": "image/jpeg"}
+        if self.aleatorio.random() < 0.5:
+            midia["caption"] = f"meu nome é {self.aleatorio.choice(NOMES)}"
+        return self._mensagem(telefone, tipo, {tipo: midia})
+
+    def _mensagem(self, telefone, tipo, conteudo):
+        return {"from": telefone or self.aleatorio.choice(self.telefones),
+                "id": f"wamid.{uuid.UUID(int=self.aleatorio.getrandbits(128)).hex}",
+                "timestamp": str(int(time.time())), "type": tipo, **conteudo}
+
+    def mensagem(self, telefone=None):
+        if self.aleatorio.random() < self.fracao_midia:
+            return self.mensagem_midia(telefone)
+        return self.mensagem_texto(telefone)
+
+    def notificacao(self, mensagens=1, entries=1):
+        """Uma notificação com `mensagens` mensagens distribuídas em `entries` entries."""
+        grupos = [[] for _ in range(max(1, entries))]
+        for i in range(mensagens):
+            grupos[i % len(grupos)].append(self.mensagem())
+        return {"object": "whatsapp_business_account", "entry": [{
+            "id": "0", "changes": [{"field": "messages", "value": {
+                "messaging_product": "whatsapp", "metadata": {"phone_number_id": "0"}, "messages": grupo
+            }}]
+        } for grupo in grupos if grupo]}
+
+    def notificacoes(self, quantidade, por_notificacao=1):
+        return [self.notificacao(por_notificacao, entries=1 + (por_notificacao > 3)) for _ in range(quantidade)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--notificacoes", type=int, default=3)
+    parser.add_argument("--por-notificacao", type=int, default=5)
+    parser.add_argument("--semente", type=int, default=42)
+    args = parser.parse_args()
+    gerador = GeradorWebhook(semente=args.semente)
+    for notificacao in gerador.notificacoes(args.notificacoes, args.por_notificacao):
+        print(json.dumps(notificacao, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
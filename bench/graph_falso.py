@@ -0,0 +1,142 @@
+"""
+Servidor local que imita a Graph API da Meta para testes de carga.
+
+Atende os endpoints que o app usa: envio de mensagens (POST /<phone_id>/messages),
+informações da mídia (GET /<media_id>/) e o download (GET /arquivo/<media_id>).
+A latência, a taxa de 429 (limite da Meta, com Retry-After) e a de falhas 500 são
+configuráveis. Aponte o app para ele com GRAPH_API_URL=http://127.0.0.1:<porta>.
+
+    python bench/graph_falso.py [--porta 8900] [--latencia-ms 80] [--taxa-429 0.02] [--taxa-falha 0.01]
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# JPEG mínimo válido (1x1), o bastante para o cache de mídia e as miniaturas.
+JPEG_1X1 = bytes.fromhex(
+    "ffd8ffe000104a46494600010100000100010000ffdb004300080606070605080707070909080a0c140d0c0b0b0c1912130f141d1a1f1e1d1a1c1c"
+    "20242e2720222c231c1c2837292c30313434341f27393d38323c2e333432ffc0000b080001000101011100ffc4001f000001050101010101010000"
+    "0000000000000102030405060708090a0bffc400b5100002010303020403050504040000017d01020300041105122131410613516107227114328191"
+    "a1082342b1c11552d1f02433627282090a161718191a25262728292a3435363738393a434445464748494a535455565758595a636465666768696a"
+    "737475767778797a838485868788898a92939495969798999aa2a3a4a5a6a7a8a9aab2b3b4b5b6b7b8b9bac2c3c4c5c6c7c8c9cad2d3d4d5d6d7d8"
+    "d9dae1e2e3e4e5e6e7e8e9eaf1f2f3f4f5f6f7f8f9faffda0008010100003f00fbd3ffd9"
+)
+
+
+class EstadoGraphFalso:
+    """Configuração e contadores do servidor, compartilhados entre as threads de atendimento."""
+
+    def __init__(self, latencia_ms=50.0, jitter_ms=20.0, taxa_429=0.0, taxa_falha=0.0, retry_after_s=1):
+        self.latencia_ms = latencia_ms
+        self.jitter_ms = jitter_ms
+        self.taxa_429 = taxa_429
+        self.taxa_falha = taxa_falha
+        self.retry_after_s = retry_after_s
+        self.contagens = {}
+        self.trava = threading.Lock()
+
+    def contar(self, chave):
+        with self.trava:
+            self.contagens[chave] = self.contagens.get(chave, 0) + 1
+
+    def instantaneo(self):
+        with self.trava:
+            return dict(self.contagens)
+
+
+class AtendenteGraph(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, como a API real
+    estado = None  # definido por criar_servidor
+
+    def log_message(self, formato, *args):
+        pass
+
+    def _responder(self, status, corpo, tipo="application/json", cabecalhos=None):
+        dados = corpo if isinstance(corpo, bytes) else json.dumps(corpo).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", tipo)
+        self.send_header("Content-Length", str(len(dados)))
+        for chave, valor in (cabecalhos or {}).items():
+            self.send_header(chave, valor)
+        self.end_headers()
+        self.wfile.write(dados)
+
+    def _simular(self, operacao):
+        """Aplica a latência e sorteia 429/500. Devolve True se a requisição deve seguir."""
+        estado = self.estado
+        time.sleep(max(0.0, random.gauss(estado.latencia_ms, estado.jitter_ms)) / 1000)
+        sorteio = random.random()
+        if sorteio < estado.taxa_429:
+            estado.contar(f"{operacao}:429")
+            self._responder(429, {"error": {"code": 130429, "message": "Rate limit hit"}},
+                            cabecalhos={"Retry-After": str(estado.retry_after_s)})
+            return False
+        if sorteio < estado.taxa_429 + estado.taxa_falha:
+            estado.contar(f"{operacao}:500")
+            self._responder(500, {"error": {"code": 1, "message": "An unknown error occurred"}})
+            return False
+        estado.contar(f"{operacao}:200")
+        return True
+
+    def do_POST(self):
+        tamanho = int(self.headers.get("Content-Length") or 0)
+        corpo = self.rfile.read(tamanho)
+        if not self.path.rstrip("/").endswith("/messages"):
+            return self._responder(404, {"error": {"code": 100, "message": "Unknown path"}})
+        try:
+            destinatario = json.loads(corpo)["to"]
+        except (ValueError, KeyError):
+            return self._responder(400, {"error": {"code": 100, "message": "Invalid parameter"}})
+        if not self._simular("mensagens"): return
+        self._responder(200, {"messaging_product": "whatsapp", "contacts": [{"input": destinatario, "wa_id": destinatario}],
+                              "messages": [{"id": f"wamid.{uuid.uuid4().hex}"}]})
+
+    def do_GET(self):
+        partes = [p for p in self.path.split("?")[0].split("/") if p]
+        if len(partes) == 2 and partes[0] == "arquivo":
+            if not self._simular("download"): return
+            return self._responder(200, JPEG_1X1, tipo="image/jpeg")
+        if len(partes) == 1:
+            if not self._simular("info_midia"): return
+            host = self.headers.get("Host")
+            return self._responder(200, {"url": f"http://{host}/arquivo/{partes[0]}", "mime_type": "image/jpeg",
+                                         "file_size": len(JPEG_1X1), "id": partes[0], "messaging_product": "whatsapp"})
+        self._responder(404, {"error": {"code": 100, "message": "Unknown path"}})
+
+
+def criar_servidor(porta=0, **configuracao):
+    """Sobe o servidor numa thread daemon. Devolve (servidor, estado, url_base)."""
+    estado = EstadoGraphFalso(**configuracao)
+    atendente = type("AtendenteGraphConfigurado", (AtendenteGraph,), {"estado": estado})
+    servidor = ThreadingHTTPServer(("127.0.0.1", porta), atendente)
+    servidor.daemon_threads = True
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor, estado, f"http://127.0.0.1:{servidor.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--porta", type=int, default=8900)
+    parser.add_argument("--latencia-ms", type=float, default=50.0)
+    parser.add_argument("--jitter-ms", type=float, default=20.0)
+    parser.add_argument("--taxa-429", type=float, default=0.0)
+    parser.add_argument("--taxa-falha", type=float, default=0.0)
+    args = parser.parse_args()
+
+    servidor, estado, url = criar_servidor(args.porta, latencia_ms=args.latencia_ms, jitter_ms=args.jitter_ms,
+                                           taxa_429=args.taxa_429, taxa_falha=args.taxa_falha)
+    print(f"Graph API falsa em {url} (Ctrl+C para sair)")
+    try:
+        while True:
+            time.sleep(10)
+            print(estado.instantaneo())
+    except KeyboardInterrupt:
+        servidor.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Extração do nome do remetente a partir do texto das mensagens do WhatsApp.
+
+Primeiro são testadas frases explícitas ("meu nome é...", "me chamo...", "aqui é
+o..."); sem elas, a heurística aceita as primeiras palavras do texto desde que não
+sejam saudações ou palavras comuns. Com NOMES_DICIONARIO apontando para um arquivo
+de primeiros nomes (um por linha), a heurística só aceita nomes desse dicionário.
+
+Todos os padrões são compilados na importação e as palavras ficam em frozensets,
+então cada chamada custa poucos microssegundos (veja bench/bench_extracao_nome.py).
+"""
+import os
+import re
+import unicodedata
+from functools import lru_cache
+
+_LETRAS = "A-Za-zÀ-ÖØ-öø-ÿ"
+_PALAVRA = rf"[{_LETRAS}][{_LETRAS}'’-]*"
+_NOME = rf"({_PALAVRA}(?:\s+{_PALAVRA}){{0,5}})"
+_SAUDACAO = r"(?:oi+|ol[aá]|opa|e\s+a[ií]|bom\s+dia|boa\s+tarde|boa\s+noite|al[oô])"
+
+PADROES_EXPLICITOS = tuple(re.compile(padrao, re.IGNORECASE) for padrao in (
+    rf"\bmeu\s+nome\s+(?:completo\s+)?(?:é|e|eh|:)\s*[:,-]?\s*{_NOME}",
+    rf"\bme\s+chamo\s+{_NOME}",
+    rf"\bchamo-me\s+{_NOME}",
+    rf"\bpode\s+me\s+chamar\s+de\s+{_NOME}",
+    rf"\b(?:aqui\s+(?:é|e|eh)|quem\s+fala\s+(?:é|e|eh))\s+(?:o\s+|a\s+)?{_NOME}",
+    rf"\bfala(?:ndo)?\s+(?:aqui\s+)?(?:é\s+)?(?:o|a)\s+{_NOME}",
+    rf"\bsou\s+(?:o|a)\s+{_NOME}",
+    rf"\bnome\s*[:=]\s*{_NOME}",
+))
+# "Ana aqui", "oi, Rui Costa aqui"
+PADRAO_NOME_AQUI = re.compile(rf"^\W*(?:{_SAUDACAO}\W+)?({_PALAVRA}(?:\s+{_PALAVRA})?)\s+aqui\b", re.IGNORECASE)
+PREFIXO_SAUDACAO = re.compile(rf"^\W*(?:{_SAUDACAO}\b[\s,.!;:-]*)+", re.IGNORECASE)
+PALAVRA_INICIAL = re.compile(rf"^\W*({_PALAVRA})(?:\s+({_PALAVRA}))?(?=$|[\s,.!?;:])")
+
+PARTICULAS = frozenset({"da", "de", "do", "das", "dos", "e", "d'"})
+
+# Saudações, pronomes, verbos e palavras frequentes nas mensagens que nunca são nome.
+# Comparadas sem acento e em minúsculas.
+PALAVRAS_COMUNS = frozenset("""
+oi oii oiii ola ole opa alo hey hello hi bom boa bons boas dia dias tarde tardes noite noites
+tudo bem beleza blz td tranquilo joia obrigado obrigada obg vlw valeu grato grata por favor pf pfv
+sim nao talvez ok okay certo claro isso esse essa este esta aquele aquela aqui ali la ai
+eu tu ele ela nos vos eles elas voce voces vc vcs meu minha meus minhas seu sua teu tua nosso nossa
+o a os as um uma uns umas de da do das dos em no na nos nas para pra pro com sem sobre ate que
+qual quais quando como onde porque pq quem quanto quanta
+quero queria gostaria preciso posso pode podem poderia vou vai vamos estou esta estamos estao
+sou somos tenho tem temos ter fazer fiz faz fala falar favor saber sei ja ainda so mais menos
+muito muita pouco bem mal agora hoje amanha ontem sempre nunca tambem entao mas porem
+participar participando participo sorteio sorteios promocao premio premios ganhar ganhei ganhador
+reclamacao reclamar problema duvida ajuda informacao informacoes atendimento suporte
+mensagem mensagens teste testando texto audio foto imagem video documento arquivo
+cliente senhor senhora sr sra moca moco amigo amiga pessoal gente galera
+boa-tarde boa-noite bom-dia nome chamo chama
+manda mande envia envie enviar mandar recebi recebeu chegou bora show top legal otimo perfeito
+sera seria cade quero-participar kkk kkkk haha rs parabens feliz amem deus gracas
+""".split())
+
+
+@lru_cache(maxsize=20000)
+def normalizar(palavra):
+    sem_acento = unicodedata.normalize("NFKD", palavra).encode("ascii", "ignore").decode()
+    return sem_acento.lower().strip("'’-")
+
+
+def carregar_dicionario(caminho):
+    """Lê um arquivo de primeiros nomes (um por linha, '#' comenta) para um frozenset normalizado."""
+    if not caminho or not os.path.exists(caminho):
+        return None
+    with open(caminho, encoding="utf-8") as arquivo:
+        return frozenset(normalizar(linha.strip()) for linha in arquivo if linha.strip() and not linha.startswith("#"))
+
+
+NOMES_DICIONARIO = carregar_dicionario(os.getenv("NOMES_DICIONARIO"))
+
+
+def _formatar(palavras):
+    return " ".join(p.lower() if normalizar(p) in PARTICULAS else p[:1].upper() + p[1:].lower() for p in palavras)
+
+
+def _limpar_nome(trecho, dicionario):
+    """Mantém as palavras do nome até a primeira palavra comum; partículas só no meio."""
+    palavras = []
+    for palavra in trecho.split():
+        chave = normalizar(palavra)
+        if chave in PARTICULAS:
+            palavras.append(palavra)
+            continue
+        if chave in PALAVRAS_COMUNS or len(chave) < 2:
+            break
+        palavras.append(palavra)
+        if len(palavras) >= 5:
+            break
+    while palavras and normalizar(palavras[-1]) in PARTICULAS:
+        palavras.pop()
+    if not palavras or normalizar(palavras[0]) in PARTICULAS:
+        return None
+    if dicionario is not None and normalizar(palavras[0]) not in dicionario:
+        return None
+    return _formatar(palavras)
+
+
+def extrair_nome(texto, dicionario=None):
+    """
+    Devolve o nome formatado ("Ana Souza", "Maria da Silva") ou None. O dicionário
+    padrão é o de NOMES_DICIONARIO; frases explícitas não dependem dele.
+    """
+    if not texto or not isinstance(texto, str):
+        return None
+    dicionario = NOMES_DICIONARIO if dicionario is None else dicionario
+
+    for padrao in PADROES_EXPLICITOS:
+        encontrado = padrao.search(texto)
+        if encontrado:
+            nome = _limpar_nome(encontrado.group(1), None)
+            if nome:
+                return nome
+
+    encontrado = PADRAO_NOME_AQUI.search(texto)
+    if encontrado:
+        nome = _limpar_nome(encontrado.group(1), dicionario)
+        if nome:
+            return nome
+
+    # Heurística: o texto começa pelo nome (depois de uma eventual saudação).
+    resto = PREFIXO_SAUDACAO.sub("", texto, count=1)
+    encontrado = PALAVRA_INICIAL.match(resto)
+    if not encontrado:
+        return None
+    primeira, segunda = encontrado.group(1), encontrado.group(2)
+    chave = normalizar(primeira)
+    if len(chave) < 3 or chave in PALAVRAS_COMUNS or chave in PARTICULAS:
+        return None
+    if dicionario is not None and chave not in dicionario:
+        return None
+    palavras = [primeira]
+    if segunda and normalizar(segunda) not in PALAVRAS_COMUNS and normalizar(segunda) not in PARTICULAS:
+        palavras.append(segunda)
+    return _formatar(palavras)
+
+
+def extrair_nomes(textos, dicionario=None):
+    """Versão em lote para backfills: um nome (ou None) por texto."""
+    return [extrair_nome(texto, dicionario) for texto in textos]
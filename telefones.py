@@ -0,0 +1,51 @@
+"""
+Normalização de telefones para a forma canônica gravada no banco: E.164 só com
+dígitos, sem o '+' (o mesmo formato do campo `from` da Cloud API).
+
+Para o Brasil (+55) aplica a regra do nono dígito: celulares (assinante começando
+em 6-9) com 8 dígitos ganham o 9 na frente; fixos (2-5) ficam com 8. A regra só
+vale para DDDs existentes. O resultado é memoizado, porque os mesmos números se
+repetem o tempo todo no webhook e nos jobs de backfill.
+"""
+import re
+from functools import lru_cache
+
+CODIGO_BRASIL = "55"
+DDDS_BRASIL = frozenset({
+    11, 12, 13, 14, 15, 16, 17, 18, 19,
+    21, 22, 24, 27, 28,
+    31, 32, 33, 34, 35, 37, 38,
+    41, 42, 43, 44, 45, 46, 47, 48, 49,
+    51, 53, 54, 55,
+    61, 62, 63, 64, 65, 66, 67, 68, 69,
+    71, 73, 74, 75, 77, 79,
+    81, 82, 83, 84, 85, 86, 87, 88, 89,
+    91, 92, 93, 94, 95, 96, 97, 98, 99,
+})
+_NAO_DIGITOS = re.compile(r"\D")
+
+
+def ddd_valido(ddd):
+    return ddd in DDDS_BRASIL
+
+
+@lru_cache(maxsize=65536)
+def normalizar_telefone(numero):
+    """
+    Devolve a forma canônica de `numero` ("+55 (44) 9836-9564" -> "5544998369564").
+    Números de outros países só perdem a formatação e o prefixo internacional "00".
+    """
+    digitos = _NAO_DIGITOS.sub("", numero)
+    if digitos.startswith("00"):
+        digitos = digitos[2:]
+    if not digitos.startswith(CODIGO_BRASIL):
+        return digitos
+
+    nacional = digitos[len(CODIGO_BRASIL):]
+    if len(nacional) != 10 or not ddd_valido(int(nacional[:2])):
+        return digitos
+    ddd, assinante = nacional[:2], nacional[2:]
+    if assinante[0] in "6789":
+        return f"{CODIGO_BRASIL}{ddd}9{assinante}"
+    return digitos
+
@@ -0,0 +1,34 @@
+"""
+Acurácia da extração de nomes sobre os corpora de bench/. O corpus principal foi
+escrito junto com as regras; o de validação não foi usado para ajustá-las, então
+é ele que mostra se uma mudança generaliza. Os limites ficam logo abaixo da
+acurácia medida: uma regressão faz o teste falhar.
+"""
+import os
+
+from bench.bench_extracao_nome import acuracia, carregar_corpus
+from extracao_nome import extrair_nome, extrair_nomes
+
+BENCH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bench")
+
+
+def test_acuracia_corpus_principal():
+    casos = carregar_corpus(os.path.join(BENCH, "corpus_nomes.tsv"))
+    assert acuracia(extrair_nome, casos) >= 0.97
+
+
+def test_acuracia_corpus_validacao():
+    casos = carregar_corpus(os.path.join(BENCH, "corpus_nomes_validacao.tsv"))
+    assert len(casos) >= 50
+    assert acuracia(extrair_nome, casos) >= 0.94
+
+
+def test_dicionario_restringe_so_a_heuristica():
+    dicionario = frozenset({"ana"})
+    assert extrair_nome("Rafael Costa", dicionario) is None
+    assert extrair_nome("Ana Souza", dicionario) == "Ana Souza"
+    assert extrair_nome("meu nome é Rafael", dicionario) == "Rafael"
+
+
+def test_extrair_nomes_em_lote():
+    assert extrair_nomes(["me chamo Bia", "ok", None]) == ["Bia", None, None]
@@ -0,0 +1,38 @@
+from telefones import ddd_valido, normalizar_telefone
+
+
+def test_celular_sem_nono_digito_ganha_o_9():
+    assert normalizar_telefone("554498369564") == "5544998369564"
+
+
+def test_formatacao_e_prefixo_internacional_sao_removidos():
+    assert normalizar_telefone("+55 (44) 9836-9564") == "5544998369564"
+    assert normalizar_telefone("0055 44 9836-9564") == "5544998369564"
+
+
+def test_celular_ja_canonico_nao_muda():
+    assert normalizar_telefone("5544998369564") == "5544998369564"
+
+
+def test_fixo_mantem_oito_digitos():
+    assert normalizar_telefone("554432251234") == "554432251234"
+
+
+def test_ddd_inexistente_nao_recebe_o_9():
+    assert not ddd_valido(20)
+    assert normalizar_telefone("552098369564") == "552098369564"
+
+
+def test_outros_paises_so_perdem_a_formatacao():
+    assert normalizar_telefone("+1 (415) 555-0100") == "14155550100"
+    assert normalizar_telefone("00351 912 345 678") == "351912345678"
+
+
+def test_tamanho_fora_do_padrao_brasileiro_fica_como_veio():
+    assert normalizar_telefone("55449836956") == "55449836956"
+
+
+def test_normalizar_e_idempotente():
+    for numero in ("554498369564", "+55 11 2345-6789", "+1 415 555 0100"):
+        canonico = normalizar_telefone(numero)
+        assert normalizar_telefone(canonico) == canonico